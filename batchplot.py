@@ -0,0 +1,316 @@
+"""
+Batch rendering of diagnostic plots for many results, e.g. a parameter
+scan or a toy study
+
+The plots of a collection of results are first extracted as PlotItems,
+plain numpy data, then rendered on one reused canvas: with ROOT in batch
+mode, or with matplotlib (no ROOT needed). Output is either one multi-page
+PDF, or one file per plot from a filename pattern like "plots/scan_{}.png".
+Given an executor, the items are split into chunks rendered in parallel,
+each to its own part file; multi-page parts are merged if pypdf is installed.
+"""
+
+import os
+import numpy
+import profiling
+
+class PlotItem(object):
+    """
+    The data of one plot: a 1D histogram with errors ("hist1d"), a 2D
+    histogram ("hist2d"), or a line of points ("graph")
+    """
+
+    def __init__(self,kind,values,xBinEdges=None,yBinEdges=None,errors=None,x=None,
+                        title="",xTitle="",yTitle="",drawOption=None):
+        """
+        Inputs:
+            kind: "hist1d", "hist2d", or "graph"
+            values: numpy array of bin contents (nX,) or (nX,nY), or the y of the graph points
+            xBinEdges: numpy array of x bin edges, for histograms
+            yBinEdges: numpy array of y bin edges, for 2D histograms
+            errors: optional numpy array of 1 sigma errors, for 1D histograms
+            x: numpy array of the x of the graph points
+            title, xTitle, yTitle: str plot and axis titles
+            drawOption: optional ROOT draw option, default "E", "colz", or "APL" by kind
+        """
+        if not (kind in ("hist1d","hist2d","graph")):
+            raise ValueError("kind must be 'hist1d', 'hist2d', or 'graph'",kind)
+        self.kind = kind
+        self.values = numpy.asarray(values,dtype=numpy.float64)
+        self.xBinEdges = None if xBinEdges is None else numpy.asarray(xBinEdges,dtype=numpy.float64)
+        self.yBinEdges = None if yBinEdges is None else numpy.asarray(yBinEdges,dtype=numpy.float64)
+        self.errors = None if errors is None else numpy.asarray(errors,dtype=numpy.float64)
+        self.x = None if x is None else numpy.asarray(x,dtype=numpy.float64)
+        self.title = title
+        self.xTitle = xTitle
+        self.yTitle = yTitle
+        if drawOption is None:
+            drawOption = {"hist1d": "E","hist2d": "colz","graph": "APL"}[kind]
+        self.drawOption = drawOption
+
+def _resultItems(result,covariance,binEdges,xAxisTitle,yAxisTitle,titlePrefix,label=""):
+    """
+    Returns the result and covariance PlotItems of one unfolded result, as
+    UnfoldResult.plotResult and plotCovarianceMatrix draw them
+    """
+    errors = numpy.sqrt(numpy.abs(numpy.diag(covariance)))
+    return [PlotItem("hist1d",result,binEdges,errors=errors,title=titlePrefix+"Unfolded Histogram"+label,
+                        xTitle="True {}".format(xAxisTitle),yTitle="Unfolded {}".format(yAxisTitle)),
+            PlotItem("hist2d",covariance,binEdges,binEdges,title=titlePrefix+"Unfolded Covariance Matrix"+label,
+                        xTitle="True {}".format(xAxisTitle),yTitle="True {}".format(xAxisTitle))]
+
+def getPlotItems(obj):
+    """
+    Returns the list of diagnostic PlotItems of a result, made from its
+    arrays, without ROOT
+    Inputs:
+        obj: Unfolding, UnfoldResult, BatchResult, ScanResult, or
+            xsec.XsecUnfoldResult, or a list of these
+    Outputs:
+        list of PlotItem
+    """
+    import unfold_base
+    import xsec
+    if isinstance(obj,(list,tuple)):
+        return [item for element in obj for item in getPlotItems(element)]
+    if isinstance(obj,unfold_base.Unfolding):
+        return [PlotItem("hist1d",obj.reconstructed,obj.recoBinEdges,errors=numpy.sqrt(numpy.abs(obj.reconstructedVariance)),
+                            title=obj.titlePrefix+"Reconstructed Histogram",
+                            xTitle="Reconstructed {}".format(obj.xAxisTitle),yTitle="Reconstructed {}".format(obj.yAxisTitle)),
+                PlotItem("hist2d",obj.getMigrationArray(),obj.recoBinEdges,obj.trueBinEdges,title=obj.titlePrefix+"Migration Matrix",
+                            xTitle="Reconstructed {}".format(obj.xAxisTitle),yTitle="True {}".format(obj.xAxisTitle))]
+    if isinstance(obj,unfold_base.UnfoldResult):
+        return _resultItems(obj.result,obj.covariance,obj.binEdges,obj.xAxisTitle,obj.yAxisTitle,obj.titlePrefix)
+    if isinstance(obj,(unfold_base.ScanResult,unfold_base.BatchResult)):
+        unfolding = obj.unfolding
+        result = []
+        for i in range(len(obj)):
+            if isinstance(obj,unfold_base.ScanResult):
+                label = " (parameter {})".format(obj.parameters[i])
+            else:
+                label = " (spectrum {})".format(i)
+            result += _resultItems(obj.results[i],obj.covariances[i],unfolding.trueBinEdges,
+                                    unfolding.xAxisTitle,unfolding.yAxisTitle,unfolding.titlePrefix,label)
+        if isinstance(obj,unfold_base.ScanResult) and len(obj) > 1:
+            logResiduals, logRegularizations, curvatures = obj.getLCurve()
+            result.append(PlotItem("graph",logRegularizations,x=logResiduals,title=unfolding.titlePrefix+"L-Curve",
+                                    xTitle="log_{10}(#chi^{2})",yTitle="log_{10}(|Lx|^{2})"))
+        return result
+    if isinstance(obj,xsec.XsecUnfoldResult):
+        unfolding = obj.numUnfoldResult
+        return [PlotItem("hist1d",obj.result,obj.binEdges,errors=obj.getErrorArray(),
+                            title=unfolding.titlePrefix+"Unfolded Cross Section",
+                            xTitle="True {}".format(unfolding.xAxisTitle),yTitle="Cross Section")]
+    raise TypeError("Don't know how to plot",type(obj))
+
+def _isPattern(outfilename):
+    return "{}" in outfilename
+
+class RootRenderer(object):
+    """
+    Draws PlotItems on one pooled batch-mode TCanvas, with pooled scratch
+    histograms from utilities.ROOTObjectManager
+    """
+
+    def __init__(self):
+        from utilities import getROOT, getObjectManager
+        self.ROOT = getROOT()
+        self.ROOT.gROOT.SetBatch(True)
+        self.objectManager = getObjectManager()
+        self.canvas = self.objectManager.acquireCanvas()
+        self.outfilename = None
+
+    def open(self,outfilename):
+        self.outfilename = outfilename
+        if not _isPattern(outfilename):
+            self.canvas.Print(outfilename+"[")
+
+    def draw(self,item,iPage):
+        import rootadapter
+        from utilities import setupCOLZFrame
+        canvas = self.canvas
+        canvas.Clear()
+        hist = None
+        if item.kind == "hist1d":
+            obj = hist = self.objectManager.acquireHist(item.xBinEdges)
+            rootadapter.setHistContents(hist,item.values,item.errors)
+        elif item.kind == "hist2d":
+            setupCOLZFrame(canvas)
+            obj = hist = self.objectManager.acquireHist(item.xBinEdges,item.yBinEdges)
+            rootadapter.setHistContents(hist,item.values)
+        else:
+            obj = self.objectManager.track(self.ROOT.TGraph(len(item.x),numpy.ascontiguousarray(item.x),
+                                                            numpy.ascontiguousarray(item.values)))
+        obj.SetTitle(item.title)
+        obj.GetXaxis().SetTitle(item.xTitle)
+        obj.GetYaxis().SetTitle(item.yTitle)
+        obj.Draw(item.drawOption)
+        if _isPattern(self.outfilename):
+            canvas.SaveAs(self.outfilename.format(iPage))
+        else:
+            canvas.Print(self.outfilename)
+        if item.kind == "hist2d":
+            setupCOLZFrame(canvas,reset=True)
+        canvas.Clear()
+        if not (hist is None):
+            self.objectManager.releaseHist(hist)
+
+    def close(self):
+        if not _isPattern(self.outfilename):
+            self.canvas.Print(self.outfilename+"]")
+        self.objectManager.releaseCanvas(self.canvas)
+        self.canvas = None
+
+class MatplotlibRenderer(object):
+    """
+    Draws PlotItems on one reused matplotlib figure with the Agg backend,
+    without ROOT or pyplot's global state
+    """
+
+    def __init__(self,figsize=(7,7)):
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        self.figure = Figure(figsize=figsize)
+        FigureCanvasAgg(self.figure)
+        self.outfilename = None
+        self.pdf = None
+
+    def open(self,outfilename):
+        self.outfilename = outfilename
+        if not _isPattern(outfilename):
+            from matplotlib.backends.backend_pdf import PdfPages
+            self.pdf = PdfPages(outfilename)
+
+    def draw(self,item,iPage):
+        figure = self.figure
+        figure.clf()
+        axes = figure.add_subplot(1,1,1)
+        if item.kind == "hist1d":
+            centers = 0.5*(item.xBinEdges[1:]+item.xBinEdges[:-1])
+            axes.stairs(item.values,item.xBinEdges)
+            if not (item.errors is None):
+                axes.errorbar(centers,item.values,yerr=item.errors,fmt="none")
+        elif item.kind == "hist2d":
+            # Contents are (nX,nY), pcolormesh wants rows along y
+            mesh = axes.pcolormesh(item.xBinEdges,item.yBinEdges,item.values.T)
+            figure.colorbar(mesh,ax=axes)
+        else:
+            axes.plot(item.x,item.values,marker="o")
+        axes.set_title(item.title)
+        axes.set_xlabel(item.xTitle)
+        axes.set_ylabel(item.yTitle)
+        if self.pdf is None:
+            figure.savefig(self.outfilename.format(iPage))
+        else:
+            self.pdf.savefig(figure)
+
+    def close(self):
+        if not (self.pdf is None):
+            self.pdf.close()
+            self.pdf = None
+        self.figure.clf()
+
+def getRenderer(backend="auto"):
+    """
+    Returns a renderer
+    Inputs:
+        backend: "root", "matplotlib", or "auto" for matplotlib if installed, else ROOT
+    """
+    if backend == "auto":
+        try:
+            import matplotlib
+            backend = "matplotlib"
+        except ImportError:
+            backend = "root"
+    if backend == "matplotlib":
+        return MatplotlibRenderer()
+    if backend == "root":
+        return RootRenderer()
+    raise ValueError("backend must be 'root', 'matplotlib', or 'auto'",backend)
+
+@profiling.profiled()
+def render(items,outfilename,backend="auto",firstPage=0):
+    """
+    Renders PlotItems in this process
+    Inputs:
+        items: list of PlotItem
+        outfilename: multi-page .pdf filename, or a pattern with "{}" replaced
+            by the page number, e.g. "plots/scan_{}.png"
+        backend: see getRenderer
+        firstPage: int page number of the first item, for patterns
+    """
+    if not _isPattern(outfilename) and not outfilename.endswith(".pdf"):
+        raise ValueError("outfilename must be a .pdf or contain {} for one file per plot",outfilename)
+    renderer = getRenderer(backend)
+    renderer.open(outfilename)
+    try:
+        for iItem, item in enumerate(items):
+            renderer.draw(item,firstPage+iItem)
+    finally:
+        renderer.close()
+
+def _renderTask(items,task):
+    start, stop, outfilename, backend = task
+    render(items[start:stop],outfilename,backend,firstPage=start)
+    return outfilename
+
+def _mergePdfs(partFilenames,outfilename):
+    """
+    Merges PDF files into outfilename and deletes them, returning True, or
+    returns False if pypdf isn't installed
+    """
+    try:
+        import pypdf
+    except ImportError:
+        return False
+    writer = pypdf.PdfWriter()
+    for partFilename in partFilenames:
+        writer.append(partFilename)
+    with open(outfilename,"wb") as outFile:
+        writer.write(outFile)
+    for partFilename in partFilenames:
+        os.remove(partFilename)
+    return True
+
+def plotAll(results,outfilename,backend="auto",executor=None,nChunks=None):
+    """
+    Renders the diagnostic plots of a collection of results
+    Inputs:
+        results: an object or list accepted by getPlotItems, or a list of PlotItem
+        outfilename: multi-page .pdf filename, or a pattern with "{}" replaced
+            by the plot number, e.g. "plots/scan_{}.png"
+        backend: "root", "matplotlib", or "auto"
+        executor: optional executors.ProcessExecutor to render chunks of the
+            plots in parallel
+        nChunks: int number of chunks, default the number of workers
+    Outputs:
+        list of the files written: outfilename for a multi-page output, or its
+        parts "<name>_part<i>.pdf" if they were rendered in parallel and
+        pypdf isn't installed to merge them
+    """
+    if isinstance(results,(list,tuple)) and all(isinstance(item,PlotItem) for item in results):
+        items = list(results)
+    else:
+        items = getPlotItems(results)
+    if executor is None or len(items) < 2:
+        render(items,outfilename,backend)
+        return [outfilename] if not _isPattern(outfilename) else [outfilename.format(i) for i in range(len(items))]
+
+    if nChunks is None:
+        nChunks = executor.nWorkers
+    nChunks = max(1,min(nChunks,len(items)))
+    bounds = numpy.linspace(0,len(items),nChunks+1).astype(int)
+    tasks = []
+    for iChunk in range(nChunks):
+        if _isPattern(outfilename):
+            chunkFilename = outfilename
+        else:
+            chunkFilename = "{}_part{}.pdf".format(outfilename[:-len(".pdf")],iChunk)
+        tasks.append((int(bounds[iChunk]),int(bounds[iChunk+1]),chunkFilename,backend))
+    partFilenames = executor.run(_renderTask,tasks,items)
+    if _isPattern(outfilename):
+        return [outfilename.format(i) for i in range(len(items))]
+    if _mergePdfs(partFilenames,outfilename):
+        return [outfilename]
+    print("Warning: pypdf isn't installed, so the plots were left in {} part files".format(len(partFilenames)))
+    return partFilenames
@@ -0,0 +1,219 @@
+"""
+Benchmarks of the unfolding techniques across binnings, statistics, and smearing
+
+Each problem is generated with utilities.CreateFakeDataArrays. For each
+technique, construction, the first unfold (including any response
+factorization), a repeated unfold, and the covariance propagation of the
+linear techniques are timed separately. The peak memory allocated through
+Python is measured in a separate, untimed pass, as tracing allocations
+slows down Python code. Results are written as one JSON object per line,
+so runs can be compared to catch regressions.
+
+Usage:
+    python benchmark.py --bins 10 50 200 --events 100000 --smearing 0.05 0.1 -o results.jsonl
+"""
+
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+import numpy
+import cache
+from utilities import CreateFakeDataArrays
+
+def _numpyTechniques():
+    from matrixinverse import UnfoldingMatrixInverse
+    from svdunfold import UnfoldingSVD
+    from tikhonov import UnfoldingTikhonov
+    from iterativebayes import UnfoldingIterativeBayes
+    return {
+        "matrixinverse": (UnfoldingMatrixInverse,lambda nTrue: None),
+        "svd": (UnfoldingSVD,lambda nTrue: max(1,nTrue//2)),
+        "tikhonov": (UnfoldingTikhonov,lambda nTrue: 1e-3),
+        "bayes": (UnfoldingIterativeBayes,lambda nTrue: 4),
+    }
+
+def _rootTechniques():
+    from tunfold import UnfoldingTUnfold
+    from tsvdunfold import UnfoldingTSVDUnfold
+    return {
+        "tunfold": (UnfoldingTUnfold,lambda nTrue: 1e-3),
+        "tsvdunfold": (UnfoldingTSVDUnfold,lambda nTrue: max(1,nTrue//2)),
+    }
+
+def getTechniques():
+    """
+    Returns a dict of technique name to (Unfolding class, function of nTrue
+    giving the parameter to benchmark with), with the ROOT techniques
+    included only if ROOT can be imported
+    """
+    result = _numpyTechniques()
+    try:
+        result.update(_rootTechniques())
+    except ImportError:
+        pass
+    return result
+
+def _makeInputs(name,dataBuilder,mcBuilder):
+    """
+    Returns the constructor arguments for a technique, as ROOT histograms
+    for the ROOT techniques and arrays otherwise
+    """
+    if name in ("tunfold","tsvdunfold"):
+        from rootadapter import makeHist, makeHist2D
+        recoBinEdges = mcBuilder.recoBinEdges
+        trueBinEdges = mcBuilder.trueBinEdges
+        reconstructed = dataBuilder.getRecoHist()
+        args = [makeHist(reconstructed,recoBinEdges,errors=numpy.sqrt(reconstructed)),
+                makeHist2D(mcBuilder.getMigrationMatrix(),recoBinEdges,trueBinEdges)]
+        if name == "tsvdunfold":
+            args += [makeHist(mcBuilder.getRecoHist(),recoBinEdges),makeHist(mcBuilder.getTrueHist(),trueBinEdges)]
+        return args, {}
+    return ([dataBuilder.getRecoHist(),mcBuilder.getMigrationMatrix()],
+            {"recoBinEdges": mcBuilder.recoBinEdges,"trueBinEdges": mcBuilder.trueBinEdges})
+
+def _timeStage(function,repeats):
+    """
+    Returns the result of function() and the minimum wall time in seconds of repeats calls
+    """
+    best = None
+    for iRepeat in range(repeats):
+        start = time.perf_counter()
+        result = function()
+        elapsed = time.perf_counter()-start
+        best = elapsed if best is None else min(best,elapsed)
+    return result, best
+
+def _peakMemory(function):
+    """
+    Returns the peak memory in bytes allocated through Python while calling function()
+    """
+    tracemalloc.start()
+    try:
+        function()
+        currentMemory, peakMemory = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return peakMemory
+
+def benchmarkTechnique(name,unfoldingClass,parameter,dataBuilder,mcBuilder,repeats=3):
+    """
+    Times one technique on one problem
+
+    covarianceSeconds is the time of the covariance work inside unfold:
+    Unfolding.propagateCovariance with the unfolding matrix for SVD and
+    Tikhonov, and SparseResponse.propagate for matrix inverse. Iterative Bayes propagates its covariance in the same pass
+    as the result, so it has none. For the ROOT techniques, whose covariance
+    is computed by DoUnfold, histogramSeconds is the time to make the
+    covariance histogram instead.
+    Inputs:
+        name: technique name, see getTechniques
+        unfoldingClass: Unfolding subclass
+        parameter: the regularization, n-iterations, etc. input parameter
+        dataBuilder, mcBuilder: histbuilder.ResponseBuilder from CreateFakeDataArrays
+        repeats: int number of times each stage is run, the minimum time is kept
+    Outputs:
+        dict of times in seconds and peak traced memory in bytes
+    """
+    args, kargs = _makeInputs(name,dataBuilder,mcBuilder)
+    previousCache = cache.getDefaultCache()
+    result = {}
+    try:
+        # A disabled cache, so every construction and first unfold does the full setup
+        cache.setDefaultCache(cache.DecompositionCache(maxEntries=0))
+        unfolding, result["constructSeconds"] = _timeStage(lambda: unfoldingClass(*args,**kargs),repeats)
+        def firstUnfold():
+            fresh = unfoldingClass(*args,**kargs)
+            start = time.perf_counter()
+            fresh.unfold(parameter)
+            return time.perf_counter()-start
+        result["unfoldSeconds"] = min(firstUnfold() for iRepeat in range(repeats))
+        unfolding.unfold(parameter)
+        unfoldResult, result["repeatUnfoldSeconds"] = _timeStage(lambda: unfolding.unfold(parameter),repeats)
+        if name in ("tunfold","tsvdunfold"):
+            result["histogramSeconds"] = _timeStage(unfoldResult.getCovarianceMatrix,repeats)[1]
+        elif name == "matrixinverse":
+            # Propagated with solves against the factorized response, as in unfold
+            response = unfolding.getSparseResponse()
+            result["covarianceSeconds"] = _timeStage(lambda: response.propagate(unfolding.reconstructedVariance),repeats)[1]
+        else:
+            try:
+                unfoldingMatrix = unfolding.getUnfoldingMatrix(parameter)
+            except NotImplementedError:
+                result["covarianceSeconds"] = None
+            else:
+                result["covarianceSeconds"] = _timeStage(lambda: unfolding.propagateCovariance(unfoldingMatrix),repeats)[1]
+        result["peakTracedBytes"] = _peakMemory(lambda: unfoldingClass(*args,**kargs).unfold(parameter))
+    finally:
+        cache.setDefaultCache(previousCache)
+    return result
+
+def runBenchmarks(binCounts,eventCounts,smearings,techniques=None,repeats=3,seed=0,recoBinFactor=1,output=sys.stdout):
+    """
+    Runs every technique on every combination of binning, statistics, and
+    smearing, writing one JSON line per technique and problem to output
+    Inputs:
+        binCounts: list of int numbers of true bins
+        eventCounts: list of int numbers of data events; the MC has 10 times more
+        smearings: list of float relative reco smearing
+        techniques: list of technique names, default all available
+        repeats: int number of times each stage is run
+        seed: int random seed for the fake data
+        recoBinFactor: int number of reco bins per true bin
+        output: file to write to
+    Outputs:
+        list of the result dicts
+    """
+    available = getTechniques()
+    if techniques is None:
+        techniques = sorted(available)
+    for name in techniques:
+        if not (name in available):
+            raise ValueError("Unknown or unavailable technique, choose from {}".format(sorted(available)),name)
+    results = []
+    for nTrue in binCounts:
+        nReco = nTrue*recoBinFactor
+        for nEvents in eventCounts:
+            for smearing in smearings:
+                rng = numpy.random.default_rng(seed)
+                dataBuilder, mcBuilder = CreateFakeDataArrays(nEvents,10*nEvents,nReco,nTrue,smearing,smearing,rng=rng)
+                for name in techniques:
+                    unfoldingClass, getParameter = available[name]
+                    parameter = getParameter(nTrue)
+                    result = {"technique": name,"nTrue": nTrue,"nReco": nReco,"nEvents": nEvents,
+                                "smearing": smearing,"parameter": parameter,
+                                "python": platform.python_version(),"numpy": numpy.__version__}
+                    try:
+                        result.update(benchmarkTechnique(name,unfoldingClass,parameter,dataBuilder,mcBuilder,repeats))
+                    except Exception as e:
+                        # e.g. matrix inverse with non-square binnings, or a singular response
+                        result["error"] = "{}: {}".format(type(e).__name__,e)
+                    output.write(json.dumps(result)+"\n")
+                    output.flush()
+                    results.append(result)
+    return results
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the unfolding techniques, writing JSON lines")
+    parser.add_argument("--bins",type=int,nargs="+",default=[10,50,200],help="numbers of true bins")
+    parser.add_argument("--reco-bin-factor",type=int,default=1,help="number of reco bins per true bin")
+    parser.add_argument("--events",type=int,nargs="+",default=[10000,1000000],help="numbers of data events")
+    parser.add_argument("--smearing",type=float,nargs="+",default=[0.05],help="relative reco smearing")
+    parser.add_argument("--techniques",nargs="+",default=None,help="techniques to run, default all available")
+    parser.add_argument("--repeats",type=int,default=3,help="runs of each stage, the minimum time is kept")
+    parser.add_argument("--seed",type=int,default=0,help="random seed for the fake data")
+    parser.add_argument("-o","--output",default=None,help="output file, default stdout")
+    args = parser.parse_args(argv)
+
+    output = sys.stdout if args.output is None else open(args.output,"w")
+    try:
+        runBenchmarks(args.bins,args.events,args.smearing,args.techniques,args.repeats,args.seed,
+                        args.reco_bin_factor,output)
+    finally:
+        if not (args.output is None):
+            output.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,297 @@
+"""
+Multidimensional binnings, flattened to the 1D bin index used by the unfolding core
+
+A Binning is the product of one set of bin edges per axis, e.g. kinetic
+energy and angle, optionally with a mask dropping unused bins (e.g.
+kinematically forbidden ones), like a TUnfoldBinning distribution. Kept bins
+are numbered 0..nBins-1 in C order, the compact index. Unfolding accepts a
+Binning in place of recoBinEdges or trueBinEdges, flattens N-D inputs with
+it, and UnfoldResult maps the results and covariances back to N-D arrays.
+
+MultiResponseBuilder fills the migration matrix between two binnings from
+events, accumulating only its non-zero entries, so large N-D responses are
+built sparse.
+"""
+
+import numpy
+from histbuilder import binIndices, EventIndices, ResponseBuilder
+
+class Binning(object):
+    """
+    Product binning of several axes, with a compact index for the kept bins
+    """
+
+    def __init__(self,binEdges,names=None,mask=None):
+        """
+        Inputs:
+            binEdges: list of increasing 1D arrays of bin edges, one per axis
+            names: optional list of axis names, e.g. ["Kinetic Energy [MeV]","cos#theta"]
+            mask: optional bool array with one entry per N-D bin, True for
+                the bins kept, default all
+        """
+        binEdges = [numpy.array(edges,dtype=numpy.float64) for edges in binEdges]
+        if len(binEdges) < 1:
+            raise ValueError("binEdges must have at least one axis")
+        for edges in binEdges:
+            if edges.ndim != 1 or len(edges) < 2 or (numpy.diff(edges) <= 0.).any():
+                raise ValueError("Bin edges must be a 1D increasing array with at least 2 entries",edges)
+        if names is None:
+            names = ["axis{}".format(i) for i in range(len(binEdges))]
+        if len(names) != len(binEdges):
+            raise ValueError("names must have one entry per axis",names)
+        self.binEdges = binEdges
+        self.names = list(names)
+        self.shape = tuple(len(edges)-1 for edges in binEdges)
+        self.nAxes = len(self.shape)
+        self.nFullBins = int(numpy.prod(self.shape))
+        if mask is None:
+            self.mask = None
+            self.fullIndices = numpy.arange(self.nFullBins)
+        else:
+            mask = numpy.array(mask,dtype=bool)
+            if mask.shape != self.shape:
+                raise ValueError("mask must have shape {}".format(self.shape),mask.shape)
+            self.mask = mask
+            self.fullIndices = numpy.flatnonzero(mask)
+        self.nBins = len(self.fullIndices)
+        # Compact index of each N-D bin in C order, -1 if masked
+        self.compactIndices = numpy.full(self.nFullBins,-1,dtype=numpy.int64)
+        self.compactIndices[self.fullIndices] = numpy.arange(self.nBins)
+
+    def __eq__(self,other):
+        return (isinstance(other,Binning) and self.shape == other.shape
+                and all(numpy.array_equal(a,b) for a, b in zip(self.binEdges,other.binEdges))
+                and numpy.array_equal(self.fullIndices,other.fullIndices))
+
+    def __ne__(self,other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.shape,self.nBins))
+
+    def getBinEdges(self,axis=0):
+        return self.binEdges[axis].copy()
+
+    def getBinCenters(self,axis=0):
+        edges = self.binEdges[axis]
+        return 0.5*(edges[1:]+edges[:-1])
+
+    def getFlatBinEdges(self):
+        """
+        Returns the edges of the compact index bins, 0..nBins, used as the
+        1D bin edges by the unfolding core
+        """
+        return numpy.arange(self.nBins+1,dtype=numpy.float64)
+
+    def getBinVolumes(self):
+        """
+        Returns the product of the bin widths of each kept bin, in compact index order
+        """
+        volumes = numpy.ones(1)
+        for edges in self.binEdges:
+            volumes = numpy.multiply.outer(volumes,numpy.diff(edges)).ravel()
+        return volumes[self.fullIndices]
+
+    def getCurvatureMatrix(self):
+        """
+        Returns the second-derivative matrix along each axis acting on the
+        bin contents divided by the bin volumes, like TUnfoldBinning's
+        regularization along each axis, with one row per three consecutive
+        kept bins along an axis. For one unmasked axis this is
+        utilities.curvatureMatrix.
+        """
+        full = numpy.arange(self.nFullBins).reshape(self.shape)
+        triples = []
+        for axis, nAxisBins in enumerate(self.shape):
+            if nAxisBins < 3:
+                continue
+            triple = [self.compactIndices[numpy.take(full,numpy.arange(offset,nAxisBins-2+offset),axis=axis).ravel()]
+                        for offset in range(3)]
+            kept = (triple[0] >= 0) & (triple[1] >= 0) & (triple[2] >= 0)
+            triples.append([indices[kept] for indices in triple])
+        nRows = sum(len(triple[0]) for triple in triples)
+        result = numpy.zeros((nRows,self.nBins))
+        iRow = 0
+        for left, middle, right in triples:
+            iRows = numpy.arange(iRow,iRow+len(left))
+            result[iRows,left] = 1.
+            result[iRows,middle] = -2.
+            result[iRows,right] = 1.
+            iRow += len(left)
+        return result/self.getBinVolumes()
+
+    def getBinIndices(self,values):
+        """
+        Returns the compact bin index of each point, or -1 if it is outside
+        the binning, in a masked bin, or NaN on any axis
+        Inputs:
+            values: numpy array (nPoints,nAxes), or list of nAxes arrays of nPoints values
+        Outputs:
+            numpy int64 array of nPoints compact indices
+        """
+        if isinstance(values,(list,tuple)):
+            columns = [numpy.asarray(column) for column in values]
+        else:
+            values = numpy.asarray(values)
+            if values.ndim == 1 and self.nAxes == 1:
+                values = values[:,numpy.newaxis]
+            if values.ndim != 2 or values.shape[1] != self.nAxes:
+                raise ValueError("values must have shape (nPoints,{})".format(self.nAxes),values.shape)
+            columns = [values[:,axis] for axis in range(self.nAxes)]
+        if len(columns) != self.nAxes:
+            raise ValueError("values must have one column per axis, {}".format(self.nAxes))
+        axisIndices = [binIndices(column,edges) for column, edges in zip(columns,self.binEdges)]
+        outside = numpy.zeros(axisIndices[0].shape,dtype=bool)
+        for indices in axisIndices:
+            outside |= indices < 0
+        flat = numpy.ravel_multi_index([numpy.where(outside,0,indices) for indices in axisIndices],self.shape)
+        return numpy.where(outside,-1,self.compactIndices[flat])
+
+    def flatten(self,a,axis=0):
+        """
+        Returns a with the N-D bin axes starting at axis replaced by one
+        compact bin axis
+        Inputs:
+            a: numpy array with shape[axis:axis+nAxes] equal to self.shape
+            axis: int first bin axis
+        Outputs:
+            numpy array with those axes replaced by one of length nBins
+        """
+        a = numpy.asarray(a,dtype=numpy.float64)
+        if a.shape[axis:axis+self.nAxes] != self.shape:
+            raise ValueError("Axes {} to {} must have shape {}".format(axis,axis+self.nAxes-1,self.shape),a.shape)
+        full = a.reshape(a.shape[:axis]+(self.nFullBins,)+a.shape[axis+self.nAxes:])
+        return numpy.take(full,self.fullIndices,axis=axis)
+
+    def unflatten(self,a,axis=0,fill=0.):
+        """
+        Inverse of flatten: returns a with the compact bin axis replaced by
+        the N-D bin axes, with fill in the masked bins
+        """
+        a = numpy.asarray(a,dtype=numpy.float64)
+        if a.shape[axis] != self.nBins:
+            raise ValueError("Axis {} must have length {}".format(axis,self.nBins),a.shape)
+        full = numpy.full(a.shape[:axis]+(self.nFullBins,)+a.shape[axis+1:],fill)
+        index = [slice(None)]*a.ndim
+        index[axis] = self.fullIndices
+        full[tuple(index)] = a
+        return full.reshape(a.shape[:axis]+self.shape+a.shape[axis+1:])
+
+    def unflattenCovariance(self,covariance,fill=0.):
+        """
+        Returns a (nBins,nBins) covariance as an array of shape self.shape+self.shape
+        """
+        return self.unflatten(self.unflatten(covariance,1,fill),0,fill)
+
+def flattenMigration(migration,recoBinning,trueBinning):
+    """
+    Returns the (nReco,nTrue) migration matrix of compact bin indices of an
+    N-D response of shape recoBinning.shape+trueBinning.shape. Either binning
+    may be None for a plain 1D axis. Other shapes are returned unchanged.
+    """
+    migration = numpy.asarray(migration,dtype=numpy.float64)
+    recoShape = (migration.shape[0],) if recoBinning is None else recoBinning.shape
+    trueShape = (migration.shape[-1],) if trueBinning is None else trueBinning.shape
+    if migration.shape != recoShape+trueShape:
+        return migration
+    if not (recoBinning is None):
+        migration = recoBinning.flatten(migration,0)
+    if not (trueBinning is None):
+        migration = trueBinning.flatten(migration,1)
+    return migration
+
+def _scipySparse():
+    try:
+        import scipy.sparse
+    except ImportError:
+        raise ImportError("scipy is needed for sparse migration matrices")
+    return scipy.sparse
+
+class MultiResponseBuilder(ResponseBuilder):
+    """
+    ResponseBuilder for multidimensional binnings. The migration matrix is
+    accumulated as its non-zero (reco,true) entries, so its memory scales
+    with the number of populated bins, not nReco*nTrue.
+    """
+
+    def __init__(self,recoBinning,trueBinning,keepEvents=False):
+        """
+        Inputs:
+            recoBinning: Binning of the reconstructed values
+            trueBinning: Binning of the true values
+            keepEvents: if True, also keep each event's compact bin indices,
+                see histbuilder.EventIndices
+        """
+        if not (isinstance(recoBinning,Binning) and isinstance(trueBinning,Binning)):
+            raise TypeError("recoBinning and trueBinning must be Binnings")
+        self.recoBinning = recoBinning
+        self.trueBinning = trueBinning
+        self.recoBinEdges = recoBinning.getFlatBinEdges()
+        self.trueBinEdges = trueBinning.getFlatBinEdges()
+        self.nReco = recoBinning.nBins
+        self.nTrue = trueBinning.nBins
+        self.nEvents = 0
+        # Sorted flat indices reco*nTrue+true of the non-zero entries, and their sums
+        self.migrationKeys = numpy.zeros(0,dtype=numpy.int64)
+        self.migrationValues = numpy.zeros(0)
+        self.trueCounts = numpy.zeros(self.nTrue)
+        self.recoCounts = numpy.zeros(self.nReco)
+        self.events = EventIndices(self.nReco,self.nTrue) if keepEvents else None
+
+    def fill(self,true,reco,weights=None):
+        """
+        Adds a chunk of events
+        Inputs:
+            true: numpy array (nEvents,nTrueAxes), or list of one array per true axis
+            reco: numpy array (nEvents,nRecoAxes), or list of one array per reco axis,
+                NaN if not reconstructed
+            weights: optional numpy array of event weights
+        """
+        trueIndices = self.trueBinning.getBinIndices(true)
+        recoIndices = self.recoBinning.getBinIndices(reco)
+        if trueIndices.shape != recoIndices.shape:
+            raise ValueError("true and reco must have the same number of events")
+        if not (weights is None):
+            weights = numpy.asarray(weights,dtype=numpy.float64)
+            if weights.shape != trueIndices.shape:
+                raise ValueError("weights must have one entry per event")
+        self._fillIndices(trueIndices,recoIndices,weights)
+
+    def _fillIndices(self,trueIndices,recoIndices,weights):
+        inTrue = trueIndices >= 0
+        inBoth = inTrue & (recoIndices >= 0)
+        selectedWeights = None if weights is None else weights[inTrue]
+        self.trueCounts += numpy.bincount(trueIndices[inTrue],weights=selectedWeights,minlength=self.nTrue)
+        selectedWeights = numpy.ones(inBoth.sum()) if weights is None else weights[inBoth]
+        self.recoCounts += numpy.bincount(recoIndices[inBoth],weights=selectedWeights,minlength=self.nReco)
+        keys = recoIndices[inBoth]*self.nTrue+trueIndices[inBoth]
+        keys = numpy.concatenate([self.migrationKeys,keys])
+        values = numpy.concatenate([self.migrationValues,selectedWeights])
+        self.migrationKeys, inverse = numpy.unique(keys,return_inverse=True)
+        self.migrationValues = numpy.bincount(inverse.ravel(),weights=values,minlength=len(self.migrationKeys))
+        self.nEvents += len(trueIndices)
+        self._keepEvents(trueIndices,recoIndices,weights,inTrue)
+
+    def getMigrationMatrix(self,sparse=False):
+        """
+        Returns the (nReco,nTrue) migration matrix of compact bin indices
+        Inputs:
+            sparse: if True, return a scipy.sparse CSR matrix instead of a numpy array
+        """
+        rows, columns = numpy.divmod(self.migrationKeys,self.nTrue)
+        if sparse:
+            return _scipySparse().csr_matrix((self.migrationValues,(rows,columns)),shape=(self.nReco,self.nTrue))
+        result = numpy.zeros((self.nReco,self.nTrue))
+        result[rows,columns] = self.migrationValues
+        return result
+
+    def getEfficiency(self):
+        reconstructed = numpy.bincount(self.migrationKeys % self.nTrue,weights=self.migrationValues,minlength=self.nTrue)
+        return reconstructed/numpy.where(self.trueCounts != 0.,self.trueCounts,1.)
+
+    def getResponseMatrix(self,sparse=False):
+        migration = self.getMigrationMatrix(sparse)
+        scale = 1./numpy.where(self.trueCounts != 0.,self.trueCounts,1.)
+        if sparse:
+            return migration.multiply(scale[numpy.newaxis,:]).tocsr()
+        return migration*scale
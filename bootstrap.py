@@ -0,0 +1,181 @@
+"""
+Poisson bootstrap of the migration matrix for its MC statistical uncertainty
+
+A ResponseBuilder made with keepEvents=True keeps the true and reco bin
+index of every simulated event. Each bootstrap replica reweights every
+event by an independent Poisson(1) count and refills the migration matrix
+and spectra with weighted bincounts, a batch of replicas and a chunk of
+events at a time, so memory doesn't depend on the number of replicas. The
+data are unfolded with each replica's migration matrix, and the spread of
+the results is the MC statistical covariance.
+
+Replica i always uses the random stream spawned from the seed with index
+i, so results only depend on the seed, not on the batch size, chunk size,
+or how the replicas are split across an executor.
+"""
+
+import math
+import numpy
+import profiling
+from unfold_base import Unfolding
+from toys import RunningCovariance
+
+# Cumulative Poisson(1) probabilities, reaching 1 in double precision
+_poissonOneCDF = numpy.cumsum([math.exp(-1.)/math.factorial(k) for k in range(30)])
+
+def _poissonOne(u):
+    """
+    Returns Poisson(1) counts from uniform random numbers u by inverting the
+    CDF, several times faster than Generator.poisson. Each step only
+    compares the values that passed the previous threshold, about 1/k! of them.
+    """
+    counts = (u >= _poissonOneCDF[0]).astype(numpy.float64)
+    indices = numpy.flatnonzero(u >= _poissonOneCDF[1])
+    remaining = u[indices]
+    k = 1
+    while len(indices) > 0:
+        counts[indices] += 1.
+        k += 1
+        passed = remaining >= _poissonOneCDF[k]
+        indices = indices[passed]
+        remaining = remaining[passed]
+    return counts
+
+class BootstrapResponse(object):
+    """
+    Generates Poisson bootstrap replicas of a response from the event bin
+    indices kept by a histbuilder.ResponseBuilder or binning.MultiResponseBuilder
+    """
+
+    def __init__(self,builder,chunkSize=262144):
+        """
+        Inputs:
+            builder: histbuilder.ResponseBuilder or binning.MultiResponseBuilder
+                made with keepEvents=True
+            chunkSize: int number of events reweighted at a time per replica
+        """
+        if getattr(builder,"events",None) is None:
+            raise ValueError("builder must be made with keepEvents=True to bootstrap it")
+        self.nReco = builder.nReco
+        self.nTrue = builder.nTrue
+        self.trueIndices, self.recoIndices, self.weights = builder.events.getArrays()
+        self.chunkSize = chunkSize
+
+    @staticmethod
+    def _seedSequence(seed):
+        if isinstance(seed,numpy.random.SeedSequence):
+            return seed
+        return numpy.random.SeedSequence(seed)
+
+    @staticmethod
+    def _replicaRng(seedSequence,iReplica):
+        # The same stream as seedSequence.spawn(n)[iReplica], for any n
+        return numpy.random.default_rng(numpy.random.SeedSequence(seedSequence.entropy,
+                                            spawn_key=seedSequence.spawn_key+(iReplica,)))
+
+    @profiling.profiled()
+    def getReplicas(self,firstReplica,nReplicas,seed=None):
+        """
+        Returns a batch of bootstrap replicas
+        Inputs:
+            firstReplica: int index of the first replica
+            nReplicas: int number of replicas
+            seed: seed for numpy.random.SeedSequence, or a SeedSequence; the
+                same seed must be used for every batch of one bootstrap
+        Outputs:
+            tuple of numpy arrays (nReplicas,nReco,nTrue) migration matrices,
+            (nReplicas,nTrue) true spectra, and (nReplicas,nReco) reco spectra
+        """
+        seedSequence = self._seedSequence(seed)
+        rngs = [self._replicaRng(seedSequence,i) for i in range(firstReplica,firstReplica+nReplicas)]
+        nReco, nTrue = self.nReco, self.nTrue
+        migrations = numpy.zeros(nReplicas*nReco*nTrue)
+        trueCounts = numpy.zeros(nReplicas*nTrue)
+        recoCounts = numpy.zeros(nReplicas*nReco)
+        offsets = numpy.arange(nReplicas)[:,numpy.newaxis]
+        for start in range(0,len(self.trueIndices),self.chunkSize):
+            trueIndices = self.trueIndices[start:start+self.chunkSize].astype(numpy.int64)
+            recoIndices = self.recoIndices[start:start+self.chunkSize].astype(numpy.int64)
+            weights = numpy.array([_poissonOne(rng.random(len(trueIndices))) for rng in rngs])
+            if not (self.weights is None):
+                weights *= self.weights[start:start+self.chunkSize]
+            trueCounts += numpy.bincount((offsets*nTrue+trueIndices).ravel(),weights=weights.ravel(),
+                                            minlength=nReplicas*nTrue)
+            reconstructed = recoIndices >= 0
+            trueIndices = trueIndices[reconstructed]
+            recoIndices = recoIndices[reconstructed]
+            weights = weights[:,reconstructed].ravel()
+            migrations += numpy.bincount((offsets*(nReco*nTrue)+recoIndices*nTrue+trueIndices).ravel(),
+                                            weights=weights,minlength=nReplicas*nReco*nTrue)
+            recoCounts += numpy.bincount((offsets*nReco+recoIndices).ravel(),weights=weights,
+                                            minlength=nReplicas*nReco)
+        return (migrations.reshape(nReplicas,nReco,nTrue),trueCounts.reshape(nReplicas,nTrue),
+                recoCounts.reshape(nReplicas,nReco))
+
+    def iterateReplicas(self,nReplicas,seed=None,batchSize=16,firstReplica=0):
+        """
+        Yields the replicas in batches of at most batchSize, see getReplicas
+        Inputs:
+            nReplicas: int total number of replicas
+            seed: seed for numpy.random.SeedSequence, or a SeedSequence
+            batchSize: int maximum number of replicas held in memory at once
+            firstReplica: int index of the first replica
+        """
+        seedSequence = self._seedSequence(seed)
+        for start in range(firstReplica,firstReplica+nReplicas,batchSize):
+            yield self.getReplicas(start,min(batchSize,firstReplica+nReplicas-start),seedSequence)
+
+    @profiling.profiled()
+    def getCovariance(self,unfolding,nReplicas,parameter=None,seed=None,correctEfficiency=False,
+                        batchSize=16,accumulator=None,executor=None,nTasks=None,firstReplica=0):
+        """
+        Unfolds the unfolding's reconstructed spectrum with each replica's
+        migration matrix and accumulates the covariance of the results
+        Inputs:
+            unfolding: Unfolding with this response's binning
+            nReplicas: int number of replicas
+            parameter: the regularization, n-iterations, etc. input parameter
+            seed: seed for numpy.random.SeedSequence, or a SeedSequence
+            correctEfficiency: if True, divide each result by its replica's
+                efficiency, so the covariance includes the efficiency's MC statistics
+            batchSize: int maximum number of replicas held in memory at once per task
+            accumulator: optional toys.RunningCovariance to add to
+            executor: optional executors.SerialExecutor, ThreadExecutor, or
+                ProcessExecutor to split the replicas across
+            nTasks: int number of executor tasks, default the number of workers
+            firstReplica: int index of the first replica
+        Outputs:
+            toys.RunningCovariance of the unfolded results
+        """
+        if not isinstance(unfolding,Unfolding):
+            raise TypeError("unfolding doesn't inherit from Unfolding",type(unfolding))
+        if unfolding.migration.shape != (self.nReco,self.nTrue):
+            raise ValueError("unfolding migration matrix must have shape {}".format((self.nReco,self.nTrue)),
+                                unfolding.migration.shape)
+        if accumulator is None:
+            accumulator = RunningCovariance(self.nTrue)
+        seedSequence = self._seedSequence(seed)
+        if executor is None:
+            for migrations, trueCounts, recoCounts in self.iterateReplicas(nReplicas,seedSequence,batchSize,firstReplica):
+                y = numpy.tile(unfolding.reconstructed,(len(migrations),1))
+                x = unfolding.unfoldArrays(y,parameter,migrations)
+                if correctEfficiency:
+                    efficiency = migrations.sum(axis=1)/numpy.where(trueCounts != 0.,trueCounts,1.)
+                    x = x/numpy.where(efficiency != 0.,efficiency,1.)*(efficiency != 0.)
+                accumulator.update(x)
+            return accumulator
+        if nTasks is None:
+            nTasks = executor.nWorkers
+        nTasks = max(1,min(nTasks,nReplicas))
+        bounds = numpy.linspace(firstReplica,firstReplica+nReplicas,nTasks+1).astype(int)
+        tasks = [(int(bounds[i]),int(bounds[i+1]-bounds[i]),parameter,seedSequence,correctEfficiency,batchSize)
+                    for i in range(nTasks)]
+        for taskAccumulator in executor.run(_covarianceTask,tasks,(self,unfolding)):
+            accumulator.merge(taskAccumulator)
+        return accumulator
+
+def _covarianceTask(context,task):
+    bootstrapResponse, unfolding = context
+    firstReplica, nReplicas, parameter, seedSequence, correctEfficiency, batchSize = task
+    return bootstrapResponse.getCovariance(unfolding,nReplicas,parameter,seedSequence,correctEfficiency,
+                                            batchSize,firstReplica=firstReplica)
@@ -0,0 +1,222 @@
+"""
+Cache of response matrix factorizations, keyed by a hash of their inputs
+
+Unfoldings store the factorizations that don't depend on the data or the
+regularization parameter (inverse, SVD, normal equations, etc.) through
+Unfolding.getCachedDecomposition. They are kept in a size-bounded LRU in
+memory, and optionally in a directory of .npz files, so new unfolding
+objects with the same migration matrix and binning, and repeated jobs,
+skip the setup.
+"""
+
+import os
+import hashlib
+import tempfile
+import threading
+import collections
+import numpy
+
+def contentKey(*items):
+    """
+    Returns a hex digest of the contents of items, which may be numpy
+    arrays (hashed with their dtype and shape), scipy.sparse matrices
+    (hashed as CSR), strings, or numbers
+    """
+    digest = hashlib.sha1()
+    for item in items:
+        if hasattr(item,"tocsr"):
+            csr = item.tocsr(copy=True)
+            csr.sum_duplicates()
+            digest.update("sparse{}{}".format(csr.dtype.str,csr.shape).encode())
+            for array in (csr.data,csr.indices,csr.indptr):
+                digest.update(numpy.ascontiguousarray(array).tobytes())
+        elif isinstance(item,numpy.ndarray):
+            digest.update("array{}{}".format(item.dtype.str,item.shape).encode())
+            digest.update(numpy.ascontiguousarray(item).tobytes())
+        else:
+            digest.update("{}{!r}".format(type(item).__name__,item).encode())
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+class DecompositionCache(object):
+    """
+    Least-recently-used cache of decompositions, each a tuple of objects,
+    usually numpy arrays
+
+    Arrays are stored read-only, as they are shared between every unfolding
+    with the same inputs. Decompositions made only of numpy arrays are also
+    written to directory, if given, and read back when not in memory.
+
+    maxBytes counts numpy arrays and objects with an nbytes attribute, e.g.
+    sparseresponse.SparseResponse. Other objects, e.g. the TUnfoldDensity instances of tunfold,
+    have no measurable size, so they count as 0 bytes and are only limited
+    by maxEntries. Decompositions holding any non-array object aren't
+    written to directory: .npz files only hold arrays, and ROOT objects and
+    locks only make sense in the process that made them.
+    """
+
+    def __init__(self,maxBytes=256*1024**2,maxEntries=128,directory=None):
+        """
+        Inputs:
+            maxBytes: int maximum total size of the arrays held in memory
+            maxEntries: int maximum number of decompositions held in memory
+            directory: optional directory for the on-disk tier, created if needed
+        """
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        self.directory = directory
+        if not (directory is None) and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.entries = collections.OrderedDict()
+        self.nBytes = 0
+        self.hits = 0
+        self.diskHits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        # Per-key locks, so concurrent threads compute each decomposition once
+        self._keyLocks = {}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self,key):
+        return key in self.entries or (os.path.exists(self._filename(key)) if self.directory else False)
+
+    @staticmethod
+    def _sizeOf(value):
+        """
+        Returns the bytes of a decomposition's arrays and sized objects;
+        objects without an nbytes attribute count as 0, see the class docstring
+        """
+        return sum(int(getattr(item,"nbytes",0)) for item in value)
+
+    @staticmethod
+    def _isStorable(value):
+        """
+        Returns True if a decomposition can be written to the on-disk tier,
+        i.e. is made only of numpy arrays
+        """
+        return all(isinstance(item,numpy.ndarray) for item in value)
+
+    def _filename(self,key):
+        return os.path.join(self.directory,key+".npz")
+
+    def get(self,key):
+        """
+        Returns the decomposition stored under key, or None
+        """
+        with self._lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            value = self._load(key)
+            if value is None:
+                self.misses += 1
+                return None
+            self.diskHits += 1
+            self._store(key,value)
+            return value
+
+    def put(self,key,value):
+        """
+        Stores a decomposition under key
+        Inputs:
+            key: str, e.g. from contentKey
+            value: tuple of numpy arrays or other objects
+        Outputs:
+            the stored tuple, with read-only arrays
+        """
+        value = tuple(self._readOnly(item) for item in value)
+        with self._lock:
+            self._store(key,value)
+            self._save(key,value)
+        return value
+
+    def getOrCompute(self,key,compute):
+        """
+        Returns the decomposition stored under key, or computes it with
+        compute(), a function returning a tuple, and stores it
+        """
+        with self._lock:
+            keyLock = self._keyLocks.setdefault(key,threading.Lock())
+        try:
+            with keyLock:
+                value = self.get(key)
+                if value is None:
+                    value = self.put(key,compute())
+        finally:
+            with self._lock:
+                self._keyLocks.pop(key,None)
+        return value
+
+    def clear(self):
+        """
+        Empties the in-memory tier; files in directory are left alone
+        """
+        with self._lock:
+            self.entries.clear()
+            self.nBytes = 0
+
+    @staticmethod
+    def _readOnly(item):
+        if isinstance(item,numpy.ndarray):
+            item = numpy.array(item)
+            item.flags.writeable = False
+        return item
+
+    def _store(self,key,value):
+        nBytes = self._sizeOf(value)
+        if nBytes > self.maxBytes or self.maxEntries < 1:
+            return
+        if key in self.entries:
+            self.nBytes -= self._sizeOf(self.entries.pop(key))
+        self.entries[key] = value
+        self.nBytes += nBytes
+        while self.nBytes > self.maxBytes or len(self.entries) > self.maxEntries:
+            oldKey, oldValue = self.entries.popitem(last=False)
+            self.nBytes -= self._sizeOf(oldValue)
+
+    def _save(self,key,value):
+        if self.directory is None or not self._isStorable(value):
+            return
+        if os.path.exists(self._filename(key)):
+            return
+        # Written to a temporary file and renamed, so concurrent jobs never read a partial file
+        fd, tmpFilename = tempfile.mkstemp(suffix=".npz",dir=self.directory)
+        try:
+            with os.fdopen(fd,"wb") as tmpFile:
+                numpy.savez(tmpFile,*value)
+            os.replace(tmpFilename,self._filename(key))
+        except Exception:
+            if os.path.exists(tmpFilename):
+                os.remove(tmpFilename)
+            raise
+
+    def _load(self,key):
+        if self.directory is None or not os.path.exists(self._filename(key)):
+            return None
+        try:
+            with numpy.load(self._filename(key)) as npz:
+                value = tuple(npz["arr_{}".format(i)] for i in range(len(npz.files)))
+        except (IOError,ValueError):
+            return None
+        for item in value:
+            item.flags.writeable = False
+        return value
+
+_defaultCache = DecompositionCache()
+
+def getDefaultCache():
+    """
+    Returns the DecompositionCache used by unfoldings not given their own
+    """
+    return _defaultCache
+
+def setDefaultCache(decompositionCache):
+    """
+    Replaces the DecompositionCache used by unfoldings not given their own,
+    e.g. with one that has an on-disk tier
+    """
+    global _defaultCache
+    _defaultCache = decompositionCache
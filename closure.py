@@ -0,0 +1,236 @@
+"""
+Closure and bias tests of an unfolding technique with pseudo-experiments
+
+Pseudo-datasets are Poisson fluctuations of a known true spectrum folded
+with a response, thrown in batches as stacked numpy arrays and unfolded
+together with Unfolding.unfoldBatch for each regularization parameter, or
+one at a time for the techniques weighted by the reconstructed variance. The
+bias, spread, pulls, and coverage of each true bin are accumulated batch by
+batch, so thousands of pseudo-datasets take seconds for typical binnings
+and can be checked before every production unfold:
+
+    closureResult = ClosureTest(unfolding).run([2,4,8],nPseudo=2000,seed=1)
+    print(closureResult.formatSummary())
+    if not closureResult.passes():
+        raise Exception("Unfolding doesn't close",closureResult.getFailures())
+"""
+
+import numpy
+import cache
+import profiling
+from unfold_base import Unfolding
+
+class ClosureTest(object):
+    """
+    Throws pseudo-datasets from a true spectrum and unfolds them with an
+    unfolding's technique and migration matrix
+    """
+
+    def __init__(self,unfolding,truth=None,response=None):
+        """
+        Inputs:
+            unfolding: Unfolding to test, its technique and migration matrix
+            truth: optional numpy array (nTrue,) true spectrum of reconstructed
+                events, the quantity the unfolding estimates; default the
+                migration matrix's true projection scaled to the reconstructed
+                spectrum's total
+            response: optional numpy array (nReco,nTrue) response to fold the
+                truth with, e.g. from a different model for a stress test;
+                default unfolding.getResponseMatrix(), for closure
+        """
+        if not isinstance(unfolding,Unfolding):
+            raise TypeError("unfolding doesn't inherit from Unfolding",type(unfolding))
+        nReco, nTrue = unfolding.migration.shape
+        if truth is None:
+            truth = unfolding.getTrueProjection()
+            truth = truth*(unfolding.reconstructed.sum()/truth.sum())
+        if response is None:
+            response = unfolding.getResponseMatrix()
+        truth = numpy.array(truth,dtype=numpy.float64)
+        response = numpy.array(response,dtype=numpy.float64)
+        if truth.shape != (nTrue,):
+            raise ValueError("truth must have shape {}".format((nTrue,)),truth.shape)
+        if response.shape != (nReco,nTrue):
+            raise ValueError("response must have shape {}".format((nReco,nTrue)),response.shape)
+        self.unfolding = unfolding
+        self.truth = truth
+        self.response = response
+        self.expected = response.dot(truth)
+
+    def throwPseudoData(self,nPseudo,rng):
+        """
+        Returns nPseudo Poisson fluctuations of the folded truth
+        Inputs:
+            nPseudo: int number of pseudo-datasets
+            rng: numpy.random.Generator
+        Outputs:
+            numpy array (nPseudo,nReco)
+        """
+        return rng.poisson(numpy.clip(self.expected,0.,None),size=(nPseudo,len(self.expected))).astype(numpy.float64)
+
+    def unfoldPseudoData(self,pseudoData,parameters):
+        """
+        Unfolds pseudo-datasets, each with its own counts as its variance,
+        as real data are. Techniques whose unfolding matrix is weighted by
+        the reconstructed variance (SVD, Tikhonov) are refactorized for each
+        pseudo-dataset, and scanned over the parameters from that one
+        factorization; the others unfold the whole batch with unfoldBatch.
+        Inputs:
+            pseudoData: numpy array (nPseudo,nReco)
+            parameters: list of regularization, n-iterations, etc. input parameters
+        Outputs:
+            results: numpy array (nParameters,nPseudo,nTrue)
+            errors: numpy array (nParameters,nPseudo,nTrue)
+        """
+        if not self.unfolding.dependsOnReconstructedVariance:
+            batchResults = [self.unfolding.unfoldBatch(pseudoData,parameter,pseudoData) for parameter in parameters]
+            return (numpy.array([batchResult.results for batchResult in batchResults]),
+                    numpy.array([batchResult.getErrorArrays() for batchResult in batchResults]))
+        # A cache that keeps nothing, so single-use factorizations don't
+        # evict the real ones from the shared cache
+        throwawayCache = cache.DecompositionCache(maxEntries=0)
+        results = []
+        errors = []
+        for y in pseudoData:
+            unfolding = self.unfolding.withReconstructed(y,y,throwawayCache)
+            scanResult = unfolding.scan(parameters)
+            results.append(scanResult.results)
+            errors.append(numpy.sqrt(numpy.abs(numpy.diagonal(scanResult.covariances,axis1=1,axis2=2))))
+        return numpy.swapaxes(numpy.array(results),0,1), numpy.swapaxes(numpy.array(errors),0,1)
+
+    @profiling.profiled()
+    def run(self,parameters=[None],nPseudo=1000,seed=None,batchSize=1000):
+        """
+        Unfolds nPseudo pseudo-datasets for each parameter. Each batch of
+        pseudo-datasets is shared by all parameters, and each pseudo-dataset
+        is unfolded with its own counts as its variance, as real data are,
+        see unfoldPseudoData.
+        Inputs:
+            parameters: list of regularization, n-iterations, etc. input parameters
+            nPseudo: int number of pseudo-datasets
+            seed: seed for numpy.random.default_rng
+            batchSize: int maximum number of pseudo-datasets held in memory at once
+        Outputs:
+            ClosureResult
+        """
+        parameters = list(parameters)
+        rng = numpy.random.default_rng(seed)
+        nTrue = len(self.truth)
+        # Per parameter and true bin: sums of the result, its square, the
+        # pull, its square, the number of defined pulls, and of covering errors
+        sums = numpy.zeros((6,len(parameters),nTrue))
+        nThrown = 0
+        while nThrown < nPseudo:
+            nBatch = min(batchSize,nPseudo-nThrown)
+            pseudoData = self.throwPseudoData(nBatch,rng)
+            batchResults, batchErrors = self.unfoldPseudoData(pseudoData,parameters)
+            for iParameter, (results, errors) in enumerate(zip(batchResults,batchErrors)):
+                defined = errors > 0.
+                pulls = numpy.where(defined,(results-self.truth)/numpy.where(defined,errors,1.),0.)
+                sums[:,iParameter] += [results.sum(axis=0),(results**2).sum(axis=0),pulls.sum(axis=0),
+                                        (pulls**2).sum(axis=0),defined.sum(axis=0),
+                                        (defined & (numpy.abs(pulls) <= 1.)).sum(axis=0)]
+            nThrown += nBatch
+        return ClosureResult(parameters,self.truth,nPseudo,sums)
+
+class ClosureResult(object):
+    """
+    Holds the per-bin bias, pull, and coverage of a ClosureTest, as numpy
+    arrays (nParameters,nTrue) in the order of the parameters
+    """
+
+    def __init__(self,parameters,truth,nPseudo,sums):
+        """
+        Inputs:
+            parameters: list of the regularization, n-iterations, etc. input parameters
+            truth: numpy array (nTrue,) true spectrum
+            nPseudo: int number of pseudo-datasets
+            sums: numpy array (6,nParameters,nTrue) of the sums accumulated by ClosureTest.run
+        """
+        resultSums, resultSquareSums, pullSums, pullSquareSums, nDefined, nCovered = sums
+        nDefined = numpy.where(nDefined > 0,nDefined,numpy.nan)
+        self.parameters = parameters
+        self.truth = truth
+        self.nPseudo = nPseudo
+        self.mean = resultSums/nPseudo
+        self.bias = self.mean-truth
+        self.relativeBias = self.bias/numpy.where(truth != 0.,truth,numpy.nan)
+        self.spread = numpy.sqrt(numpy.clip(resultSquareSums/nPseudo-self.mean**2,0.,None)*nPseudo/max(nPseudo-1,1))
+        self.pullMean = pullSums/nDefined
+        self.pullWidth = numpy.sqrt(numpy.clip(pullSquareSums/nDefined-self.pullMean**2,0.,None))
+        # Fraction of pseudo-datasets whose 1 sigma interval contains the truth, 0.683 ideally
+        self.coverage = nCovered/nDefined
+
+    def _index(self,parameter):
+        for i, other in enumerate(self.parameters):
+            if other == parameter:
+                return i
+        raise KeyError("Parameter wasn't tested",parameter)
+
+    def getBias(self,parameter):
+        return self.bias[self._index(parameter)].copy()
+    def getRelativeBias(self,parameter):
+        return self.relativeBias[self._index(parameter)].copy()
+    def getPullMean(self,parameter):
+        return self.pullMean[self._index(parameter)].copy()
+    def getPullWidth(self,parameter):
+        return self.pullWidth[self._index(parameter)].copy()
+    def getCoverage(self,parameter):
+        return self.coverage[self._index(parameter)].copy()
+
+    def getFailures(self,maxPullMean=0.3,pullWidthRange=(0.8,1.2),minCoverage=0.6,maxRelativeBias=None):
+        """
+        Returns the failed checks, as a list of (parameter, true bin index,
+        description). Bins with no defined pulls, e.g. empty ones, are skipped.
+        Inputs:
+            maxPullMean: largest allowed |pull mean|
+            pullWidthRange: (low,high) allowed pull width
+            minCoverage: smallest allowed 1 sigma coverage
+            maxRelativeBias: optional largest allowed |bias|/truth
+        """
+        checks = [(numpy.abs(self.pullMean) > maxPullMean,"pull mean {:.3f}",self.pullMean),
+                    (self.pullWidth < pullWidthRange[0],"pull width {:.3f}",self.pullWidth),
+                    (self.pullWidth > pullWidthRange[1],"pull width {:.3f}",self.pullWidth),
+                    (self.coverage < minCoverage,"coverage {:.3f}",self.coverage)]
+        if not (maxRelativeBias is None):
+            checks.append((numpy.abs(self.relativeBias) > maxRelativeBias,"relative bias {:.3f}",self.relativeBias))
+        result = []
+        for failed, description, values in checks:
+            for iParameter, iBin in zip(*numpy.nonzero(failed)):
+                result.append((self.parameters[iParameter],int(iBin),description.format(values[iParameter,iBin])))
+        return result
+
+    def passes(self,**kargs):
+        """
+        Returns True if no check fails, see getFailures for the keyword arguments
+        """
+        return len(self.getFailures(**kargs)) == 0
+
+    def formatSummary(self):
+        """
+        Returns a text table of the mean over true bins of each quantity, one
+        parameter per line
+        """
+        lines = ["{:>12} {:>12} {:>12} {:>12} {:>12}".format("Parameter","|Rel. bias|","Pull mean","Pull width","Coverage")]
+        for i, parameter in enumerate(self.parameters):
+            lines.append("{:>12} {:>12.4f} {:>12.3f} {:>12.3f} {:>12.3f}".format(
+                            str(parameter),numpy.nanmean(numpy.abs(self.relativeBias[i])),numpy.nanmean(self.pullMean[i]),
+                            numpy.nanmean(self.pullWidth[i]),numpy.nanmean(self.coverage[i])))
+        return "\n".join(lines)
+
+if __name__ == "__main__":
+
+    from utilities import CreateFakeDataArrays
+    from matrixinverse import UnfoldingMatrixInverse
+    from iterativebayes import UnfoldingIterativeBayes
+    from svdunfold import UnfoldingSVD
+    from tikhonov import UnfoldingTikhonov
+
+    dataBuilder, mcBuilder = CreateFakeDataArrays(20000,300000,10,10,0.1,0.1,rng=numpy.random.default_rng(1))
+    for unfoldingClass, parameters in [(UnfoldingMatrixInverse,[None]),(UnfoldingIterativeBayes,[1,2,4,8]),
+                                        (UnfoldingSVD,[3,5,8]),(UnfoldingTikhonov,[1e-4,1e-3,1e-2])]:
+        unfolding = unfoldingClass(dataBuilder.getRecoHist(),mcBuilder.getMigrationMatrix(),
+                                    recoBinEdges=mcBuilder.recoBinEdges,trueBinEdges=mcBuilder.trueBinEdges)
+        closureResult = ClosureTest(unfolding).run(parameters,nPseudo=2000,seed=2)
+        print(unfoldingClass.__name__)
+        print(closureResult.formatSummary())
@@ -0,0 +1,321 @@
+"""
+Executors to run unfoldings, scans, and toys in parallel
+
+Every executor has the same interface, run(function,tasks,context), which
+calls function(context,task) for each task and returns the results in
+task order, so reductions are deterministic whichever worker ran a task.
+
+ProcessExecutor puts the numpy arrays of the context (e.g. the migration
+matrix of an Unfolding) in shared memory once per run, instead of pickling
+them with every task. Each worker copies them out once per run and detaches,
+and the parent frees the shared memory when the run ends, even if a task
+raised. ROOT objects aren't sent to the worker processes, so
+use the numpy unfolding techniques with it. Decompositions already computed
+are shared with the workers along with the other arrays.
+"""
+
+import os
+import uuid
+import threading
+import concurrent.futures
+import numpy
+from utilities import isTH1
+from cache import DecompositionCache
+
+class SerialExecutor(object):
+    """
+    Runs tasks one after the other in this process
+    """
+
+    nWorkers = 1
+
+    def run(self,function,tasks,context=None):
+        return [function(context,task) for task in tasks]
+
+    def shutdown(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.shutdown()
+
+class ThreadExecutor(SerialExecutor):
+    """
+    Runs tasks in a pool of threads. numpy releases the GIL in its linear
+    algebra, so this helps for large binnings without copying anything.
+    """
+
+    def __init__(self,nWorkers=None):
+        """
+        Inputs:
+            nWorkers: int number of threads, default the number of CPUs
+        """
+        self.nWorkers = nWorkers or os.cpu_count() or 1
+        self.pool = concurrent.futures.ThreadPoolExecutor(self.nWorkers)
+
+    def run(self,function,tasks,context=None):
+        futures = [self.pool.submit(function,context,task) for task in tasks]
+        return [future.result() for future in futures]
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+class ProcessExecutor(SerialExecutor):
+    """
+    Runs tasks in a pool of processes, sharing the context's arrays with
+    the workers through shared memory
+    """
+
+    def __init__(self,nWorkers=None):
+        """
+        Inputs:
+            nWorkers: int number of processes, default the number of CPUs
+        """
+        self.nWorkers = nWorkers or os.cpu_count() or 1
+        self.pool = concurrent.futures.ProcessPoolExecutor(self.nWorkers)
+
+    def run(self,function,tasks,context=None):
+        sharedContext = _SharedContext(context)
+        futures = []
+        try:
+            futures = [self.pool.submit(_runWithSharedContext,function,sharedContext.packed,task) for task in tasks]
+            return [future.result() for future in futures]
+        finally:
+            # If a task raised, the tasks not started are dropped, and the
+            # running ones are waited for, so none attaches after the unlink
+            for future in futures:
+                future.cancel()
+            concurrent.futures.wait(futures)
+            sharedContext.close()
+
+    def shutdown(self):
+        self.pool.shutdown()
+
+# Arrays smaller than this are pickled with the tasks instead of shared
+_minSharedBytes = 4096
+
+class _SharedArray(object):
+    """
+    Picklable reference to an array in shared memory
+    """
+
+    def __init__(self,name,shape,dtype):
+        self.name = name
+        self.shape = shape
+        self.dtype = dtype
+
+class _NewLock(object):
+    """
+    Picklable stand-in for a threading.Lock, unpacked as a new lock, since
+    locks can't be pickled and only guard objects within one process
+    """
+
+_lockType = type(threading.Lock())
+
+class _PackedObject(object):
+    """
+    Picklable copy of an object with its arrays replaced by _SharedArrays
+    """
+
+    def __init__(self,cls,attributes):
+        self.cls = cls
+        self.attributes = attributes
+
+class _SharedContext(object):
+    """
+    Packs a context object for the worker processes, copying its arrays into
+    shared memory, which is released by close()
+    """
+
+    def __init__(self,context):
+        from multiprocessing import shared_memory
+        self._sharedMemory = shared_memory
+        self.blocks = []
+        # Shared copy of each array by id, so arrays referenced from several
+        # places, e.g. a decomposition shared by two unfoldings, are copied once
+        self._sharedArrays = {}
+        self.key = uuid.uuid4().hex
+        try:
+            self.packed = (self.key,self._pack(context))
+        except Exception:
+            self.close()
+            raise
+
+    def _pack(self,obj):
+        if isinstance(obj,numpy.ndarray):
+            if obj.nbytes < _minSharedBytes or obj.dtype.hasobject:
+                return obj
+            if id(obj) in self._sharedArrays:
+                return self._sharedArrays[id(obj)]
+            block = self._sharedMemory.SharedMemory(create=True,size=obj.nbytes)
+            self.blocks.append(block)
+            numpy.ndarray(obj.shape,dtype=obj.dtype,buffer=block.buf)[...] = obj
+            self._sharedArrays[id(obj)] = _SharedArray(block.name,obj.shape,obj.dtype)
+            return self._sharedArrays[id(obj)]
+        if isTH1(obj) or isinstance(obj,DecompositionCache):
+            # Workers use their own default cache
+            return None
+        if isinstance(obj,_lockType):
+            return _NewLock()
+        if isinstance(obj,list):
+            return [self._pack(item) for item in obj]
+        if isinstance(obj,tuple):
+            return tuple(self._pack(item) for item in obj)
+        if isinstance(obj,dict):
+            return dict((key,self._pack(value)) for key, value in obj.items())
+        if hasattr(obj,"__dict__") and not isinstance(obj,type):
+            # A class's own __getstate__ may drop attributes that can't be
+            # pickled, e.g. the factorization of a SparseResponse
+            if getattr(type(obj),"__getstate__",None) is getattr(object,"__getstate__",None):
+                state = obj.__dict__
+            else:
+                state = obj.__getstate__()
+            return _PackedObject(type(obj),self._pack(state))
+        return obj
+
+    def close(self):
+        blocks, self.blocks = self.blocks, []
+        for block in blocks:
+            try:
+                block.close()
+            finally:
+                block.unlink()
+
+# Context most recently unpacked in this worker process, as (key, context)
+_workerContext = (None,None)
+
+def _attachArray(sharedArray):
+    """
+    Returns a copy of an array in shared memory, detaching from the block,
+    so the worker holds nothing the parent's unlink has to wait for
+    """
+    from multiprocessing import shared_memory
+    # Workers share the parent process's resource tracker, so attaching
+    # doesn't make the block's lifetime depend on the worker
+    block = shared_memory.SharedMemory(name=sharedArray.name)
+    try:
+        view = numpy.ndarray(sharedArray.shape,dtype=sharedArray.dtype,buffer=block.buf)
+        result = view.copy()
+        # The block can't be closed while a view of it exists
+        del view
+    finally:
+        block.close()
+    return result
+
+def _unpack(obj,arrays):
+    """
+    Rebuilds a packed context; arrays maps block names to the arrays already
+    copied, so arrays shared in the parent are shared in the worker too
+    """
+    if isinstance(obj,_SharedArray):
+        if not (obj.name in arrays):
+            arrays[obj.name] = _attachArray(obj)
+        return arrays[obj.name]
+    if isinstance(obj,_NewLock):
+        return threading.Lock()
+    if isinstance(obj,_PackedObject):
+        result = obj.cls.__new__(obj.cls)
+        result.__dict__.update(_unpack(obj.attributes,arrays))
+        return result
+    if isinstance(obj,list):
+        return [_unpack(item,arrays) for item in obj]
+    if isinstance(obj,tuple):
+        return tuple(_unpack(item,arrays) for item in obj)
+    if isinstance(obj,dict):
+        return dict((key,_unpack(value,arrays)) for key, value in obj.items())
+    return obj
+
+def _runWithSharedContext(function,packedContext,task):
+    global _workerContext
+    key, packed = packedContext
+    if _workerContext[0] != key:
+        _workerContext = (key,_unpack(packed,{}))
+    return function(_workerContext[1],task)
+
+def _splitEvenly(items,nChunks):
+    nChunks = max(1,min(nChunks,len(items)))
+    bounds = numpy.linspace(0,len(items),nChunks+1).astype(int)
+    return [items[bounds[i]:bounds[i+1]] for i in range(nChunks)]
+
+def _scanTask(unfolding,parameters):
+    scanResult = unfolding.scan(parameters)
+    return scanResult.results, scanResult.covariances
+
+def scan(unfolding,parameters,executor,nChunks=None):
+    """
+    Runs Unfolding.scan with the parameters split into chunks across the executor
+    Inputs:
+        unfolding: Unfolding
+        parameters: list of regularization, n-iterations, etc. input parameters
+        executor: SerialExecutor, ThreadExecutor, or ProcessExecutor
+        nChunks: int number of tasks, default the number of workers
+    Outputs:
+        ScanResult
+    """
+    from unfold_base import ScanResult
+    parameters = list(parameters)
+    if nChunks is None:
+        nChunks = executor.nWorkers
+    chunkResults = executor.run(_scanTask,_splitEvenly(parameters,nChunks),unfolding)
+    results = numpy.concatenate([chunkResult[0] for chunkResult in chunkResults])
+    covariances = numpy.concatenate([chunkResult[1] for chunkResult in chunkResults])
+    return ScanResult(unfolding,parameters,results,covariances)
+
+def _unfoldTask(unfolding,parameter):
+    unfoldResult = unfolding.unfold(parameter)
+    return unfoldResult.result, unfoldResult.covariance
+
+def unfold(unfolding,parameters,executor):
+    """
+    Calls Unfolding.unfold for each parameter across the executor
+    Inputs:
+        unfolding: Unfolding
+        parameters: list of regularization, n-iterations, etc. input parameters
+        executor: SerialExecutor, ThreadExecutor, or ProcessExecutor
+    Outputs:
+        list of UnfoldResult, in the order of parameters
+    """
+    from unfold_base import UnfoldResult
+    parameters = list(parameters)
+    arrays = executor.run(_unfoldTask,parameters,unfolding)
+    return [UnfoldResult(unfolding,result,covariance,parameter)
+                for parameter, (result, covariance) in zip(parameters,arrays)]
+
+def _toysTask(toyMC,task):
+    nToys, batchSize, seedSequence, store, firstTag = task
+    return toyMC.run(nToys,batchSize=batchSize,seed=seedSequence,store=store,firstTag=firstTag)
+
+def throwToys(toyMC,nToys,executor,seed=None,batchSize=256,nTasks=None,store=None,firstTag=0):
+    """
+    Runs ToyMC.run split into tasks across the executor. Each task has its
+    own random seed spawned from seed, and the tasks are merged in order,
+    so the result only depends on seed and nTasks.
+    Inputs:
+        toyMC: toys.ToyMC
+        nToys: int total number of toys
+        executor: SerialExecutor, ThreadExecutor, or ProcessExecutor
+        seed: seed for numpy.random.SeedSequence, or a SeedSequence
+        batchSize: int maximum number of toys held in memory at once per task
+        nTasks: int number of tasks, default the number of workers
+        store: optional resultstore.ResultStore each task appends its toys to,
+            tagged with their toy numbers; records are in the order they finish
+        firstTag: int toy number of the first toy
+    Outputs:
+        toys.RunningCovariance
+    """
+    if nTasks is None:
+        nTasks = executor.nWorkers
+    nTasks = max(1,min(nTasks,nToys))
+    if not isinstance(seed,numpy.random.SeedSequence):
+        seed = numpy.random.SeedSequence(seed)
+    seedSequences = seed.spawn(nTasks)
+    toyBounds = numpy.linspace(0,nToys,nTasks+1).astype(int)
+    tasks = [(int(toyBounds[i+1]-toyBounds[i]),batchSize,seedSequences[i],store,firstTag+int(toyBounds[i]))
+                for i in range(nTasks)]
+    accumulators = executor.run(_toysTask,tasks,toyMC)
+    result = accumulators[0]
+    for accumulator in accumulators[1:]:
+        result.merge(accumulator)
+    return result
@@ -0,0 +1,310 @@
+"""
+Streaming builder of the migration matrix and spectra from event-level data
+
+Events are read in chunks, binned with vectorized searches, and added to
+pre-allocated accumulators, so memory doesn't depend on the number of events.
+"""
+
+import zipfile
+import numpy
+
+def binIndices(values,binEdges):
+    """
+    Returns the bin index of each value, or -1 if it is outside the
+    binning or NaN. Bins include their low edge, except the last bin which
+    also includes the high edge, like numpy.histogram.
+    Inputs:
+        values: numpy array of values
+        binEdges: numpy array of nBins+1 increasing bin edges
+    Outputs:
+        numpy int64 array of bin indices
+    """
+    values = numpy.asarray(values)
+    nBins = len(binEdges)-1
+    result = numpy.searchsorted(binEdges,values,side="right")-1
+    result[values == binEdges[-1]] = nBins-1
+    result[(result < 0) | (result >= nBins) | numpy.isnan(values)] = -1
+    return result
+
+def iterateFile(filename,trueName,recoName,weightName=None,chunkSize=1000000):
+    """
+    Yields chunks of (true,reco,weights) arrays from a file, with weights None
+    if weightName is None
+    Inputs:
+        filename: .npz, .h5/.hdf5 (needs h5py), or .parquet (needs pyarrow) file
+        trueName: name of the true value column/dataset
+        recoName: name of the reco value column/dataset
+        weightName: optional name of the event weight column/dataset
+        chunkSize: int number of events per chunk
+    """
+    names = [trueName,recoName] + ([] if weightName is None else [weightName])
+    if filename.endswith(".npz"):
+        with zipfile.ZipFile(filename) as zipFile:
+            columns = [_NpzColumn(filename,zipFile,name) for name in names]
+            try:
+                for chunk in _iterateColumns(columns,chunkSize):
+                    yield chunk
+            finally:
+                for column in columns:
+                    column.close()
+    elif filename.endswith(".h5") or filename.endswith(".hdf5"):
+        try:
+            import h5py
+        except ImportError:
+            raise ImportError("h5py is needed to read HDF5 files",filename)
+        with h5py.File(filename,"r") as h5File:
+            columns = [h5File[name] for name in names]
+            for chunk in _iterateColumns(columns,chunkSize):
+                yield chunk
+    elif filename.endswith(".parquet"):
+        try:
+            import pyarrow.parquet
+        except ImportError:
+            raise ImportError("pyarrow is needed to read parquet files",filename)
+        parquetFile = pyarrow.parquet.ParquetFile(filename)
+        for batch in parquetFile.iter_batches(batch_size=chunkSize,columns=names):
+            columns = [batch.column(name).to_numpy(zero_copy_only=False) for name in names]
+            if weightName is None:
+                columns.append(None)
+            yield tuple(columns)
+    else:
+        raise ValueError("Unknown file type, must be .npz, .h5, .hdf5, or .parquet",filename)
+
+class _NpzColumn(object):
+    """
+    1D array in an .npz file read one slice at a time: memory-mapped if it
+    is stored uncompressed, as numpy.savez writes it, otherwise decompressed
+    in order as the slices are asked for
+    """
+
+    def __init__(self,filename,zipFile,name):
+        import inputio
+        try:
+            info = zipFile.getinfo(name+".npy")
+        except KeyError:
+            raise KeyError("No array {} in {}".format(name,filename))
+        self.name = name
+        self.member = None
+        if info.compress_type == zipfile.ZIP_STORED:
+            self.array = inputio.mapNpzMember(filename,info)
+            shape, self.dtype = self.array.shape, self.array.dtype
+        else:
+            self.array = None
+            self.member = zipFile.open(info)
+            shape, fortranOrder, self.dtype = inputio.readNpyHeader(self.member)
+            if self.dtype.hasobject:
+                raise ValueError("Object arrays can't be read from input files",name)
+        if len(shape) != 1:
+            raise ValueError("Column {} must be 1D".format(name),shape)
+        self.length = shape[0]
+        self.position = 0
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self,key):
+        if not (self.array is None):
+            return self.array[key]
+        start, stop, step = key.indices(self.length)
+        if start != self.position or step != 1:
+            raise ValueError("Compressed column {} can only be read in order".format(self.name))
+        count = max(0,stop-start)
+        self.position = start+count
+        return numpy.frombuffer(self.member.read(count*self.dtype.itemsize),dtype=self.dtype,count=count)
+
+    def close(self):
+        if not (self.member is None):
+            self.member.close()
+
+def _iterateColumns(columns,chunkSize):
+    """
+    Yields (true,reco,weights) slices of columns, which may be memory-mapped
+    arrays or HDF5 datasets, so only one chunk is read at a time
+    """
+    nEvents = len(columns[0])
+    for column in columns[1:]:
+        if len(column) != nEvents:
+            raise ValueError("All columns must have the same length")
+    for start in range(0,nEvents,chunkSize):
+        chunk = [numpy.asarray(column[start:start+chunkSize]) for column in columns]
+        if len(chunk) == 2:
+            chunk.append(None)
+        yield tuple(chunk)
+
+class EventIndices(object):
+    """
+    Per-event true and reco bin indices kept by a ResponseBuilder, e.g. for
+    bootstrap.BootstrapResponse, in the smallest integer type holding them.
+    Only events inside the true binning are kept; reco is -1 for events
+    not reconstructed.
+    """
+
+    def __init__(self,nReco,nTrue):
+        """
+        Inputs:
+            nReco: int number of reco bins
+            nTrue: int number of true bins
+        """
+        self.nReco = nReco
+        self.nTrue = nTrue
+        self.dtype = numpy.promote_types(numpy.min_scalar_type(-max(nReco,nTrue)),numpy.int16)
+        self.chunks = []
+
+    def __len__(self):
+        return sum(len(chunk[0]) for chunk in self.chunks)
+
+    def append(self,trueIndices,recoIndices,weights=None):
+        """
+        Adds the bin indices of a chunk of events
+        Inputs:
+            trueIndices: numpy array of true bin indices, all >= 0
+            recoIndices: numpy array of reco bin indices, -1 if not reconstructed
+            weights: optional numpy array of event weights
+        """
+        self.chunks.append((trueIndices.astype(self.dtype),recoIndices.astype(self.dtype),
+                            None if weights is None else numpy.array(weights,dtype=numpy.float64)))
+
+    def getArrays(self):
+        """
+        Returns the kept events as one chunk
+        Outputs:
+            tuple of (trueIndices, recoIndices, weights), weights None if no
+            chunk was weighted
+        """
+        if len(self.chunks) != 1:
+            trueIndices = numpy.concatenate([chunk[0] for chunk in self.chunks]+[numpy.zeros(0,self.dtype)])
+            recoIndices = numpy.concatenate([chunk[1] for chunk in self.chunks]+[numpy.zeros(0,self.dtype)])
+            weights = None
+            if any(not (chunk[2] is None) for chunk in self.chunks):
+                weights = numpy.concatenate([numpy.ones(len(chunk[0])) if chunk[2] is None else chunk[2]
+                                                for chunk in self.chunks])
+            self.chunks = [(trueIndices,recoIndices,weights)]
+        return self.chunks[0]
+
+class ResponseBuilder(object):
+    """
+    Accumulates the migration matrix, true and reconstructed spectra, and
+    efficiency from event-level true and reconstructed values
+
+    Events with a true value outside the true binning are ignored. Events
+    with a reconstructed value that is NaN or outside the reco binning
+    count only in the true spectrum, as not reconstructed.
+    """
+
+    def __init__(self,recoBinEdges,trueBinEdges,keepEvents=False):
+        """
+        Inputs:
+            recoBinEdges: reconstructed bin edges
+            trueBinEdges: true bin edges
+            keepEvents: if True, also keep each event's bin indices in an
+                EventIndices, e.g. for bootstrap.BootstrapResponse
+        """
+        self.recoBinEdges = numpy.array(recoBinEdges,dtype=numpy.float64)
+        self.trueBinEdges = numpy.array(trueBinEdges,dtype=numpy.float64)
+        for binEdges in [self.recoBinEdges,self.trueBinEdges]:
+            if binEdges.ndim != 1 or len(binEdges) < 2 or (numpy.diff(binEdges) <= 0.).any():
+                raise ValueError("Bin edges must be a 1D increasing array with at least 2 entries",binEdges)
+        self.nReco = len(self.recoBinEdges)-1
+        self.nTrue = len(self.trueBinEdges)-1
+        self.nEvents = 0
+        self.migration = numpy.zeros((self.nReco,self.nTrue))
+        self.trueCounts = numpy.zeros(self.nTrue)
+        self.recoCounts = numpy.zeros(self.nReco)
+        self.events = EventIndices(self.nReco,self.nTrue) if keepEvents else None
+
+    def fill(self,true,reco,weights=None):
+        """
+        Adds a chunk of events
+        Inputs:
+            true: numpy array of true values
+            reco: numpy array of reconstructed values, NaN if not reconstructed
+            weights: optional numpy array of event weights
+        """
+        trueIndices = binIndices(true,self.trueBinEdges)
+        recoIndices = binIndices(reco,self.recoBinEdges)
+        if trueIndices.shape != recoIndices.shape:
+            raise ValueError("true and reco must have the same length")
+        if not (weights is None):
+            weights = numpy.asarray(weights,dtype=numpy.float64)
+            if weights.shape != trueIndices.shape:
+                raise ValueError("weights must have the same length as true and reco")
+        self._fillIndices(trueIndices,recoIndices,weights)
+
+    def _fillIndices(self,trueIndices,recoIndices,weights):
+        inTrue = trueIndices >= 0
+        inBoth = inTrue & (recoIndices >= 0)
+        selectedWeights = None if weights is None else weights[inTrue]
+        self.trueCounts += numpy.bincount(trueIndices[inTrue],weights=selectedWeights,minlength=self.nTrue)
+        flatIndices = recoIndices[inBoth]*self.nTrue+trueIndices[inBoth]
+        selectedWeights = None if weights is None else weights[inBoth]
+        self.migration += numpy.bincount(flatIndices,weights=selectedWeights,
+                                            minlength=self.nReco*self.nTrue).reshape(self.nReco,self.nTrue)
+        self.recoCounts += numpy.bincount(recoIndices[inBoth],weights=selectedWeights,minlength=self.nReco)
+        self.nEvents += len(trueIndices)
+        self._keepEvents(trueIndices,recoIndices,weights,inTrue)
+
+    def _keepEvents(self,trueIndices,recoIndices,weights,inTrue):
+        if not (self.events is None):
+            self.events.append(trueIndices[inTrue],recoIndices[inTrue],None if weights is None else weights[inTrue])
+
+    def fillChunks(self,chunks):
+        """
+        Adds events from an iterable of (true,reco) or (true,reco,weights) chunks
+        """
+        for chunk in chunks:
+            self.fill(*chunk)
+
+    def fillArrays(self,true,reco,weights=None,chunkSize=1000000):
+        """
+        Adds events from arrays, e.g. memory-mapped .npy files, a chunk at a time
+        """
+        columns = [true,reco] + ([] if weights is None else [weights])
+        self.fillChunks(_iterateColumns(columns,chunkSize))
+
+    def fillNpy(self,trueFilename,recoFilename,weightFilename=None,chunkSize=1000000):
+        """
+        Adds events from .npy files, memory-mapped so only one chunk is read at a time
+        """
+        true = numpy.load(trueFilename,mmap_mode="r")
+        reco = numpy.load(recoFilename,mmap_mode="r")
+        weights = None if weightFilename is None else numpy.load(weightFilename,mmap_mode="r")
+        self.fillArrays(true,reco,weights,chunkSize)
+
+    def fillFile(self,filename,trueName,recoName,weightName=None,chunkSize=1000000):
+        """
+        Adds events from a columnar file, see iterateFile
+        """
+        self.fillChunks(iterateFile(filename,trueName,recoName,weightName,chunkSize))
+
+    def getMigrationMatrix(self):
+        """
+        Returns the migration matrix of reconstructed events, numpy array
+        (nReco,nTrue), in the layout used by Unfolding
+        """
+        return self.migration.copy()
+
+    def getTrueHist(self):
+        """
+        Returns the true spectrum of all events, reconstructed or not
+        """
+        return self.trueCounts.copy()
+
+    def getRecoHist(self):
+        """
+        Returns the reconstructed spectrum of events inside the true binning
+        """
+        return self.recoCounts.copy()
+
+    def getEfficiency(self):
+        """
+        Returns the fraction of events in each true bin that are reconstructed
+        """
+        reconstructed = self.migration.sum(axis=0)
+        return reconstructed/numpy.where(self.trueCounts != 0.,self.trueCounts,1.)
+
+    def getResponseMatrix(self):
+        """
+        Returns the response matrix, including inefficiency: the probability
+        for an event in each true bin to be reconstructed in each reco bin
+        """
+        return self.migration/numpy.where(self.trueCounts != 0.,self.trueCounts,1.)
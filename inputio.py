@@ -0,0 +1,270 @@
+"""
+Cross-section inputs in one NPZ or HDF5 file, in place of ROOT histograms
+
+A file holds one or more channels, each the inputs of an XsecUnfolder:
+dz, density, bin edges, and the numerator and denominator arrays of
+XsecUnfolder.fromArrays, stored under "<channel>/dz",
+"<channel>/recoBinEdges", "<channel>/num/migration", etc. A multidimensional
+binning.Binning is stored as the edges of each axis, "<channel>/trueBinning/edges0",
+..., its axis names, and its mask, if any. Only the channels
+a job asks for are read. Arrays stored uncompressed, as saveInputs writes
+them, are memory-mapped, so opening a file and making an XsecUnfolder reads
+only the headers and the small arrays.
+"""
+
+import struct
+import zipfile
+import numpy
+import xsec
+import binning
+
+_sides = ["num","denom"]
+_arrayKeys = ["reconstructed","reconstructedVariance","migration","efficiency","efficiencyErrors",
+                "backgrounds","backgroundErrors","migrationUncertainties"]
+# Written only if the XsecUnfolder has them
+_optionalArrayKeys = ["simReconstructed","simTrue"]
+# Arrays smaller than this are read into memory instead of memory-mapped
+_minMappedBytes = 4096
+
+def readNpyHeader(f):
+    """
+    Reads the header of a .npy array from file object f, leaving it at the data
+    Outputs:
+        tuple of (shape,fortranOrder,dtype)
+    """
+    version = numpy.lib.format.read_magic(f)
+    if version == (1,0):
+        return numpy.lib.format.read_array_header_1_0(f)
+    return numpy.lib.format.read_array_header_2_0(f)
+
+def mapNpzMember(filename,info,minMappedBytes=_minMappedBytes):
+    """
+    Returns an array stored uncompressed in an .npz file, memory-mapped
+    unless it is smaller than minMappedBytes
+    Inputs:
+        filename: .npz file name
+        info: zipfile.ZipInfo of the member, which must be ZIP_STORED
+        minMappedBytes: arrays smaller than this are read into memory
+    """
+    if info.compress_type != zipfile.ZIP_STORED:
+        raise ValueError("Only uncompressed arrays can be memory-mapped",info.filename)
+    with open(filename,"rb") as f:
+        # The member's data follows its local header, whose extra field
+        # may differ in length from the central directory's
+        f.seek(info.header_offset)
+        localHeader = f.read(30)
+        nameLength, extraLength = struct.unpack("<HH",localHeader[26:30])
+        f.seek(info.header_offset+30+nameLength+extraLength)
+        shape, fortranOrder, dtype = readNpyHeader(f)
+        count = int(numpy.prod(shape))
+        if dtype.hasobject:
+            raise ValueError("Object arrays can't be read from input files",info.filename)
+        if count*dtype.itemsize < max(minMappedBytes,1):
+            result = numpy.fromfile(f,dtype=dtype,count=count)
+            return result.reshape(shape[::-1]).T if fortranOrder else result.reshape(shape)
+        offset = f.tell()
+    return numpy.memmap(filename,dtype=dtype,mode="r",offset=offset,shape=shape,
+                            order="F" if fortranOrder else "C")
+
+def _isHDF5(filename):
+    return filename.endswith(".h5") or filename.endswith(".hdf5")
+
+def _h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError("h5py is needed to read and write HDF5 files")
+    return h5py
+
+def _binningArrays(prefix,binningToSave):
+    """
+    Returns a dict of the arrays describing a binning.Binning, named under prefix
+    """
+    result = {}
+    for axis, edges in enumerate(binningToSave.binEdges):
+        result["{}/edges{}".format(prefix,axis)] = numpy.asarray(edges,dtype=numpy.float64)
+    # Bytes rather than unicode strings, which HDF5 can't store as fixed-size arrays
+    result[prefix+"/names"] = numpy.array([name.encode("utf-8") for name in binningToSave.names])
+    if not (binningToSave.mask is None):
+        result[prefix+"/mask"] = numpy.asarray(binningToSave.mask,dtype=bool)
+    return result
+
+def saveInputs(filename,xsecUnfolders,overwrite=False):
+    """
+    Writes the array inputs of XsecUnfolders to a .npz or .h5/.hdf5 file,
+    uncompressed so they can be memory-mapped when read. The techniques'
+    extra inputs are written as their arrays, "simReconstructed" and "simTrue".
+    Inputs:
+        filename: path of the file
+        xsecUnfolders: dict of channel name to XsecUnfolder, or one
+            XsecUnfolder, written as channel "default"
+        overwrite: if True, replace an existing file
+    """
+    if isinstance(xsecUnfolders,xsec.XsecUnfolder):
+        xsecUnfolders = {"default": xsecUnfolders}
+    arrays = {}
+    for channel, xsecUnfolder in xsecUnfolders.items():
+        if "/" in channel:
+            raise ValueError("Channel names can't contain \"/\"",channel)
+        for name, binningToSave in [("recoBinning",xsecUnfolder.recoBinning),("trueBinning",xsecUnfolder.trueBinning)]:
+            if not (binningToSave is None):
+                arrays.update(_binningArrays(channel+"/"+name,binningToSave))
+        arrays[channel+"/dz"] = numpy.array(xsecUnfolder.dz)
+        arrays[channel+"/density"] = numpy.array(xsecUnfolder.density)
+        arrays[channel+"/recoBinEdges"] = numpy.asarray(xsecUnfolder.recoBinEdges,dtype=numpy.float64)
+        arrays[channel+"/trueBinEdges"] = numpy.asarray(xsecUnfolder.trueBinEdges,dtype=numpy.float64)
+        for side, sideArrays in zip(_sides,[xsecUnfolder.numArrays,xsecUnfolder.denomArrays]):
+            for key in _arrayKeys+[key for key in _optionalArrayKeys if key in sideArrays]:
+                arrays["{}/{}/{}".format(channel,side,key)] = numpy.ascontiguousarray(sideArrays[key])
+    if _isHDF5(filename):
+        with _h5py().File(filename,"w" if overwrite else "x") as h5File:
+            for name, value in arrays.items():
+                h5File.create_dataset(name,data=value)
+    elif filename.endswith(".npz"):
+        with open(filename,"wb" if overwrite else "xb") as f:
+            numpy.savez(f,**arrays)
+    else:
+        raise ValueError("Unknown file type, must be .npz, .h5, or .hdf5",filename)
+
+class InputFile(object):
+    """
+    Reads channels of cross-section inputs written by saveInputs, a channel
+    at a time, memory-mapping uncompressed arrays
+
+        with InputFile("inputs.npz") as inputFile:
+            xsecUnfolder = inputFile.getXsecUnfolder("pion")
+    """
+
+    def __init__(self,filename):
+        """
+        Inputs:
+            filename: path of a .npz or .h5/.hdf5 file
+        """
+        self.filename = filename
+        if _isHDF5(filename):
+            self._h5File = _h5py().File(filename,"r")
+            names = []
+            self._h5File.visititems(lambda name, obj: names.append(name) if hasattr(obj,"shape") else None)
+            self._members = dict((name,None) for name in names)
+        elif filename.endswith(".npz"):
+            self._h5File = None
+            with zipfile.ZipFile(filename) as zipFile:
+                self._members = dict((info.filename[:-len(".npy")],info) for info in zipFile.infolist()
+                                        if info.filename.endswith(".npy"))
+        else:
+            raise ValueError("Unknown file type, must be .npz, .h5, or .hdf5",filename)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+        return False
+
+    def close(self):
+        """
+        Closes an HDF5 file; memory-mapped arrays already read stay valid
+        """
+        if not (self._h5File is None):
+            self._h5File.close()
+            self._h5File = None
+
+    def getChannelNames(self):
+        """
+        Returns the sorted list of channel names in the file
+        """
+        return sorted(set(name.split("/")[0] for name in self._members if name.endswith("/dz")))
+
+    def getArray(self,name):
+        """
+        Returns one array, memory-mapped if it is stored uncompressed and
+        contiguous and isn't small
+        Inputs:
+            name: str e.g. "pion/num/migration"
+        """
+        if not (name in self._members):
+            raise KeyError("No array {} in {}".format(name,self.filename))
+        if self._h5File is None:
+            return self._readNpzMember(self._members[name])
+        return self._readH5Dataset(self._h5File[name])
+
+    def _readNpzMember(self,info):
+        if info.compress_type != zipfile.ZIP_STORED:
+            with zipfile.ZipFile(self.filename) as zipFile:
+                with zipFile.open(info) as member:
+                    return numpy.lib.format.read_array(member)
+        return mapNpzMember(self.filename,info)
+
+    def _readH5Dataset(self,dataset):
+        offset = dataset.id.get_offset()
+        if (dataset.chunks is None and dataset.compression is None and not (offset is None)
+                and dataset.nbytes >= _minMappedBytes):
+            return numpy.memmap(self.filename,dtype=dataset.dtype,mode="r",offset=offset,shape=dataset.shape)
+        return dataset[()]
+
+    def getBinning(self,channel,name):
+        """
+        Returns a binning.Binning written by saveInputs, or None if there is none
+        Inputs:
+            channel: str channel name
+            name: "recoBinning" or "trueBinning"
+        """
+        prefix = "{}/{}/".format(channel,name)
+        if not (prefix+"edges0" in self._members):
+            return None
+        nAxes = len([member for member in self._members if member.startswith(prefix+"edges")])
+        binEdges = [numpy.array(self.getArray("{}edges{}".format(prefix,axis))) for axis in range(nAxes)]
+        names = [bytes(axisName).decode("utf-8") for axisName in self.getArray(prefix+"names")]
+        mask = numpy.array(self.getArray(prefix+"mask")) if prefix+"mask" in self._members else None
+        return binning.Binning(binEdges,names,mask)
+
+    def getArrays(self,channel):
+        """
+        Returns the arrays of one channel
+        Inputs:
+            channel: str channel name
+        Outputs:
+            dict with "dz", "density", "recoBinEdges", "trueBinEdges",
+            "recoBinning" and "trueBinning" (binning.Binning or None), and
+            "num" and "denom" dicts of XsecUnfolder.fromArrays inputs
+        """
+        if not (channel in self.getChannelNames()):
+            raise KeyError("No channel {} in {}".format(channel,self.filename),self.getChannelNames())
+        result = {}
+        for name in ["dz","density","recoBinEdges","trueBinEdges"]:
+            result[name] = self.getArray(channel+"/"+name)
+        for name in ["recoBinning","trueBinning"]:
+            result[name] = self.getBinning(channel,name)
+        for side in _sides:
+            prefix = "{}/{}/".format(channel,side)
+            result[side] = dict((name[len(prefix):],self.getArray(name)) for name in self._members
+                                    if name.startswith(prefix))
+        return result
+
+    def getXsecUnfolder(self,channel="default",executor=None):
+        """
+        Returns an XsecUnfolder of one channel, see XsecUnfolder.fromArrays
+        Inputs:
+            channel: str channel name
+            executor: optional default executor for XsecUnfolder.unfold
+        """
+        arrays = self.getArrays(channel)
+        recoBinEdges = arrays["recoBinEdges"] if arrays["recoBinning"] is None else arrays["recoBinning"]
+        trueBinEdges = arrays["trueBinEdges"] if arrays["trueBinning"] is None else arrays["trueBinning"]
+        return xsec.XsecUnfolder.fromArrays(float(arrays["dz"]),float(arrays["density"]),arrays["num"],arrays["denom"],
+                                            recoBinEdges,trueBinEdges,executor=executor)
+
+def loadInputs(filename,channels=None,executor=None):
+    """
+    Reads XsecUnfolders from a file written by saveInputs
+    Inputs:
+        filename: path of a .npz or .h5/.hdf5 file
+        channels: optional list of the channel names to read, default all
+        executor: optional default executor for XsecUnfolder.unfold
+    Outputs:
+        dict of channel name to XsecUnfolder
+    """
+    with InputFile(filename) as inputFile:
+        if channels is None:
+            channels = inputFile.getChannelNames()
+        return dict((channel,inputFile.getXsecUnfolder(channel,executor)) for channel in channels)
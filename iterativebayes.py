@@ -0,0 +1,197 @@
+"""
+Iterative Bayesian (D'Agostini) implementation of the Unfolding class in numpy
+"""
+
+import numpy
+import profiling
+from unfold_base import Unfolding, UnfoldResult, ScanResult, BatchResult
+
+def _safeDivide(numerator,denominator):
+    return numerator/numpy.where(denominator != 0.,denominator,1.)*(denominator != 0.)
+
+def iterativeBayes(response,reconstructed,prior,nIterations,reconstructedVariance=None,propagateCovariance=None):
+    """
+    Runs D'Agostini iterations, keeping the result of every iteration
+
+    All spectra are iterated together with matrix operations, and if
+    reconstructedVariance or propagateCovariance is given, the Jacobian d(result)/d(reconstructed)
+    is propagated along with them (Adye's method, with the response fixed),
+    so every iteration's covariance comes out of the same pass.
+
+    Inputs:
+        response: numpy array (nReco,nTrue) response matrix
+        reconstructed: numpy array (nReco,) or (nSpectra,nReco) spectra to unfold
+        prior: numpy array (nTrue,) starting true distribution
+        nIterations: int number of iterations, at least 1
+        reconstructedVariance: optional numpy array with the same shape as reconstructed
+        propagateCovariance: optional function of the Jacobians (...,nTrue,nReco) returning
+            the covariances, for correlated reconstructed uncertainties, e.g.
+            Unfolding.propagateCovariance; used instead of reconstructedVariance
+    Outputs:
+        results: numpy array (nIterations,nTrue) or (nIterations,nSpectra,nTrue)
+        covariances: numpy array (nIterations,nTrue,nTrue) or (nIterations,nSpectra,nTrue,nTrue),
+            or None if neither reconstructedVariance nor propagateCovariance is given
+    """
+    nIterations = int(nIterations)
+    if nIterations < 1:
+        raise ValueError("nIterations must be at least 1",nIterations)
+    y = numpy.asarray(reconstructed,dtype=numpy.float64)
+    efficiency = response.sum(axis=0)
+    x = numpy.broadcast_to(numpy.asarray(prior,dtype=numpy.float64),y.shape[:-1]+(response.shape[1],))
+
+    propagate = not (reconstructedVariance is None and propagateCovariance is None)
+    if propagateCovariance is None and propagate:
+        variance = numpy.asarray(reconstructedVariance)[...,numpy.newaxis,:]
+        propagateCovariance = lambda jacobian: numpy.matmul(jacobian*variance,numpy.swapaxes(jacobian,-1,-2))
+    if propagate:
+        jacobian = numpy.zeros(x.shape+(y.shape[-1],))
+
+    results = numpy.zeros((nIterations,)+x.shape)
+    covariances = numpy.zeros((nIterations,)+x.shape+x.shape[-1:]) if propagate else None
+    for iIteration in range(nIterations):
+        folded = x.dot(response.T)
+        inverseFolded = _safeDivide(1.,folded)
+        ratio = y*inverseFolded
+        correction = _safeDivide(ratio.dot(response),efficiency)
+        xOverEfficiency = _safeDivide(x,efficiency)
+        if propagate:
+            responseTOverFolded = response.T*inverseFolded[...,numpy.newaxis,:]
+            feedback = numpy.matmul(response.T*(ratio*inverseFolded)[...,numpy.newaxis,:],response)
+            jacobian = (xOverEfficiency[...,numpy.newaxis]*(responseTOverFolded-numpy.matmul(feedback,jacobian))
+                            + correction[...,numpy.newaxis]*jacobian)
+            covariances[iIteration] = propagateCovariance(jacobian)
+        x = x*correction
+        results[iIteration] = x
+    return results, covariances
+
+class UnfoldingIterativeBayes(Unfolding):
+    """
+    Low-level unfolding class using iterative Bayesian (D'Agostini) unfolding
+
+    The regularization parameter is the number of iterations.
+    """
+
+    @profiling.profiled()
+    def __init__(self,reconstructedHist,migrationMatrix,prior=None,**kargs):
+        """
+        Unfolding Constructor
+        Inputs:
+            reconstructedHist: TH1 or 1D array reconstructed histogram to unfold
+            migrationMatrix: TH2 or 2D array migration matrix to use for unfolding true v reconstructed
+            prior: starting true distribution, 1D array, "flat", or None to use the
+                projection of migrationMatrix on the true axis
+        Keyword arguments are passed to Unfolding
+        """
+        super(UnfoldingIterativeBayes, self).__init__(reconstructedHist,migrationMatrix,**kargs)
+        nTrue = self.migration.shape[1]
+        if prior is None:
+            prior = self.getTrueProjection()
+        elif isinstance(prior,str):
+            if prior != "flat":
+                raise ValueError("prior must be an array, 'flat', or None",prior)
+            prior = numpy.ones(nTrue)
+        prior = numpy.array(prior,dtype=numpy.float64)
+        if prior.shape != (nTrue,):
+            raise ValueError("prior must have {} entries".format(nTrue),prior.shape)
+        if (prior < 0.).any() or prior.sum() <= 0.:
+            raise ValueError("prior must be non-negative with a positive sum")
+        self.prior = prior
+
+    @profiling.profiled()
+    def unfold(self,parameter=None):
+        """
+        Method to unfold with the number of iterations
+        Inputs:
+            parameter: int number of iterations
+        Outputs:
+            UnfoldResult
+        """
+        return self.unfoldIterations(parameter)[-1]
+
+    def unfoldIterations(self,nIterations):
+        """
+        Unfolds with every number of iterations up to nIterations in one pass
+        Inputs:
+            nIterations: int maximum number of iterations
+        Outputs:
+            list of UnfoldResult, for 1, 2, ..., nIterations iterations
+        """
+        if nIterations is None:
+            raise ValueError("Iterative Bayesian unfolding requires the number of iterations")
+        results, covariances = iterativeBayes(self.getResponseMatrix(),self.reconstructed,self.prior,
+                                                nIterations,propagateCovariance=self.propagateCovariance)
+        return [UnfoldResult(self,results[i],covariances[i],i+1) for i in range(len(results))]
+
+    @profiling.profiled()
+    def unfoldBatch(self,reconstructedHists,parameter=None,reconstructedVariances=None):
+        """
+        Unfolds many reconstructed spectra that share this unfolding's
+        migration matrix, iterating all of them together
+        Inputs:
+            reconstructedHists: list of TH1 or 1D arrays, or 2D array (nSpectra,nReco)
+            parameter: int number of iterations
+            reconstructedVariances: optional 2D array (nSpectra,nReco), see getSpectraArrays
+        Outputs:
+            BatchResult
+        """
+        if parameter is None:
+            raise ValueError("Iterative Bayesian unfolding requires the number of iterations")
+        reconstructed, variances = self.getSpectraArrays(reconstructedHists,reconstructedVariances)
+        results, covariances = iterativeBayes(self.getResponseMatrix(),reconstructed,self.prior,parameter,variances)
+        return BatchResult(self,parameter,reconstructed,variances,results[-1],covariances[-1])
+
+    @profiling.profiled()
+    def unfoldArrays(self,reconstructed,parameter=None,migrations=None):
+        """
+        Unfolds a stack of reconstructed spectra, without covariances,
+        iterating all of them together
+        Inputs:
+            reconstructed: numpy array (nSpectra,nReco)
+            parameter: int number of iterations
+            migrations: optional numpy array (nSpectra,nReco,nTrue) of a
+                migration matrix for each spectrum, default this unfolding's
+        Outputs:
+            numpy array (nSpectra,nTrue)
+        """
+        if parameter is None:
+            raise ValueError("Iterative Bayesian unfolding requires the number of iterations")
+        if migrations is None:
+            return iterativeBayes(self.getResponseMatrix(),reconstructed,self.prior,parameter)[0][-1]
+        return numpy.array([iterativeBayes(self.withMigration(migration).getResponseMatrix(),y,self.prior,parameter)[0][-1]
+                                for y, migration in zip(reconstructed,migrations)])
+
+    def scan(self,parameters,executor=None):
+        """
+        Unfolds with each of a list of numbers of iterations, all from one
+        pass up to the largest
+        Inputs:
+            parameters: list of int numbers of iterations
+            executor: optional executors.SerialExecutor, ThreadExecutor, or
+                ProcessExecutor to split the parameters across
+        Outputs:
+            ScanResult
+        """
+        parameters = list(parameters)
+        if not (executor is None):
+            import executors
+            return executors.scan(self,parameters,executor)
+        iterations = numpy.array(parameters,dtype=int)
+        if len(iterations) == 0 or (iterations < 1).any():
+            raise ValueError("numbers of iterations must be at least 1",parameters)
+        results, covariances = iterativeBayes(self.getResponseMatrix(),self.reconstructed,self.prior,
+                                                iterations.max(),propagateCovariance=self.propagateCovariance)
+        return ScanResult(self,parameters,results[iterations-1],covariances[iterations-1])
+
+if __name__ == "__main__":
+
+    from utilities import *
+    getROOT().gROOT.SetBatch(True)
+
+    trueDataHist, recoDataHist, trueMCHist, recoMCHist, migrationMatrix = CreateFakeData(2000,30000,10,10,0.1,0.1)
+
+    u = UnfoldingIterativeBayes(recoDataHist,migrationMatrix)
+    u.plotReconstructedHist("testBayesReco.png")
+    u.plotMigrationMatrix("testBayesMigrate.png")
+    r = u.unfold(4)
+    r.plotResult("testBayesFinal.png")
+    r.plotCovarianceMatrix("testBayesFinalCov.png")
@@ -2,91 +2,175 @@
 Direct matrix inversion implementation of Unfolding class
 """
 
-import ROOT
-from unfold_base import Unfolding, UnfoldResult
-from utilities import cloneTNamedUUIDName
 import numpy
+import profiling
+from unfold_base import Unfolding, UnfoldResult, ScanResult, BatchResult
+from sparseresponse import SparseResponse
 
 class UnfoldingMatrixInverse(Unfolding):
     """
     Low-level unfolding class using matrix inverse
+
+    Banded and sparse responses, common for fine binnings, are stored
+    compactly and solved with banded or sparse factorizations, see
+    sparseresponse.SparseResponse; dense ones are LU factorized. A
+    scipy.sparse migration matrix is never densified to unfold. The inverse
+    is never formed to unfold, scan, or unfold batches, only when
+    getUnfoldingMatrix is asked for it.
     """
 
-    def __init__(self,reconstructedHist,migrationMatrix):
+    # Above this condition number, more than 10 of the 16 significant digits may be lost
+    conditionWarningThreshold = 1e10
+
+    @profiling.profiled()
+    def __init__(self,reconstructedHist,migrationMatrix,responseKind=None,**kargs):
         """
         Unfolding Constructor
         Inputs:
-            reconstructedHist: TH1 reconstructed histogram to unfold
-            migrationMatrix: TH2 migration matrix to use for unfolding true v reconstructed
+            reconstructedHist: TH1 or 1D array reconstructed histogram to unfold
+            migrationMatrix: TH2 or 2D array migration matrix to use for unfolding true v reconstructed
+            responseKind: "banded", "sparse", or "dense" to force the response storage,
+                default detected from the migration matrix
+        Keyword arguments are passed to Unfolding
         """
-        super(UnfoldingMatrixInverse, self).__init__(reconstructedHist,migrationMatrix)
-        if migrationMatrix.GetNbinsX() != migrationMatrix.GetNbinsY():
+        super(UnfoldingMatrixInverse, self).__init__(reconstructedHist,migrationMatrix,**kargs)
+        if self.migration.shape[0] != self.migration.shape[1]:
             raise Exception("migrationMatrix must be square for matrix inverse unfolding")
-        
+        self.responseKind = responseKind
+
+    def getDecompositionInputs(self):
+        return super(UnfoldingMatrixInverse,self).getDecompositionInputs()+[str(self.responseKind)]
+
+    def decompose(self):
+        """
+        Returns the factorized response and its condition number, computing
+        them if they aren't cached
+        Outputs:
+            tuple of (sparseresponse.SparseResponse, condition number array)
+        """
+        return self.getCachedDecomposition(self._decompose)
+
+    def getSparseResponse(self):
+        """
+        Returns the response matrix as a sparseresponse.SparseResponse
+        """
+        return self.decompose()[0]
+
+    @profiling.profiled()
+    def _decompose(self):
+        sparseResponse = SparseResponse(self.getResponseMatrix(sparse=True),kind=self.responseKind)
+        return (sparseResponse,numpy.array(sparseResponse.getConditionNumber()))
+
+    def getConditionNumber(self):
+        """
+        Returns the estimated 1-norm condition number of the response matrix
+        """
+        return float(self.decompose()[1])
+
+    def _checkCondition(self):
+        """
+        Prints a warning if the response is too ill-conditioned to solve accurately
+        """
+        conditionNumber = self.getConditionNumber()
+        if not (conditionNumber < self.conditionWarningThreshold):
+            print("Warning: response matrix condition number is {:.3g}, the matrix inverse unfolding result may be inaccurate".format(conditionNumber))
+
+    @profiling.profiled()
     def unfold(self,parameter=None):
         """
-        Method to unfold with regularization, n-iterations, etc. input parameter
+        Method to unfold, solving with the response instead of inverting it
         Inputs:
-            parameter: the regularization, n-iterations, etc. input parameter
+            parameter: ignored, matrix inverse unfolding has no parameter
         Outputs:
             UnfoldResult
         """
+        response = self.getSparseResponse()
+        self._checkCondition()
+        x = response.solve(self.reconstructed)
+        factors = self.reconstructedCovarianceFactors
+        uncorrelatedVariance = self.reconstructedVariance
+        if not (factors is None):
+            uncorrelatedVariance = uncorrelatedVariance-(factors**2).sum(axis=1)
+        xCov = response.propagate(uncorrelatedVariance,factors,self.reconstructedCovariance)
+        return UnfoldResult(self,x,xCov,parameter)
+
+    @profiling.profiled()
+    def scan(self,parameters,executor=None):
+        """
+        Matrix inverse unfolding has no parameter, so every parameter gets
+        the result of unfold, solved once with the factorized response
+        Inputs:
+            parameters: list of parameters, all ignored
+            executor: ignored
+        Outputs:
+            ScanResult
+        """
+        parameters = list(parameters)
+        unfoldResult = self.unfold()
+        return ScanResult(self,parameters,numpy.tile(unfoldResult.result,(len(parameters),1)),
+                            numpy.tile(unfoldResult.covariance,(len(parameters),1,1)))
 
-        super(UnfoldingMatrixInverse,self).unfold(parameter)
-
-        y = self.histToBinArray(self.reconstructedHist)
-        yCov = numpy.diagflat(y**0.5)
-        migrationMatrix = self.histToBinArray(self.migrationMatrix) 
-
-        inverseMatrix = numpy.linalg.inv(migrationMatrix)
-        x = inverseMatrix.dot(y)
-        xCov = inverseMatrix.dot(yCov.dot(inverseMatrix.T))
-
-        resultHist = self.binArrayToHist(x)
-        covarianceMatrix = self.binArrayToHist(xCov,True)
-
-        result = UnfoldResult(self, resultHist, covarianceMatrix, parameter)
-        return result
-
-    def histToBinArray(self,hist):
-        if isinstance(hist,ROOT.TH2):
-            nBins = hist.GetNbinsX()
-            assert(hist.GetNbinsY() == nBins)
-            result = numpy.zeros((nBins,nBins))
-            for iBin in range(1,nBins+1):
-                for jBin in range(1,nBins+1):
-                    result[iBin-1][jBin-1] = hist.GetBinContent(iBin,jBin)
-            return result
-        else:
-            nBins = hist.GetNbinsX()
-            result = numpy.zeros(nBins)
-            for iBin in range(1,nBins+1):
-                result[iBin-1] = hist.GetBinContent(iBin)
-            return result
-
-    def binArrayToHist(self,a, th2=False):
-        if th2:
-            result = cloneTNamedUUIDName(self.migrationMatrix)
-            result.Reset()
-            nBins = result.GetNbinsX()
-            assert(hist.GetNbinsY() == nBins)
-            assert(a.shape == (nBins,nBins))
-            for iBin in range(1,nBins+1):
-                for jBin in range(1,nBins+1):
-                    result.SetBinContent(iBin,jBin,a[iBin-1][jBin-1])
-            return result
-        else:
-            result = cloneTNamedUUIDName(self.reconstructedHist)
-            result.Reset()
-            nBins = result.GetNbinsX()
-            for iBin in range(1,nBins+1):
-                result.SetBinContent(iBin,a[iBin-1])
-            return result
+    @profiling.profiled()
+    def unfoldBatch(self,reconstructedHists,parameter=None,reconstructedVariances=None):
+        """
+        Unfolds many reconstructed spectra, solving all of them with the
+        factorized response together, and propagating each one's variance
+        through solves, see sparseresponse.SparseResponse.propagate
+        Inputs:
+            reconstructedHists: list of TH1 or 1D arrays, or 2D array (nSpectra,nReco)
+            parameter: ignored, matrix inverse unfolding has no parameter
+            reconstructedVariances: optional 2D array (nSpectra,nReco), see getSpectraArrays
+        Outputs:
+            BatchResult
+        """
+        reconstructed, variances = self.getSpectraArrays(reconstructedHists,reconstructedVariances)
+        response = self.getSparseResponse()
+        self._checkCondition()
+        results = response.solve(reconstructed.T).T
+        nTrue = self.migration.shape[1]
+        covariances = numpy.array([response.propagate(variance) for variance in variances]).reshape(-1,nTrue,nTrue)
+        return BatchResult(self,parameter,reconstructed,variances,results,covariances)
+
+    def getUnfoldingMatrix(self,parameter=None):
+        """
+        Returns the inverse of the response matrix, formed with a solve for
+        each column. Only for callers that need the matrix itself, e.g.
+        IncrementalUnfolding; unfold, scan, unfoldBatch, and unfoldArrays
+        solve with the factorized response instead.
+        Inputs:
+            parameter: ignored, matrix inverse unfolding has no parameter
+        Outputs:
+            numpy array of shape (nTrue,nReco)
+        """
+        return self.getSparseResponse().solve(numpy.identity(self.migration.shape[0]))
+
+    @profiling.profiled()
+    def unfoldArrays(self,reconstructed,parameter=None,migrations=None):
+        """
+        Unfolds a stack of reconstructed spectra, without covariances,
+        solving all of them together
+        Inputs:
+            reconstructed: numpy array (nSpectra,nReco)
+            parameter: ignored, matrix inverse unfolding has no parameter
+            migrations: optional numpy array (nSpectra,nReco,nTrue) of a
+                migration matrix for each spectrum, default this unfolding's
+        Outputs:
+            numpy array (nSpectra,nTrue)
+        """
+        if migrations is None:
+            reconstructed = numpy.asarray(reconstructed,dtype=numpy.float64)
+            return self.getSparseResponse().solve(reconstructed.T).T
+        migrations = numpy.asarray(migrations,dtype=numpy.float64)
+        trueSums = migrations.sum(axis=1,keepdims=True)
+        responses = migrations/numpy.where(trueSums != 0.,trueSums,1.)
+        reconstructed = numpy.asarray(reconstructed,dtype=numpy.float64)
+        return numpy.linalg.solve(responses,reconstructed[...,numpy.newaxis])[...,0]
 
 if __name__ == "__main__":
 
-    ROOT.gROOT.SetBatch(True)
     from utilities import *
+    from rootadapter import histToArray
+    getROOT().gROOT.SetBatch(True)
 
     trueDataHist, recoDataHist, trueMCHist, recoMCHist, migrationMatrix = CreateFakeData(2000,300,10,10,0.1,0.1)
 
@@ -94,29 +178,29 @@ if __name__ == "__main__":
     u.plotReconstructedHist("testMatInvReco.png")
     u.plotMigrationMatrix("testMatInvMigrate.png")
 
-    true = u.histToBinArray(trueMCHist)
-    reco = u.histToBinArray(recoMCHist)
-    migrate = u.histToBinArray(migrationMatrix)
+    true = histToArray(trueMCHist)
+    reco = histToArray(recoMCHist)
+    migrate = histToArray(migrationMatrix)
     for i in range(migrate.shape[0]):
         #for j in range(migrate.shape[0]):
         #    migrate[i,j] += i
 
         rowsum = migrate[i,:].sum()
         columnsum = migrate[:,i].sum()
-        print "rowsum %.f" % rowsum
-        print "colsum          %.f" % columnsum
+        print("rowsum %.f" % rowsum)
+        print("colsum          %.f" % columnsum)
         #migrate[i,:] = migrate[i,:]/rowsum
 
         #migrate[:,i] = migrate[:,i]/columnsum
 
-    print "true"
-    print true
-    print "reco"
-    print reco
-    print "migrate dot true"
-    print migrate.dot(true)
-    print "migrate"
-    print migrate
+    print("true")
+    print(true)
+    print("reco")
+    print(reco)
+    print("migrate dot true")
+    print(migrate.dot(true))
+    print("migrate")
+    print(migrate)
 
     r = u.unfold()
     r.plotResult("testMatInvFinal.png")
@@ -0,0 +1,204 @@
+"""
+Timing instrumentation of the unfolding pipeline
+
+Stages are functions decorated with profiled, or blocks in a stage context
+manager. While profiling is enabled, each stage records its call count,
+wall time, and the size of the numpy arrays passed in and returned; the
+time of a stage includes the stages it calls. While disabled, which is the
+default, a stage costs one flag check. Profiling is enabled with enable(),
+within a profile() block, or for a whole job by setting the environment
+variable UNFOLD_PROFILE=1.
+
+Stages run in worker processes (executors.ProcessExecutor) are recorded in
+those processes, not in the parent.
+"""
+
+import os
+import time
+import threading
+import functools
+import numpy
+
+_enabled = bool(os.environ.get("UNFOLD_PROFILE"))
+_tracer = None
+_stats = {}
+_lock = threading.Lock()
+
+def enable():
+    global _enabled
+    _enabled = True
+
+def disable():
+    global _enabled
+    _enabled = False
+
+def isEnabled():
+    return _enabled
+
+def reset():
+    """
+    Forgets the stages recorded so far
+    """
+    with _lock:
+        _stats.clear()
+
+def setTracer(tracer):
+    """
+    Sets an external tracer, entered around every stage while profiling is
+    enabled, e.g. an OpenTelemetry tracer's start_as_current_span
+    Inputs:
+        tracer: function of the stage name returning a context manager, or
+            None to remove the tracer
+    """
+    global _tracer
+    _tracer = tracer
+
+def _arrayBytes(obj):
+    """
+    Returns the total size of the numpy arrays in obj, looking one level
+    into tuples and lists
+    """
+    if isinstance(obj,numpy.ndarray):
+        return obj.nbytes
+    if isinstance(obj,(tuple,list)):
+        return sum(item.nbytes for item in obj if isinstance(item,numpy.ndarray))
+    return 0
+
+def _record(name,seconds,arrayBytes):
+    with _lock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = [0,0.,0.,0]
+        stats[0] += 1
+        stats[1] += seconds
+        stats[2] = max(stats[2],seconds)
+        stats[3] = max(stats[3],arrayBytes)
+
+class _Stage(object):
+
+    def __init__(self,name,arrays):
+        self.name = name
+        self.arrays = arrays
+
+    def __enter__(self):
+        self.span = None
+        if not (_tracer is None):
+            self.span = _tracer(self.name)
+            self.span.__enter__()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,*excInfo):
+        seconds = time.perf_counter()-self.start
+        _record(self.name,seconds,sum(_arrayBytes(a) for a in self.arrays))
+        if not (self.span is None):
+            self.span.__exit__(*excInfo)
+        return False
+
+class _NullStage(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*excInfo):
+        return False
+
+_nullStage = _NullStage()
+
+def stage(name,*arrays):
+    """
+    Returns a context manager timing a block as the stage name
+    Inputs:
+        name: str stage name
+        arrays: numpy arrays the block works on, for the array size
+    """
+    if not _enabled:
+        return _nullStage
+    return _Stage(name,arrays)
+
+def profiled(name=None):
+    """
+    Decorator making a function a stage, named by default by its qualified
+    name, e.g. "UnfoldingSVD._decompose". The array size is that of the
+    array arguments and results.
+    """
+    def decorator(function):
+        stageName = function.__qualname__ if name is None else name
+        @functools.wraps(function)
+        def wrapper(*args,**kargs):
+            if not _enabled:
+                return function(*args,**kargs)
+            with _Stage(stageName,args+tuple(kargs.values())) as s:
+                result = function(*args,**kargs)
+                s.arrays += (result,)
+            return result
+        return wrapper
+    return decorator
+
+class profile(object):
+    """
+    Context manager enabling profiling within a block, then restoring the
+    previous state:
+
+        with profiling.profile():
+            xsecUnfolder.unfold(UnfoldingSVD,5,5)
+        print(profiling.formatSummary())
+    """
+
+    def __init__(self,reset=True,tracer=None):
+        """
+        Inputs:
+            reset: if True, forget the stages recorded before the block
+            tracer: optional external tracer for the block, see setTracer
+        """
+        self.reset = reset
+        self.tracer = tracer
+
+    def __enter__(self):
+        self.previous = (_enabled,_tracer)
+        if self.reset:
+            reset()
+        if not (self.tracer is None):
+            setTracer(self.tracer)
+        enable()
+        return self
+
+    def __exit__(self,*excInfo):
+        global _enabled
+        _enabled, previousTracer = self.previous
+        setTracer(previousTracer)
+        return False
+
+def getSummary():
+    """
+    Returns a JSON-serializable dict of stage name to a dict of "calls",
+    "totalSeconds", "meanSeconds", "maxSeconds", and "maxArrayBytes"
+    """
+    with _lock:
+        items = [(name,list(stats)) for name, stats in _stats.items()]
+    return dict((name,{"calls": calls,"totalSeconds": total,"meanSeconds": total/calls,
+                        "maxSeconds": longest,"maxArrayBytes": arrayBytes})
+                    for name, (calls, total, longest, arrayBytes) in items)
+
+def formatSummary(sortBy="totalSeconds"):
+    """
+    Returns the summary as a text table, one stage per line, sorted by
+    decreasing sortBy, a key of the getSummary dicts
+    """
+    summary = getSummary()
+    names = sorted(summary,key=lambda name: -summary[name][sortBy])
+    width = max([len("Stage")]+[len(name) for name in names])
+    lines = ["{:<{}} {:>8} {:>12} {:>12} {:>12} {:>12}".format("Stage",width,"Calls","Total [s]","Mean [s]","Max [s]","Max arrays")]
+    for name in names:
+        stats = summary[name]
+        lines.append("{:<{}} {:>8} {:>12.6f} {:>12.6f} {:>12.6f} {:>12}".format(
+                        name,width,stats["calls"],stats["totalSeconds"],stats["meanSeconds"],
+                        stats["maxSeconds"],_formatBytes(stats["maxArrayBytes"])))
+    return "\n".join(lines)
+
+def _formatBytes(nBytes):
+    for unit in ["B","kB","MB"]:
+        if nBytes < 1024:
+            return "{:.0f} {}".format(nBytes,unit)
+        nBytes /= 1024.
+    return "{:.1f} GB".format(nBytes)
@@ -0,0 +1,190 @@
+"""
+On-disk store of unfolded results, e.g. toys and parameter scans
+
+A store is one binary file: a magic string, a JSON header with the binning
+and metadata (technique, parameter, seed, etc.), then fixed-size records of
+the result, optionally its covariance, the parameter, and an integer tag.
+Readers memory-map the records, so single toys or bins are sliced without
+loading the file. Appends write whole records under an exclusive file lock,
+so several processes can append to the same store.
+"""
+
+import os
+import json
+import numpy
+
+try:
+    import fcntl
+except ImportError:
+    # No file locking (e.g. Windows): appends from several processes aren't safe
+    fcntl = None
+
+_magic = b"UNFSTORE"
+_version = 1
+# Records start at a multiple of this, so memory-mapped arrays are aligned
+_alignment = 64
+
+def _recordDtype(nBins,storeCovariance):
+    fields = [("result",numpy.float64,(nBins,))]
+    if storeCovariance:
+        fields.append(("covariance",numpy.float64,(nBins,nBins)))
+    fields += [("parameter",numpy.float64),("tag",numpy.int64)]
+    return numpy.dtype(fields)
+
+def createStore(filename,binEdges,storeCovariance=True,overwrite=False,**metadata):
+    """
+    Creates an empty result store
+    Inputs:
+        filename: path of the store file
+        binEdges: true bin edges of the results
+        storeCovariance: if True, each record holds a covariance matrix
+        overwrite: if True, replace an existing file
+        metadata: JSON-serializable values to keep in the header, e.g.
+            technique="svd", parameter=5, seed=1234
+    Outputs:
+        ResultStore
+    """
+    binEdges = numpy.array(binEdges,dtype=numpy.float64)
+    if binEdges.ndim != 1 or len(binEdges) < 2:
+        raise ValueError("binEdges must be a 1D array with at least 2 entries",binEdges)
+    header = {
+        "version": _version,
+        "binEdges": binEdges.tolist(),
+        "storeCovariance": bool(storeCovariance),
+        "metadata": metadata,
+    }
+    headerBytes = json.dumps(header).encode("utf-8")
+    prefixLength = len(_magic)+8
+    dataOffset = -(-(prefixLength+len(headerBytes))//_alignment)*_alignment
+    headerBytes += b" "*(dataOffset-prefixLength-len(headerBytes))
+    with open(filename,"wb" if overwrite else "xb") as f:
+        f.write(_magic)
+        f.write(numpy.array([_version,len(headerBytes)],dtype="<u4").tobytes())
+        f.write(headerBytes)
+    return ResultStore(filename)
+
+class ResultStore(object):
+    """
+    Reads and appends to a result store made by createStore
+
+    Only the filename and header are kept, so a ResultStore can be sent to
+    worker processes, each appending to the same file.
+    """
+
+    def __init__(self,filename):
+        """
+        Inputs:
+            filename: path of a store file made by createStore
+        """
+        with open(filename,"rb") as f:
+            prefix = f.read(len(_magic)+8)
+            if len(prefix) < len(_magic)+8 or prefix[:len(_magic)] != _magic:
+                raise ValueError("Not a result store file",filename)
+            version, headerLength = numpy.frombuffer(prefix[len(_magic):],dtype="<u4")
+            if version != _version:
+                raise ValueError("Unsupported result store version {}".format(version),filename)
+            header = json.loads(f.read(int(headerLength)).decode("utf-8"))
+        self.filename = filename
+        self.binEdges = numpy.array(header["binEdges"],dtype=numpy.float64)
+        self.nBins = len(self.binEdges)-1
+        self.storeCovariance = header["storeCovariance"]
+        self.metadata = header["metadata"]
+        self.dataOffset = len(_magic)+8+int(headerLength)
+        self.recordDtype = _recordDtype(self.nBins,self.storeCovariance)
+
+    def __len__(self):
+        # A record still being written by another process isn't counted
+        return (os.path.getsize(self.filename)-self.dataOffset)//self.recordDtype.itemsize
+
+    def getBinEdges(self):
+        return self.binEdges.copy()
+
+    def append(self,results,covariances=None,parameters=None,tags=None):
+        """
+        Appends a batch of results as one locked write
+        Inputs:
+            results: numpy array (nRecords,nBins)
+            covariances: numpy array (nRecords,nBins,nBins), required if the
+                store holds covariances and ignored otherwise
+            parameters: optional list of nRecords numeric parameters, None stored as NaN
+            tags: optional list of nRecords ints, e.g. toy or task numbers
+        """
+        results = numpy.asarray(results,dtype=numpy.float64)
+        if results.ndim != 2 or results.shape[1] != self.nBins:
+            raise ValueError("results must have shape (nRecords,{})".format(self.nBins),results.shape)
+        records = numpy.zeros(len(results),dtype=self.recordDtype)
+        records["result"] = results
+        if self.storeCovariance:
+            if covariances is None:
+                raise ValueError("This store holds covariances, so covariances are required")
+            records["covariance"] = covariances
+        if not (parameters is None):
+            records["parameter"] = [numpy.nan if parameter is None else parameter for parameter in parameters]
+        else:
+            records["parameter"] = numpy.nan
+        if not (tags is None):
+            records["tag"] = tags
+        data = records.tobytes()
+        with open(self.filename,"ab") as f:
+            if not (fcntl is None):
+                fcntl.flock(f.fileno(),fcntl.LOCK_EX)
+            try:
+                f.write(data)
+                f.flush()
+            finally:
+                if not (fcntl is None):
+                    fcntl.flock(f.fileno(),fcntl.LOCK_UN)
+
+    def appendResults(self,unfoldResults,tags=None):
+        """
+        Appends a list of UnfoldResult, or other results with getResultArray
+        and getCovarianceArray methods
+        """
+        unfoldResults = list(unfoldResults)
+        nBins = self.nBins
+        results = numpy.array([unfoldResult.getResultArray() for unfoldResult in unfoldResults]).reshape(-1,nBins)
+        covariances = None
+        if self.storeCovariance:
+            covariances = numpy.array([unfoldResult.getCovarianceArray() for unfoldResult in unfoldResults]).reshape(-1,nBins,nBins)
+        parameters = [getattr(unfoldResult,"parameter",None) for unfoldResult in unfoldResults]
+        self.append(results,covariances,parameters,tags)
+
+    def appendScan(self,scanResult,tags=None):
+        """
+        Appends the results of a ScanResult or BatchResult
+        """
+        if hasattr(scanResult,"parameters"):
+            parameters = scanResult.parameters
+        else:
+            parameters = [scanResult.parameter]*len(scanResult)
+        self.append(scanResult.results,scanResult.covariances,parameters,tags)
+
+    def getRecords(self):
+        """
+        Returns the records as a read-only memory-mapped structured array,
+        with fields "result", "covariance" (if stored), "parameter", and "tag"
+        """
+        nRecords = len(self)
+        if nRecords == 0:
+            return numpy.zeros(0,dtype=self.recordDtype)
+        return numpy.memmap(self.filename,dtype=self.recordDtype,mode="r",offset=self.dataOffset,shape=(nRecords,))
+
+    def getResults(self):
+        """
+        Returns a memory-mapped (nRecords,nBins) view of the results
+        """
+        return self.getRecords()["result"]
+
+    def getCovariances(self):
+        """
+        Returns a memory-mapped (nRecords,nBins,nBins) view of the covariances
+        """
+        if not self.storeCovariance:
+            raise ValueError("This store doesn't hold covariances",self.filename)
+        return self.getRecords()["covariance"]
+
+    def getParameters(self):
+        return numpy.array(self.getRecords()["parameter"])
+
+    def getTags(self):
+        return numpy.array(self.getRecords()["tag"])
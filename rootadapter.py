@@ -0,0 +1,240 @@
+"""
+Conversion between ROOT histograms and the numpy arrays used by the unfolding core
+
+This module imports ROOT, so the rest of the package only imports it when
+ROOT histograms are actually given as inputs or requested as outputs.
+"""
+
+import numpy
+import profiling
+from utilities import getROOT, cloneTNamedUUIDName, HistUUID, Hist2DUUID
+
+ROOT = getROOT()
+
+def _cellDtype(hist):
+    """
+    Returns the numpy dtype matching the storage array of a ROOT histogram
+    """
+    for arrayClass, dtype in [
+                (ROOT.TArrayD,numpy.float64),
+                (ROOT.TArrayF,numpy.float32),
+                (ROOT.TArrayI,numpy.int32),
+                (ROOT.TArrayS,numpy.int16),
+                (ROOT.TArrayC,numpy.int8),
+            ]:
+        if isinstance(hist,arrayClass):
+            return dtype
+    raise TypeError("Unsupported histogram storage type",type(hist))
+
+def _cellView(buf,nCells,dtype):
+    """
+    Wraps a PyROOT C array pointer as a read-only numpy array without copying
+    """
+    try:
+        buf.reshape((nCells,)) # cppyy LowLevelView
+    except AttributeError:
+        buf.SetSize(nCells) # legacy PyROOT buffer
+    return numpy.frombuffer(buf,dtype=dtype,count=nCells)
+
+def _cellsToArray(hist,cells,flow):
+    """
+    Reshapes a flat array of histogram cells (ROOT global bin order) into
+    [x], [x,y], or [x,y,z] order, dropping the under/overflow bins unless flow is True
+    """
+    if isinstance(hist,ROOT.TH3):
+        nx = hist.GetNbinsX()+2
+        ny = hist.GetNbinsY()+2
+        nz = hist.GetNbinsZ()+2
+        result = cells.reshape((nz,ny,nx)).T
+        if not flow:
+            result = result[1:-1,1:-1,1:-1]
+    elif isinstance(hist,ROOT.TH2):
+        nx = hist.GetNbinsX()+2
+        ny = hist.GetNbinsY()+2
+        result = cells.reshape((ny,nx)).T
+        if not flow:
+            result = result[1:-1,1:-1]
+    else:
+        result = cells
+        if not flow:
+            result = result[1:-1]
+    return numpy.array(result,dtype=numpy.float64)
+
+def _arrayToCells(hist,a,flow):
+    """
+    Inverse of _cellsToArray: returns a flat, contiguous float64 array of
+    cells in ROOT global bin order, with zero under/overflow unless flow is True
+    """
+    a = numpy.asarray(a,dtype=numpy.float64)
+    if isinstance(hist,ROOT.TH3):
+        shape = (hist.GetNbinsX()+2,hist.GetNbinsY()+2,hist.GetNbinsZ()+2)
+        cells = numpy.zeros(shape)
+        if flow:
+            cells[:,:,:] = a
+        else:
+            cells[1:-1,1:-1,1:-1] = a
+        cells = cells.T
+    elif isinstance(hist,ROOT.TH2):
+        cells = numpy.zeros(shape)
+        if flow:
+            cells[:,:] = a
+        else:
+            cells[1:-1,1:-1] = a
+        cells = cells.T
+    else:
+        shape = (hist.GetNbinsX()+2,)
+        cells = numpy.zeros(shape)
+        if flow:
+            cells[:] = a
+        else:
+            cells[1:-1] = a
+    return numpy.ascontiguousarray(cells.ravel())
+
+@profiling.profiled()
+def histToArray(hist,flow=False):
+    """
+    Copies histogram bin contents into a numpy array in one step
+
+    Inputs:
+        hist: TH1, TH2, or TH3
+        flow: if True, include the under/overflow bins
+    Outputs:
+        numpy float64 array of shape (nBinsX,), (nBinsX,nBinsY), or (nBinsX,nBinsY,nBinsZ),
+        indexed [x], [x,y], or [x,y,z] (+2 on each axis if flow)
+    """
+    nCells = hist.GetNcells()
+    cells = _cellView(hist.GetArray(),nCells,_cellDtype(hist))
+    return _cellsToArray(hist,cells,flow)
+
+@profiling.profiled()
+def histErrorsToArray(hist,flow=False):
+    """
+    Copies histogram bin errors into a numpy array in one step
+
+    Uses the sum of weights squared if the histogram has one, otherwise
+    sqrt(|content|), matching TH1::GetBinError
+
+    Inputs:
+        hist: TH1, TH2, or TH3
+        flow: if True, include the under/overflow bins
+    Outputs:
+        numpy float64 array with the same layout as histToArray
+    """
+    nCells = hist.GetNcells()
+    if hist.GetSumw2N() > 0:
+        sumw2 = _cellView(hist.GetSumw2().GetArray(),nCells,numpy.float64)
+        errors = numpy.sqrt(sumw2)
+    else:
+        cells = _cellView(hist.GetArray(),nCells,_cellDtype(hist))
+        errors = numpy.sqrt(numpy.abs(cells.astype(numpy.float64)))
+    return _cellsToArray(hist,errors,flow)
+
+def histBinEdges(hist,axis="x"):
+    """
+    Returns the bin edges of a histogram axis as a numpy array
+
+    Inputs:
+        hist: TH1, TH2, or TH3
+        axis: "x", "y", or "z"
+    Outputs:
+        numpy float64 array of nBins+1 edges
+    """
+    if axis == "x":
+        ax = hist.GetXaxis()
+    elif axis == "y":
+        ax = hist.GetYaxis()
+    elif axis == "z":
+        ax = hist.GetZaxis()
+    else:
+        raise ValueError("axis must be one of 'x', 'y', or 'z'",axis)
+    nBins = ax.GetNbins()
+    xbins = ax.GetXbins()
+    if xbins.GetSize() == nBins+1:
+        return numpy.array(_cellView(xbins.GetArray(),nBins+1,numpy.float64))
+    return numpy.linspace(ax.GetXmin(),ax.GetXmax(),nBins+1)
+
+def detach(hist):
+    """
+    Removes a histogram from ROOT's current directory and gives its
+    ownership to Python, so it is deleted when no longer referenced instead
+    of accumulating in the directory
+    Inputs:
+        hist: TH1 or TH2, e.g. returned by a ROOT method the caller owns
+    Outputs:
+        hist
+    """
+    hist.SetDirectory(0)
+    ROOT.SetOwnership(hist,True)
+    return hist
+
+def _setCells(hist,a,errors,flow):
+    hist.SetContent(_arrayToCells(hist,a,flow))
+    if not (errors is None):
+        hist.Sumw2(True)
+        hist.SetError(_arrayToCells(hist,errors,flow))
+    elif hist.GetSumw2N() > 0:
+        hist.SetError(numpy.sqrt(numpy.abs(_arrayToCells(hist,a,flow))))
+    hist.ResetStats()
+    return hist
+
+def setHistContents(hist,a,errors=None):
+    """
+    Replaces the contents of a histogram, e.g. a pooled one from
+    utilities.ROOTObjectManager.acquireHist, without under/overflow
+
+    Inputs:
+        hist: TH1 or TH2
+        a: numpy array with the layout returned by histToArray
+        errors: optional numpy array of bin errors with the same layout as a
+    Outputs:
+        hist
+    """
+    return _setCells(hist,a,errors,False)
+
+@profiling.profiled()
+def arrayToHist(a,template,errors=None,flow=False):
+    """
+    Creates a histogram with the binning of template from a numpy array in one step
+
+    Inputs:
+        a: numpy array with the layout returned by histToArray
+        template: TH1 or TH2 to take the binning (and type) from. Not modified.
+        errors: optional numpy array of bin errors with the same layout as a.
+            If None, errors are sqrt(|content|).
+        flow: if True, a (and errors) include the under/overflow bins
+    Outputs:
+        new TH1 or TH2 with UUID name, not attached to a ROOT directory
+    """
+    result = detach(cloneTNamedUUIDName(template))
+    result.Reset()
+    return _setCells(result,a,errors,flow)
+
+@profiling.profiled()
+def makeHist(a,binEdges,errors=None):
+    """
+    Creates a TH1D from a numpy array of bin contents and the bin edges
+
+    Inputs:
+        a: numpy array of nBins contents
+        binEdges: nBins+1 bin edges
+        errors: optional numpy array of nBins bin errors
+    Outputs:
+        new TH1D with UUID name, not attached to a ROOT directory
+    """
+    result = detach(HistUUID(list(binEdges),TH1D=True))
+    return _setCells(result,a,errors,False)
+
+@profiling.profiled()
+def makeHist2D(a,xBinEdges,yBinEdges):
+    """
+    Creates a TH2D from a numpy array of bin contents and the bin edges
+
+    Inputs:
+        a: numpy array of shape (nBinsX,nBinsY) indexed [x,y]
+        xBinEdges: nBinsX+1 bin edges
+        yBinEdges: nBinsY+1 bin edges
+    Outputs:
+        new TH2D with UUID name, not attached to a ROOT directory
+    """
+    result = detach(Hist2DUUID(list(xBinEdges),list(yBinEdges),TH2D=True))
+    return _setCells(result,a,None,False)
@@ -0,0 +1,410 @@
+"""
+Local asyncio service that unfolds spectra for notebooks and dashboards
+
+The service keeps the unfolding modules imported, the registered response
+matrices, their factorizations (through the decomposition cache), and the
+most recent results in one long-running process. Clients send one JSON
+request per line over TCP, and get one JSON response per line with the same
+"id", so a connection can have many requests in flight. Arrays are sent as
+nested lists, or as {"dtype","shape","data"} with base64 data (see
+encodeArray).
+
+Requests:
+    {"method": "ping"}
+    {"method": "registerResponse", "migration": ..., "recoBinEdges": ..., "trueBinEdges": ...}
+        returns {"responseId": ...}, to use instead of sending the migration again
+    {"method": "unfold", "technique": "svd", "parameter": 5, "reconstructed": ...,
+        "reconstructedVariance": ..., "responseId": ...}
+        or with "migration", "recoBinEdges", "trueBinEdges" instead of "responseId",
+        which are used for that request only and not registered;
+        returns {"result": ..., "covariance": ...}
+    {"method": "xsec", "technique": ..., "numParameter": ..., "denomParameter": ...,
+        "dz": ..., "density": ..., "num": {...}, "denom": {...},
+        "recoBinEdges": ..., "trueBinEdges": ...}
+        with num and denom as in xsec.XsecUnfolder.fromArrays; returns
+        {"result": ..., "covariance": ..., "covariancesBySource": {...}}
+    {"method": "stats"}
+
+Concurrent unfold requests with the same technique, response, and
+parameter are gathered for batchWindow seconds and unfolded as one batch.
+All of the math runs in a worker pool, so the event loop never blocks.
+
+Usage:
+    python service.py --port 8765
+"""
+
+import json
+import base64
+import asyncio
+import argparse
+import collections
+import concurrent.futures
+import numpy
+import cache
+
+def _techniques():
+    """
+    Returns a dict of technique name to Unfolding class
+    """
+    from matrixinverse import UnfoldingMatrixInverse
+    from svdunfold import UnfoldingSVD
+    from tikhonov import UnfoldingTikhonov
+    from iterativebayes import UnfoldingIterativeBayes
+    return {
+        "matrixinverse": UnfoldingMatrixInverse,
+        "svd": UnfoldingSVD,
+        "tikhonov": UnfoldingTikhonov,
+        "bayes": UnfoldingIterativeBayes,
+    }
+
+def encodeArray(a):
+    """
+    Returns a JSON-serializable dict of a numpy array, with its data in base64
+    """
+    a = numpy.ascontiguousarray(a)
+    return {"dtype": a.dtype.str,"shape": list(a.shape),"data": base64.b64encode(a.tobytes()).decode("ascii")}
+
+def decodeArray(obj):
+    """
+    Returns a float64 numpy array from a nested list, an encodeArray dict,
+    or a list of encodeArray dicts
+    """
+    if isinstance(obj,dict):
+        a = numpy.frombuffer(base64.b64decode(obj["data"]),dtype=numpy.dtype(obj["dtype"])).reshape(obj["shape"])
+        return a.astype(numpy.float64)
+    if isinstance(obj,list) and any(isinstance(item,dict) for item in obj):
+        # A list of encoded arrays, e.g. one per background
+        return numpy.array([decodeArray(item) for item in obj])
+    return numpy.array(obj,dtype=numpy.float64)
+
+def _unfoldGroup(technique,migration,recoBinEdges,trueBinEdges,parameter,reconstructed,variances):
+    """
+    Unfolds a batch of spectra sharing a response, in a pool worker
+    Outputs:
+        results: numpy array (nSpectra,nTrue)
+        covariances: numpy array (nSpectra,nTrue,nTrue)
+    """
+    unfoldingClass = _techniques()[technique]
+    unfolding = unfoldingClass(reconstructed[0],migration,recoBinEdges=recoBinEdges,trueBinEdges=trueBinEdges,
+                                reconstructedCovariance=variances[0])
+    batchResult = unfolding.unfoldBatch(reconstructed,parameter,variances)
+    return batchResult.results, batchResult.covariances
+
+def _unfoldXsec(technique,numParameter,denomParameter,dz,density,numArrays,denomArrays,recoBinEdges,trueBinEdges):
+    """
+    Runs the cross-section pipeline, in a pool worker
+    """
+    import xsec
+    unfoldingClass = _techniques()[technique]
+    xsecUnfolder = xsec.XsecUnfolder.fromArrays(dz,density,numArrays,denomArrays,recoBinEdges,trueBinEdges)
+    xsecUnfoldResult = xsecUnfolder.unfold(unfoldingClass,numParameter,denomParameter)
+    return (xsecUnfoldResult.getResultArray(),xsecUnfoldResult.getCovarianceArray(),
+            xsecUnfoldResult.getCovarianceArraysBySource())
+
+class UnfoldingService(object):
+    """
+    asyncio server answering unfolding requests, see the module docstring
+    """
+
+    def __init__(self,host="127.0.0.1",port=0,maxWorkers=None,useProcesses=False,
+                        batchWindow=0.005,maxBatchSize=256,maxCachedResults=1024):
+        """
+        Inputs:
+            host: str address to listen on, default localhost only
+            port: int port, default any free port
+            maxWorkers: int number of workers in the pool, default the number of CPUs
+            useProcesses: if True, use a pool of processes instead of threads;
+                threads share the decomposition cache and numpy releases the GIL
+                in its linear algebra, so they are usually enough
+            batchWindow: float seconds to wait for more requests to batch with
+            maxBatchSize: int number of requests at which a batch is run at once
+            maxCachedResults: int number of results kept for repeated requests
+        """
+        self.host = host
+        self.port = port
+        if useProcesses:
+            self.pool = concurrent.futures.ProcessPoolExecutor(maxWorkers)
+        else:
+            self.pool = concurrent.futures.ThreadPoolExecutor(maxWorkers)
+        self.batchWindow = batchWindow
+        self.maxBatchSize = maxBatchSize
+        self.maxCachedResults = maxCachedResults
+        # Responses registered with registerResponse, kept until the service stops
+        self.responses = {}
+        self.results = collections.OrderedDict()
+        # Batch key to the list of (reconstructed, variance, future) waiting to run
+        self.pending = {}
+        self.server = None
+        self.stats = {"requests": 0,"batches": 0,"batchedRequests": 0,"cachedResults": 0,"errors": 0}
+
+    async def start(self):
+        """
+        Starts listening, returning the (host,port) it listens on
+        """
+        self.server = await asyncio.start_server(self._handleConnection,self.host,self.port,limit=2**28)
+        self.host, self.port = self.server.sockets[0].getsockname()[:2]
+        return self.host, self.port
+
+    async def serveForever(self):
+        if self.server is None:
+            await self.start()
+        async with self.server:
+            await self.server.serve_forever()
+
+    async def close(self):
+        if not (self.server is None):
+            self.server.close()
+            await self.server.wait_closed()
+        self.pool.shutdown(wait=False)
+
+    async def _handleConnection(self,reader,writer):
+        writeLock = asyncio.Lock()
+        tasks = set()
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                # Each request is its own task, so requests on one connection run concurrently
+                task = asyncio.ensure_future(self._answer(line,writer,writeLock))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+        except (asyncio.CancelledError,ConnectionError):
+            # The service is shutting down or the client went away
+            pass
+        finally:
+            writer.close()
+
+    async def _answer(self,line,writer,writeLock):
+        requestId = None
+        try:
+            request = json.loads(line)
+            requestId = request.get("id")
+            response = await self.handle(request)
+        except Exception as e:
+            self.stats["errors"] += 1
+            response = {"error": "{}: {}".format(type(e).__name__,e)}
+        response["id"] = requestId
+        async with writeLock:
+            writer.write((json.dumps(response)+"\n").encode("utf-8"))
+            await writer.drain()
+
+    async def handle(self,request):
+        """
+        Answers one request dict, returning the response dict
+        """
+        self.stats["requests"] += 1
+        method = request.get("method")
+        if method == "ping":
+            return {"result": "pong"}
+        if method == "stats":
+            return dict(self.stats,registeredResponses=len(self.responses),
+                            decompositionCacheHits=cache.getDefaultCache().hits)
+        if method == "registerResponse":
+            return {"responseId": self._registerResponse(request)}
+        if method == "unfold":
+            return await self._unfold(request)
+        if method == "xsec":
+            return await self._xsec(request)
+        raise ValueError("Unknown method",method)
+
+    def _registerResponse(self,request):
+        responseId, response = self._decodeResponse(request)
+        self.responses[responseId] = response
+        return responseId
+
+    def _decodeResponse(self,request):
+        """
+        Returns the content key and the (migration,recoBinEdges,trueBinEdges)
+        of a response sent in a request
+        """
+        migration = decodeArray(request["migration"])
+        if migration.ndim != 2:
+            raise ValueError("migration must be a 2D array",migration.shape)
+        nReco, nTrue = migration.shape
+        recoBinEdges = decodeArray(request["recoBinEdges"]) if "recoBinEdges" in request else numpy.arange(nReco+1.)
+        trueBinEdges = decodeArray(request["trueBinEdges"]) if "trueBinEdges" in request else numpy.arange(nTrue+1.)
+        if recoBinEdges.shape != (nReco+1,) or trueBinEdges.shape != (nTrue+1,):
+            raise ValueError("Bin edges don't match the migration matrix shape",migration.shape)
+        return cache.contentKey(migration,recoBinEdges,trueBinEdges), (migration,recoBinEdges,trueBinEdges)
+
+    async def _unfold(self,request):
+        technique = request["technique"]
+        if not (technique in _techniques()):
+            raise ValueError("Unknown technique, choose from {}".format(sorted(_techniques())),technique)
+        if "responseId" in request:
+            responseId = request["responseId"]
+            if not (responseId in self.responses):
+                raise ValueError("Unknown responseId, register the response first",responseId)
+            response = self.responses[responseId]
+        else:
+            # Inline responses aren't registered, so a long-running service
+            # doesn't keep every migration matrix it was ever sent; requests
+            # with the same one still batch together by its content key
+            responseId, response = self._decodeResponse(request)
+        migration = response[0]
+        parameter = request.get("parameter")
+        reconstructed = decodeArray(request["reconstructed"])
+        if reconstructed.shape != (migration.shape[0],):
+            raise ValueError("reconstructed must have {} bins".format(migration.shape[0]),reconstructed.shape)
+        if "reconstructedVariance" in request:
+            variance = decodeArray(request["reconstructedVariance"])
+            if variance.shape != reconstructed.shape:
+                raise ValueError("reconstructedVariance must have the shape of reconstructed",variance.shape)
+        else:
+            variance = numpy.abs(reconstructed)
+
+        resultKey = cache.contentKey(technique,responseId,repr(parameter),reconstructed,variance)
+        if resultKey in self.results:
+            self.results.move_to_end(resultKey)
+            self.stats["cachedResults"] += 1
+            result, covariance = self.results[resultKey]
+        else:
+            result, covariance = await self._submit((technique,responseId,repr(parameter)),parameter,response,
+                                                    reconstructed,variance)
+            self.results[resultKey] = (result,covariance)
+            while len(self.results) > self.maxCachedResults:
+                self.results.popitem(last=False)
+        return {"result": result.tolist(),"covariance": covariance.tolist()}
+
+    def _submit(self,batchKey,parameter,response,reconstructed,variance):
+        """
+        Adds a spectrum to the batch for batchKey, returning a future of its
+        (result,covariance); response is the batch's (migration,recoBinEdges,trueBinEdges)
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        if not (batchKey in self.pending):
+            self.pending[batchKey] = []
+            loop.call_later(self.batchWindow,self._runBatch,batchKey,parameter,response)
+        self.pending[batchKey].append((reconstructed,variance,future))
+        if len(self.pending[batchKey]) >= self.maxBatchSize:
+            self._runBatch(batchKey,parameter,response)
+        return future
+
+    def _runBatch(self,batchKey,parameter,response):
+        entries = self.pending.pop(batchKey,None)
+        if not entries:
+            return
+        technique, responseId, parameterRepr = batchKey
+        migration, recoBinEdges, trueBinEdges = response
+        reconstructed = numpy.array([entry[0] for entry in entries])
+        variances = numpy.array([entry[1] for entry in entries])
+        self.stats["batches"] += 1
+        self.stats["batchedRequests"] += len(entries)
+        loop = asyncio.get_running_loop()
+        poolFuture = loop.run_in_executor(self.pool,_unfoldGroup,technique,migration,recoBinEdges,trueBinEdges,
+                                            parameter,reconstructed,variances)
+        def done(poolFuture):
+            if poolFuture.exception() is None:
+                results, covariances = poolFuture.result()
+                for (y, variance, future), result, covariance in zip(entries,results,covariances):
+                    if not future.done():
+                        future.set_result((result,covariance))
+            else:
+                for y, variance, future in entries:
+                    if not future.done():
+                        future.set_exception(poolFuture.exception())
+        poolFuture.add_done_callback(done)
+
+    async def _xsec(self,request):
+        technique = request["technique"]
+        if not (technique in _techniques()):
+            raise ValueError("Unknown technique, choose from {}".format(sorted(_techniques())),technique)
+        numArrays = dict((key,decodeArray(value)) for key, value in request["num"].items())
+        denomArrays = dict((key,decodeArray(value)) for key, value in request["denom"].items())
+        loop = asyncio.get_running_loop()
+        result, covariance, covariancesBySource = await loop.run_in_executor(
+                    self.pool,_unfoldXsec,technique,request.get("numParameter"),request.get("denomParameter"),
+                    request["dz"],request["density"],numArrays,denomArrays,
+                    decodeArray(request["recoBinEdges"]),decodeArray(request["trueBinEdges"]))
+        return {"result": result.tolist(),"covariance": covariance.tolist(),
+                "covariancesBySource": dict((source,value.tolist()) for source, value in covariancesBySource.items())}
+
+class ServiceClient(object):
+    """
+    asyncio client of an UnfoldingService; requests may be awaited concurrently
+    """
+
+    def __init__(self,reader,writer):
+        self.reader = reader
+        self.writer = writer
+        self.nextId = 0
+        self.waiting = {}
+        self.readTask = asyncio.ensure_future(self._read())
+
+    @classmethod
+    async def connect(cls,host="127.0.0.1",port=8765):
+        reader, writer = await asyncio.open_connection(host,port,limit=2**28)
+        return cls(reader,writer)
+
+    async def _read(self):
+        while True:
+            line = await self.reader.readline()
+            if not line:
+                break
+            response = json.loads(line)
+            future = self.waiting.pop(response.get("id"),None)
+            if not (future is None) and not future.done():
+                future.set_result(response)
+        for future in self.waiting.values():
+            if not future.done():
+                future.set_exception(ConnectionError("The service closed the connection"))
+
+    async def request(self,method,**params):
+        """
+        Sends a request and returns its response dict, raising RuntimeError
+        if the service answered with an error. Numpy arrays in params are
+        sent with encodeArray.
+        """
+        self.nextId += 1
+        requestId = self.nextId
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[requestId] = future
+        request = dict(params,method=method,id=requestId)
+        self.writer.write((json.dumps(request,default=self._encode)+"\n").encode("utf-8"))
+        await self.writer.drain()
+        response = await future
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response
+
+    @staticmethod
+    def _encode(obj):
+        if isinstance(obj,numpy.ndarray):
+            return encodeArray(obj)
+        if isinstance(obj,numpy.generic):
+            return obj.item()
+        raise TypeError("Can't send {} to the service".format(type(obj).__name__))
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        self.readTask.cancel()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Serve unfolding requests over TCP, one JSON request per line")
+    parser.add_argument("--host",default="127.0.0.1",help="address to listen on, default localhost only")
+    parser.add_argument("--port",type=int,default=8765,help="port to listen on")
+    parser.add_argument("--workers",type=int,default=None,help="number of pool workers, default the number of CPUs")
+    parser.add_argument("--processes",action="store_true",help="use worker processes instead of threads")
+    parser.add_argument("--batch-window",type=float,default=0.005,help="seconds to wait for requests to batch together")
+    args = parser.parse_args(argv)
+
+    service = UnfoldingService(args.host,args.port,args.workers,args.processes,args.batch_window)
+    async def run():
+        host, port = await service.start()
+        print("Serving unfolding requests on {}:{}".format(host,port))
+        try:
+            await service.serveForever()
+        finally:
+            await service.close()
+    try:
+        asyncio.run(run())
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,292 @@
+"""
+Compact storage and solves for banded and sparse square response matrices
+
+Migration matrices of fine binnings are usually nearly diagonal. A
+SparseResponse stores such a response in LAPACK banded form or as CSR and
+solves with banded or sparse LU factorizations, instead of forming the dense
+inverse. Dense responses are LU factorized once. scipy is needed for the
+banded and sparse forms and the dense LU; without it the response is kept
+dense and solved with numpy.linalg.solve.
+"""
+
+import numpy
+
+def _scipy():
+    """
+    Returns (scipy.linalg, scipy.sparse, scipy.sparse.linalg), or None if scipy isn't installed
+    """
+    try:
+        import scipy.linalg
+        import scipy.sparse
+        import scipy.sparse.linalg
+    except ImportError:
+        return None
+    return scipy.linalg, scipy.sparse, scipy.sparse.linalg
+
+def getBandwidths(matrix):
+    """
+    Returns the number of non-zero diagonals below and above the main diagonal
+    Inputs:
+        matrix: 2D numpy array or scipy.sparse matrix
+    Outputs:
+        (lower,upper) ints
+    """
+    if hasattr(matrix,"tocoo"):
+        coo = matrix.tocoo()
+        nonzero = coo.data != 0.
+        rows, columns = coo.row[nonzero], coo.col[nonzero]
+    else:
+        rows, columns = numpy.nonzero(matrix)
+    if len(rows) == 0:
+        return 0, 0
+    offsets = columns-rows
+    return int(max(0,-offsets.min())), int(max(0,offsets.max()))
+
+def toBanded(matrix,lower,upper):
+    """
+    Returns the (lower+upper+1,n) LAPACK banded storage of a square matrix,
+    a numpy array or scipy.sparse matrix, as used by scipy.linalg.solve_banded
+    """
+    n = matrix.shape[0]
+    result = numpy.zeros((lower+upper+1,n))
+    if hasattr(matrix,"tocoo"):
+        # Entry (i,j) is stored at [upper+i-j,j]; tocsr sums duplicate entries
+        coo = matrix.tocsr().tocoo()
+        result[upper+coo.row-coo.col,coo.col] = coo.data
+        return result
+    for offset in range(-lower,upper+1):
+        diagonal = numpy.diagonal(matrix,offset)
+        if offset >= 0:
+            result[upper-offset,offset:] = diagonal
+        else:
+            result[upper-offset,:n+offset] = diagonal
+    return result
+
+class SparseResponse(object):
+    """
+    Square response matrix stored as banded, sparse (CSR), or dense,
+    whichever is the most compact that applies
+
+    The state is numpy arrays, so it can be pickled and shared with worker
+    processes like the other decompositions, except the sparse LU
+    factorization, which isn't picklable and is redone once on first use
+    after unpickling.
+    """
+
+    def __init__(self,response,maxBandFraction=0.25,maxDensity=0.1,kind=None):
+        """
+        Inputs:
+            response: numpy array or scipy.sparse matrix (n,n); a sparse one is
+                never densified unless stored dense
+            maxBandFraction: banded storage is used if the number of stored
+                diagonals is at most this fraction of n
+            maxDensity: otherwise, CSR storage is used if the fraction of
+                non-zero entries is at most this
+            kind: force "banded", "sparse", or "dense" instead of detecting it
+        """
+        if hasattr(response,"tocsr"):
+            response = response.tocsr().astype(numpy.float64)
+            nNonzero = response.count_nonzero()
+        else:
+            response = numpy.asarray(response,dtype=numpy.float64)
+            nNonzero = numpy.count_nonzero(response)
+        if response.ndim != 2 or response.shape[0] != response.shape[1]:
+            raise ValueError("response must be a square matrix",response.shape)
+        n = response.shape[0]
+        lower, upper = getBandwidths(response)
+        if kind is None:
+            if _scipy() is None:
+                kind = "dense"
+            elif lower+upper+1 <= maxBandFraction*n:
+                kind = "banded"
+            elif nNonzero <= maxDensity*n*n:
+                kind = "sparse"
+            else:
+                kind = "dense"
+        elif not (kind in ("banded","sparse","dense")):
+            raise ValueError("kind must be 'banded', 'sparse', or 'dense'",kind)
+        elif kind != "dense" and _scipy() is None:
+            raise ImportError("scipy is needed for banded and sparse responses")
+
+        self.kind = kind
+        self.n = n
+        self.bandwidths = (lower,upper)
+        if kind == "banded":
+            self.banded = toBanded(response,lower,upper)
+        elif kind == "sparse":
+            csr = _scipy()[1].csr_matrix(response)
+            self.data = csr.data
+            self.indices = csr.indices
+            self.indptr = csr.indptr
+            self._splu = self._factorize()
+        else:
+            self.dense = response.toarray() if hasattr(response,"toarray") else response
+            if not (_scipy() is None):
+                self.lu, self.pivots = _scipy()[0].lu_factor(self.dense,check_finite=False)
+
+    def getStoredBytes(self):
+        """
+        Returns the number of bytes used to store the response
+        """
+        if self.kind == "banded":
+            return self.banded.nbytes
+        if self.kind == "sparse":
+            return self.data.nbytes+self.indices.nbytes+self.indptr.nbytes
+        return self.dense.nbytes
+
+    @property
+    def nbytes(self):
+        """
+        Number of bytes of all the arrays held, the response and its
+        factorization, as counted by cache.DecompositionCache
+        """
+        result = self.getStoredBytes()
+        if hasattr(self,"lu"):
+            result += self.lu.nbytes+self.pivots.nbytes
+        if not (getattr(self,"_splu",None) is None):
+            # Values and row indices of L and U, and their permutations
+            result += self._splu.nnz*(8+4)+4*self.n*2
+        return result
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop("_splu",None)
+        return state
+
+    def _csr(self):
+        return _scipy()[1].csr_matrix((self.data,self.indices,self.indptr),shape=(self.n,self.n))
+
+    def _factorize(self):
+        return _scipy()[2].splu(self._csr().tocsc())
+
+    def _getSplu(self):
+        """
+        Returns the sparse LU factorization, redoing it if it was dropped when pickled
+        """
+        if getattr(self,"_splu",None) is None:
+            self._splu = self._factorize()
+        return self._splu
+
+    def toDense(self):
+        """
+        Returns the response as a dense numpy array
+        """
+        if self.kind == "banded":
+            lower, upper = self.bandwidths
+            result = numpy.zeros((self.n,self.n))
+            for offset in range(-lower,upper+1):
+                row = self.banded[upper-offset]
+                diagonal = row[offset:] if offset >= 0 else row[:self.n+offset]
+                result += numpy.diag(diagonal,offset)
+            return result
+        if self.kind == "sparse":
+            return self._csr().toarray()
+        return self.dense.copy()
+
+    def dot(self,x):
+        """
+        Returns response . x for x of shape (n,) or (n,k)
+        """
+        if self.kind == "sparse":
+            return self._csr().dot(x)
+        if self.kind == "banded":
+            x = numpy.asarray(x,dtype=numpy.float64)
+            lower, upper = self.bandwidths
+            result = numpy.zeros(x.shape)
+            for offset in range(-lower,upper+1):
+                row = self.banded[upper-offset]
+                if offset >= 0:
+                    diagonal = row[offset:]
+                    result[:self.n-offset] += (diagonal*x[offset:].T).T
+                else:
+                    diagonal = row[:self.n+offset]
+                    result[-offset:] += (diagonal*x[:self.n+offset].T).T
+            return result
+        return self.dense.dot(x)
+
+    def _transposedBanded(self):
+        """
+        Returns the banded storage of the transposed response
+        """
+        lower, upper = self.bandwidths
+        result = numpy.zeros(self.banded.shape)
+        for offset in range(-lower,upper+1):
+            # Diagonal offset of the response is diagonal -offset of its transpose
+            row = self.banded[upper-offset]
+            if offset >= 0:
+                result[lower+offset,:self.n-offset] = row[offset:]
+            else:
+                result[lower+offset,-offset:] = row[:self.n+offset]
+        return result
+
+    def solve(self,b,transpose=False):
+        """
+        Solves response . x = b for x
+        Inputs:
+            b: numpy array (n,) or (n,k)
+            transpose: if True, solve response^T . x = b instead
+        Outputs:
+            numpy array with the shape of b
+        """
+        b = numpy.asarray(b,dtype=numpy.float64)
+        if self.kind == "banded":
+            if transpose:
+                lower, upper = self.bandwidths
+                return _scipy()[0].solve_banded((upper,lower),self._transposedBanded(),b,check_finite=False)
+            return _scipy()[0].solve_banded(self.bandwidths,self.banded,b,check_finite=False)
+        if self.kind == "sparse":
+            return self._getSplu().solve(b,trans="T" if transpose else "N")
+        if hasattr(self,"lu"):
+            return _scipy()[0].lu_solve((self.lu,self.pivots),b,trans=1 if transpose else 0,check_finite=False)
+        return numpy.linalg.solve(self.dense.T if transpose else self.dense,b)
+
+    def getConditionNumber(self):
+        """
+        Returns the 1-norm condition number of the response. With scipy it
+        is estimated from solves (Hager-Higham), without forming the inverse.
+        """
+        if self.kind == "sparse":
+            norm = abs(self._csr()).sum(axis=0).max()
+        elif self.kind == "banded":
+            norm = numpy.abs(self.banded).sum(axis=0).max()
+        else:
+            norm = numpy.abs(self.dense).sum(axis=0).max()
+        if _scipy() is None:
+            return numpy.linalg.cond(self.dense,1)
+        sparseLinalg = _scipy()[2]
+        inverse = sparseLinalg.LinearOperator((self.n,self.n),dtype=numpy.float64,
+                                                matvec=lambda x: self.solve(x),
+                                                rmatvec=lambda x: self.solve(x,transpose=True))
+        try:
+            return float(norm*sparseLinalg.onenormest(inverse))
+        except (numpy.linalg.LinAlgError,ValueError,RuntimeError):
+            return numpy.inf
+
+    def propagate(self,variance,factors=None,covariance=None):
+        """
+        Returns the covariance of response^-1 . y, without forming the inverse
+        Inputs:
+            variance: numpy array (n,) uncorrelated variance of y
+            factors: optional numpy array (n,k) of correlated 1 sigma shifts of y,
+                adding factors . factors^T to its covariance
+            covariance: optional numpy array (n,n) full covariance of y,
+                used instead of variance and factors
+        Outputs:
+            numpy array (n,n)
+        """
+        if not (covariance is None):
+            # response^-1 V response^-T = response^-1 (response^-1 V)^T, as V is symmetric
+            return self.solve(self.solve(covariance).T)
+        # response^-1 diag(sigma) is solved for directly from the columns of
+        # diag(sigma), skipping bins without variance, so neither the inverse
+        # nor the diagonal covariance is formed
+        sigma = numpy.sqrt(numpy.abs(variance))
+        nonzero = numpy.flatnonzero(sigma)
+        columns = numpy.zeros((self.n,len(nonzero)))
+        columns[nonzero,numpy.arange(len(nonzero))] = sigma[nonzero]
+        scaled = self.solve(columns)
+        result = scaled.dot(scaled.T)
+        if not (factors is None):
+            correlated = self.solve(factors)
+            result += correlated.dot(correlated.T)
+        return result
@@ -0,0 +1,149 @@
+"""
+SVD (Hocker-Kartvelishvili) implementation of the Unfolding class in numpy
+
+Follows the algorithm of ROOT TSVDUnfold without needing ROOT.
+"""
+
+import numpy
+import profiling
+from unfold_base import Unfolding
+
+def curvatureMatrix(nBins,epsilon=1e-3):
+    """
+    Returns the square second-derivative matrix used by Hocker-Kartvelishvili,
+    with epsilon added to the diagonal so it can be inverted
+    """
+    result = numpy.zeros((nBins,nBins))
+    iBins = numpy.arange(nBins)
+    result[iBins[1:],iBins[:-1]] = 1.
+    result[iBins[:-1],iBins[1:]] = 1.
+    result[iBins,iBins] = -2.
+    result[0,0] = -1.
+    result[-1,-1] = -1.
+    result[iBins,iBins] += epsilon
+    return result
+
+def binningCurvatureMatrix(trueBinning,epsilon=1e-3):
+    """
+    Returns the Hocker-Kartvelishvili curvature matrix of a binning.Binning:
+    the second differences along each axis, between neighboring kept bins,
+    summed, so bins at the end of one row aren't coupled to the start of the
+    next in the compact index. For one unmasked axis this is curvatureMatrix.
+    """
+    nBins = trueBinning.nBins
+    result = numpy.zeros((nBins,nBins))
+    full = numpy.arange(trueBinning.nFullBins).reshape(trueBinning.shape)
+    for axis, nAxisBins in enumerate(trueBinning.shape):
+        if nAxisBins < 2:
+            continue
+        left = trueBinning.compactIndices[numpy.take(full,numpy.arange(nAxisBins-1),axis=axis).ravel()]
+        right = trueBinning.compactIndices[numpy.take(full,numpy.arange(1,nAxisBins),axis=axis).ravel()]
+        kept = (left >= 0) & (right >= 0)
+        left = left[kept]
+        right = right[kept]
+        result[left,right] += 1.
+        result[right,left] += 1.
+        numpy.subtract.at(result,(left,left),1.)
+        numpy.subtract.at(result,(right,right),1.)
+    result[numpy.diag_indices(nBins)] += epsilon
+    return result
+
+class UnfoldingSVD(Unfolding):
+    """
+    Low-level unfolding class using the Hocker-Kartvelishvili SVD method
+
+    The regularization parameter is kreg, as in TSVDUnfold: singular values
+    below the kreg'th are damped. With an N-D true binning.Binning, the
+    curvature is taken along each of its axes, see binningCurvatureMatrix.
+    """
+
+    dependsOnReconstructedVariance = True
+
+    @profiling.profiled()
+    def __init__(self,reconstructedHist,migrationMatrix,**kargs):
+        """
+        Unfolding Constructor
+        Inputs:
+            reconstructedHist: TH1 or 1D array reconstructed histogram to unfold
+            migrationMatrix: TH2 or 2D array migration matrix to use for unfolding true v reconstructed.
+                Its projection on the true axis is used as the MC truth, like xini in TSVDUnfold.
+        Keyword arguments are passed to Unfolding
+        """
+        super(UnfoldingSVD, self).__init__(reconstructedHist,migrationMatrix,**kargs)
+        if self.migration.shape[0] < self.migration.shape[1]:
+            raise Exception("migrationMatrix must have at least as many reco bins as true bins for SVD unfolding")
+        if (self.getTrueProjection() <= 0.).any():
+            raise ValueError("All true bins of migrationMatrix must have entries for SVD unfolding")
+
+    def getDecompositionInputs(self):
+        return super(UnfoldingSVD,self).getDecompositionInputs()+[self.reconstructedVariance]
+
+    def decompose(self):
+        """
+        Returns the singular value decomposition of the rescaled and
+        curvature-regularized response, which is independent of kreg,
+        computing it if it isn't cached
+        Outputs:
+            tuple of (simTrue,sigma,curvatureInverse,U,s,Vt)
+        """
+        return self.getCachedDecomposition(self._decompose)
+
+    @profiling.profiled()
+    def _decompose(self):
+        simTrue = self.getTrueProjection()
+        sigma = numpy.sqrt(self.reconstructedVariance)
+        sigma = numpy.where(sigma > 0.,sigma,1.)
+        if self.trueBinning is None:
+            curvature = curvatureMatrix(len(simTrue))
+        else:
+            curvature = binningCurvatureMatrix(self.trueBinning)
+        curvatureInverse = numpy.linalg.inv(curvature)
+        # Solve for w = x / simTrue, so the response is the migration matrix itself
+        rescaledResponse = self.getMigrationArray()/sigma[:,numpy.newaxis]
+        U, s, Vt = numpy.linalg.svd(rescaledResponse.dot(curvatureInverse),full_matrices=False)
+        return (simTrue,sigma,curvatureInverse,U,s,Vt)
+
+    def getUnfoldingMatrix(self,parameter=None):
+        """
+        Returns the SVD unfolding matrix for regularization parameter kreg
+        Inputs:
+            parameter: int kreg, between 1 and the number of true bins
+        Outputs:
+            numpy array of shape (nTrue,nReco)
+        """
+        if parameter is None:
+            raise ValueError("SVD unfolding requires the regularization parameter kreg")
+        return self.getUnfoldingMatrices([parameter])[0]
+
+    def getUnfoldingMatrices(self,parameters):
+        """
+        Returns the SVD unfolding matrices for a list of kreg, all from the
+        same decomposition
+        Inputs:
+            parameters: list of int kreg, each between 1 and the number of true bins
+        Outputs:
+            numpy array of shape (nParameters,nTrue,nReco)
+        """
+        simTrue, sigma, curvatureInverse, U, s, Vt = self.decompose()
+        kregs = numpy.array(parameters,dtype=int)
+        if (kregs < 1).any() or (kregs > len(s)).any():
+            raise ValueError("kreg must be between 1 and {}".format(len(s)),parameters)
+        taus = s[kregs-1]**2
+        filterFactors = s/(s**2+taus[:,numpy.newaxis])
+        left = simTrue[:,numpy.newaxis]*curvatureInverse.dot(Vt.T)
+        right = U.T/sigma
+        return numpy.matmul(left*filterFactors[:,numpy.newaxis,:],right)
+
+if __name__ == "__main__":
+
+    from utilities import *
+    getROOT().gROOT.SetBatch(True)
+
+    trueDataHist, recoDataHist, trueMCHist, recoMCHist, migrationMatrix = CreateFakeData(2000,30000,10,10,0,0)
+
+    u = UnfoldingSVD(recoDataHist,migrationMatrix)
+    u.plotReconstructedHist("testNumpySVDReco.png")
+    u.plotMigrationMatrix("testNumpySVDMigrate.png")
+    r = u.unfold(5)
+    r.plotResult("testNumpySVDFinal.png")
+    r.plotCovarianceMatrix("testNumpySVDFinalCov.png")
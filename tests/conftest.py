@@ -0,0 +1,35 @@
+"""
+Shared setup of the regression tests: the package modules are flat, so the
+repository root is put on the path, and a fresh decomposition cache is used
+for every test so results don't depend on the test order.
+"""
+
+import os
+import sys
+import numpy
+import pytest
+
+sys.path.insert(0,os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cache
+from utilities import CreateFakeDataArrays
+
+@pytest.fixture(autouse=True)
+def freshCache():
+    previousCache = cache.getDefaultCache()
+    cache.setDefaultCache(cache.DecompositionCache())
+    yield cache.getDefaultCache()
+    cache.setDefaultCache(previousCache)
+
+def makeProblem(nBins=12,smearing=0.1,seed=1,nData=20000,nMC=300000):
+    """
+    Returns (reconstructed, migration, binEdges) of a fake dataset from
+    utilities.CreateFakeDataArrays
+    """
+    dataBuilder, mcBuilder = CreateFakeDataArrays(nData,nMC,nBins,nBins,smearing,smearing,
+                                                    rng=numpy.random.default_rng(seed))
+    return dataBuilder.getRecoHist(), mcBuilder.getMigrationMatrix(), mcBuilder.trueBinEdges
+
+@pytest.fixture
+def problem():
+    return makeProblem()
@@ -0,0 +1,19 @@
+"""
+Helpers shared by the regression tests
+"""
+
+import numpy
+
+def finiteDifferenceJacobian(function,y,relativeStep=1e-6):
+    """
+    Returns the central-difference Jacobian d function(y) / dy
+    """
+    columns = []
+    for i in range(len(y)):
+        step = relativeStep*max(abs(y[i]),1.)
+        up = y.copy()
+        down = y.copy()
+        up[i] += step
+        down[i] -= step
+        columns.append((function(up)-function(down))/(2.*step))
+    return numpy.array(columns).T
@@ -0,0 +1,45 @@
+"""
+Unfolding.unfoldBatch compared with unfolding each spectrum alone
+"""
+
+import numpy
+import pytest
+from matrixinverse import UnfoldingMatrixInverse
+from svdunfold import UnfoldingSVD
+from tikhonov import UnfoldingTikhonov
+from iterativebayes import UnfoldingIterativeBayes
+
+techniques = [(UnfoldingMatrixInverse,None),(UnfoldingSVD,5),(UnfoldingTikhonov,1e-3),(UnfoldingIterativeBayes,4)]
+
+def makeSpectra(reconstructed,nSpectra=5,seed=3):
+    rng = numpy.random.default_rng(seed)
+    # Different scales, so variance-weighted techniques get different weights for each
+    scales = rng.uniform(0.5,2.,(nSpectra,1))
+    return rng.poisson(reconstructed*scales).astype(numpy.float64)
+
+@pytest.mark.parametrize("unfoldingClass,parameter",techniques)
+def test_batchMatchesSingleUnfolds(problem,unfoldingClass,parameter,freshCache):
+    reconstructed, migration, binEdges = problem
+    unfolding = unfoldingClass(reconstructed,migration)
+    spectra = makeSpectra(reconstructed)
+    variances = spectra*numpy.random.default_rng(4).uniform(0.8,1.2,spectra.shape)
+    unfolding.unfold(parameter)
+    nCached = len(freshCache)
+    batchResult = unfolding.unfoldBatch(spectra,parameter,variances)
+    # The per-spectrum factorizations aren't kept
+    assert len(freshCache) == nCached
+    for iSpectrum, (y, variance) in enumerate(zip(spectra,variances)):
+        unfoldResult = unfolding.withReconstructed(y,variance).unfold(parameter)
+        numpy.testing.assert_allclose(batchResult.results[iSpectrum],unfoldResult.result,rtol=1e-8)
+        numpy.testing.assert_allclose(batchResult.covariances[iSpectrum],unfoldResult.covariance,
+                                        rtol=1e-7,atol=1e-9*numpy.abs(unfoldResult.covariance).max())
+        numpy.testing.assert_allclose(batchResult.getResult(iSpectrum).result,unfoldResult.result,rtol=1e-8)
+
+def test_batchOfHistogramList(problem):
+    reconstructed, migration, binEdges = problem
+    unfolding = UnfoldingSVD(reconstructed,migration)
+    spectra = makeSpectra(reconstructed,3)
+    fromList = unfolding.unfoldBatch(list(spectra),5)
+    fromArray = unfolding.unfoldBatch(spectra,5)
+    numpy.testing.assert_allclose(fromList.results,fromArray.results,rtol=1e-12)
+    assert fromArray.getErrorArrays().shape == (3,len(binEdges)-1)
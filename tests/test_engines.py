@@ -0,0 +1,72 @@
+"""
+The numpy unfolding engines compared with a direct dense solve of the
+problem each solves, and their propagated covariances with finite-difference
+Jacobians
+"""
+
+import numpy
+import pytest
+from conftest import makeProblem
+from helpers import finiteDifferenceJacobian
+from matrixinverse import UnfoldingMatrixInverse
+from svdunfold import UnfoldingSVD, curvatureMatrix
+from tikhonov import UnfoldingTikhonov
+
+def test_matrixInverseMatchesDenseSolve(problem):
+    reconstructed, migration, binEdges = problem
+    unfolding = UnfoldingMatrixInverse(reconstructed,migration)
+    result = unfolding.unfold()
+    response = unfolding.getResponseMatrix()
+    inverse = numpy.linalg.inv(response)
+    numpy.testing.assert_allclose(result.result,numpy.linalg.solve(response,reconstructed),rtol=1e-9)
+    numpy.testing.assert_allclose(result.covariance,(inverse*reconstructed).dot(inverse.T),rtol=1e-8,atol=1e-8)
+
+@pytest.mark.parametrize("tau",[0.,1e-3,1.,10.])
+@pytest.mark.parametrize("seed",[1,2])
+def test_tikhonovMatchesLeastSquares(tau,seed):
+    reconstructed, migration, binEdges = makeProblem(nBins=40,smearing=0.5,seed=seed)
+    unfolding = UnfoldingTikhonov(reconstructed,migration,recoBinEdges=binEdges,trueBinEdges=binEdges)
+    response = unfolding.getResponseMatrix()
+    regularization = unfolding.getRegularizationMatrix()
+    # Least squares of the stacked system, better conditioned than the normal equations
+    sigma = numpy.sqrt(reconstructed)
+    stacked = numpy.vstack([response/sigma[:,numpy.newaxis],tau*regularization])
+    target = numpy.concatenate([reconstructed/sigma,numpy.zeros(regularization.shape[0])])
+    expected = numpy.linalg.lstsq(stacked,target,rcond=None)[0]
+    numpy.testing.assert_allclose(unfolding.unfold(tau).result,expected,rtol=1e-8)
+
+def test_tikhonovWithEmptyTrueBin(problem):
+    reconstructed, migration, binEdges = problem
+    migration = migration.copy()
+    migration[:,5] = 0.
+    unfolding = UnfoldingTikhonov(reconstructed,migration)
+    assert numpy.isfinite(unfolding.unfold(0.1).result).all()
+    with pytest.raises(numpy.linalg.LinAlgError):
+        unfolding.unfold(0.)
+
+@pytest.mark.parametrize("kreg",[2,5,12])
+def test_svdMatchesDenseSolve(problem,kreg):
+    # Hocker-Kartvelishvili: w = x/simTrue minimizes |(A w - y)/sigma|^2 + tau |C w|^2
+    # with tau the square of the kreg'th singular value of (A/sigma) C^-1
+    reconstructed, migration, binEdges = problem
+    unfolding = UnfoldingSVD(reconstructed,migration)
+    sigma = numpy.sqrt(reconstructed)
+    curvatureInverse = numpy.linalg.inv(curvatureMatrix(len(binEdges)-1))
+    rescaled = (migration/sigma[:,numpy.newaxis]).dot(curvatureInverse)
+    tau = numpy.linalg.svd(rescaled,compute_uv=False)[kreg-1]**2
+    # Least squares of the stacked system, better conditioned than the normal equations
+    nTrue = len(binEdges)-1
+    stacked = numpy.vstack([rescaled,numpy.sqrt(tau)*numpy.eye(nTrue)])
+    z = numpy.linalg.lstsq(stacked,numpy.concatenate([reconstructed/sigma,numpy.zeros(nTrue)]),rcond=None)[0]
+    expected = migration.sum(axis=0)*curvatureInverse.dot(z)
+    numpy.testing.assert_allclose(unfolding.unfold(kreg).result,expected,rtol=1e-8)
+
+@pytest.mark.parametrize("unfoldingClass,parameter",[(UnfoldingSVD,5),(UnfoldingTikhonov,1e-3)])
+def test_linearCovarianceMatchesFiniteDifferences(problem,unfoldingClass,parameter):
+    # The unfolding matrix is fixed by the nominal variance, so only the data vary
+    reconstructed, migration, binEdges = problem
+    unfolding = unfoldingClass(reconstructed,migration)
+    unfoldingMatrix = unfolding.getUnfoldingMatrix(parameter)
+    jacobian = finiteDifferenceJacobian(unfoldingMatrix.dot,reconstructed)
+    numpy.testing.assert_allclose(unfolding.unfold(parameter).covariance,(jacobian*reconstructed).dot(jacobian.T),
+                                    rtol=1e-6,atol=1e-9)
@@ -0,0 +1,70 @@
+"""
+Scans, unfolds, and toys run on each executor compared with running them serially
+"""
+
+import numpy
+import pytest
+import executors
+import toys
+from svdunfold import UnfoldingSVD
+from tikhonov import UnfoldingTikhonov
+from iterativebayes import UnfoldingIterativeBayes
+
+techniques = [(UnfoldingSVD,[2,5,8]),(UnfoldingTikhonov,[1e-4,1e-3,1e-2]),(UnfoldingIterativeBayes,[1,4,8])]
+
+def makeExecutor(kind):
+    if kind == "serial":
+        return executors.SerialExecutor()
+    if kind == "thread":
+        return executors.ThreadExecutor(2)
+    return executors.ProcessExecutor(2)
+
+@pytest.mark.parametrize("executorKind",["serial","thread","process"])
+@pytest.mark.parametrize("unfoldingClass,parameters",techniques)
+def test_executorScanMatchesScan(problem,unfoldingClass,parameters,executorKind):
+    reconstructed, migration, binEdges = problem
+    unfolding = unfoldingClass(reconstructed,migration)
+    expected = unfolding.scan(parameters)
+    with makeExecutor(executorKind) as executor:
+        scanResult = unfolding.scan(parameters,executor)
+        unfoldResults = executors.unfold(unfolding,parameters,executor)
+    numpy.testing.assert_allclose(scanResult.results,expected.results,rtol=1e-12)
+    numpy.testing.assert_allclose(scanResult.covariances,expected.covariances,rtol=1e-12,atol=1e-12)
+    for unfoldResult, result in zip(unfoldResults,expected.results):
+        numpy.testing.assert_allclose(unfoldResult.result,result,rtol=1e-9)
+
+@pytest.mark.parametrize("executorKind",["thread","process"])
+def test_toysDontDependOnExecutor(problem,executorKind):
+    reconstructed, migration, binEdges = problem
+    toyMC = toys.ToyMC(UnfoldingSVD(reconstructed,migration),5)
+    expected = executors.throwToys(toyMC,200,executors.SerialExecutor(),seed=7,nTasks=4).getCovariance()
+    with makeExecutor(executorKind) as executor:
+        covariance = executors.throwToys(toyMC,200,executor,seed=7,nTasks=4).getCovariance()
+    numpy.testing.assert_allclose(covariance,expected,rtol=1e-10)
+
+def _sumTask(context,task):
+    if task < 0:
+        raise ValueError("task failed",task)
+    return float(context.sum())*task
+
+@pytest.mark.parametrize("tasks",[[1,2,3],[1,-2,3]])
+def test_processExecutorFreesSharedMemory(monkeypatch,tasks):
+    from multiprocessing import shared_memory
+    blockNames = []
+
+    class RecordingContext(executors._SharedContext):
+        def __init__(self,context):
+            super(RecordingContext,self).__init__(context)
+            blockNames.extend(block.name for block in self.blocks)
+
+    monkeypatch.setattr(executors,"_SharedContext",RecordingContext)
+    context = numpy.ones(10000)
+    with makeExecutor("process") as executor:
+        if min(tasks) < 0:
+            with pytest.raises(ValueError):
+                executor.run(_sumTask,tasks,context)
+        else:
+            assert executor.run(_sumTask,tasks,context) == [10000.,20000.,30000.]
+    assert len(blockNames) == 1
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=blockNames[0])
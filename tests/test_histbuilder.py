@@ -0,0 +1,24 @@
+"""
+Reading event columns from files in chunks
+"""
+
+import numpy
+import pytest
+import histbuilder
+
+@pytest.mark.parametrize("save",[numpy.savez,numpy.savez_compressed])
+def test_iterateNpzInChunks(tmp_path,save):
+    rng = numpy.random.default_rng(4)
+    true = rng.random(2500)
+    reco = rng.random(2500).astype(numpy.float32)
+    weights = rng.random(2500)
+    filename = str(tmp_path/"events.npz")
+    save(filename,true=true,reco=reco,weights=weights)
+    chunks = list(histbuilder.iterateFile(filename,"true","reco","weights",chunkSize=1000))
+    assert [len(chunk[0]) for chunk in chunks] == [1000,1000,500]
+    for column, expected in zip(zip(*chunks),[true,reco,weights]):
+        numpy.testing.assert_array_equal(numpy.concatenate(column),expected)
+    chunks = list(histbuilder.iterateFile(filename,"true","reco",chunkSize=1000))
+    assert all(chunk[2] is None for chunk in chunks)
+    with pytest.raises(KeyError):
+        list(histbuilder.iterateFile(filename,"true","missing"))
@@ -0,0 +1,43 @@
+"""
+IncrementalUnfolding compared with unfolding the accumulated spectrum with
+the same unfolding matrix
+"""
+
+import numpy
+import pytest
+from matrixinverse import UnfoldingMatrixInverse
+from svdunfold import UnfoldingSVD
+from tikhonov import UnfoldingTikhonov
+
+@pytest.mark.parametrize("unfoldingClass,parameter",[(UnfoldingMatrixInverse,None),(UnfoldingSVD,5),(UnfoldingTikhonov,1e-3)])
+def test_incrementalMatchesFixedMatrixUnfold(problem,unfoldingClass,parameter):
+    reconstructed, migration, binEdges = problem
+    unfolding = unfoldingClass(reconstructed,migration)
+    incremental = unfolding.getIncrementalUnfolding(parameter)
+    unfoldingMatrix = unfolding.getUnfoldingMatrix(parameter)
+    current = reconstructed.copy()
+    rng = numpy.random.default_rng(5)
+    for iUpdate in range(4):
+        delta = rng.poisson(0.05*reconstructed).astype(numpy.float64)
+        incremental.addCounts(delta)
+        current += delta
+        if iUpdate == 1:
+            incremental.getCovarianceArray()
+    numpy.testing.assert_allclose(incremental.getResultArray(),unfoldingMatrix.dot(current),rtol=1e-10)
+    numpy.testing.assert_allclose(incremental.getCovarianceArray(),(unfoldingMatrix*current).dot(unfoldingMatrix.T),
+                                    rtol=1e-9,atol=1e-9)
+    if not unfoldingClass.dependsOnReconstructedVariance:
+        unfoldResult = unfolding.withReconstructed(current).unfold(parameter)
+        numpy.testing.assert_allclose(incremental.getResultArray(),unfoldResult.result,rtol=1e-9)
+        numpy.testing.assert_allclose(incremental.getCovarianceArray(),unfoldResult.covariance,rtol=1e-8,atol=1e-8)
+
+def test_incrementalUpdateReplacesSpectrum(problem):
+    reconstructed, migration, binEdges = problem
+    unfolding = UnfoldingMatrixInverse(reconstructed,migration)
+    incremental = unfolding.getIncrementalUnfolding()
+    incremental.getCovarianceArray()
+    replacement = 1.5*reconstructed
+    incremental.update(replacement)
+    unfoldResult = unfolding.withReconstructed(replacement).unfold()
+    numpy.testing.assert_allclose(incremental.getResultArray(),unfoldResult.result,rtol=1e-9)
+    numpy.testing.assert_allclose(incremental.getCovarianceArray(),unfoldResult.covariance,rtol=1e-8,atol=1e-8)
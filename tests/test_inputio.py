@@ -0,0 +1,56 @@
+"""
+Round trips of XsecUnfolder inputs through inputio files
+"""
+
+import numpy
+import pytest
+import binning
+import inputio
+import xsec
+
+def makeXsecUnfolder():
+    recoBinning = binning.Binning([[0.,1.,2.,3.],[0.,1.,2.]],names=["x","y"])
+    trueBinning = binning.Binning([[0.,1.,2.,3.],[0.,1.,2.]],names=["x","y"],
+                                    mask=numpy.array([[True,True],[True,True],[True,False]]))
+    rng = numpy.random.default_rng(6)
+    migration = 100.*numpy.eye(recoBinning.nBins,trueBinning.nBins)+rng.uniform(0.,5.,(recoBinning.nBins,trueBinning.nBins))
+    sideArrays = {"reconstructed": migration.sum(axis=1),"migration": migration}
+    return xsec.XsecUnfolder.fromArrays(1.,2.,sideArrays,dict(sideArrays),recoBinning,trueBinning)
+
+def test_binningRoundTrip(tmp_path):
+    xsecUnfolder = makeXsecUnfolder()
+    filename = str(tmp_path/"inputs.npz")
+    inputio.saveInputs(filename,{"channel": xsecUnfolder})
+    with inputio.InputFile(filename) as inputFile:
+        assert inputFile.getBinning("channel","recoBinning") == xsecUnfolder.recoBinning
+        trueBinning = inputFile.getBinning("channel","trueBinning")
+        assert trueBinning == xsecUnfolder.trueBinning
+        assert list(trueBinning.names) == ["x","y"]
+        numpy.testing.assert_array_equal(trueBinning.mask,xsecUnfolder.trueBinning.mask)
+        loaded = inputFile.getXsecUnfolder("channel")
+        assert loaded.trueBinning == xsecUnfolder.trueBinning
+        numpy.testing.assert_array_equal(loaded.numArrays["migration"],xsecUnfolder.numArrays["migration"])
+
+def test_extraInputsRoundTrip(tmp_path):
+    from matrixinverse import UnfoldingMatrixInverse
+
+    class UnfoldingWithSimulation(UnfoldingMatrixInverse):
+        extraInputs = ("simRecoHist","simTrueHist")
+
+        def __init__(self,reconstructedHist,migrationMatrix,simRecoHist,simTrueHist,**kargs):
+            super(UnfoldingWithSimulation,self).__init__(reconstructedHist,migrationMatrix,**kargs)
+            self.simRecoHist = simRecoHist
+            self.simTrueHist = simTrueHist
+
+    migration = 100.*numpy.eye(4)+1.
+    sideArrays = {"reconstructed": migration.sum(axis=1),"migration": migration}
+    withoutSimulation = xsec.XsecUnfolder.fromArrays(1.,2.,sideArrays,dict(sideArrays),numpy.arange(5.),numpy.arange(5.))
+    with pytest.raises(ValueError,match="simReconstructed"):
+        withoutSimulation.getUnfoldings(UnfoldingWithSimulation)
+    simArrays = dict(sideArrays,simReconstructed=migration.sum(axis=1),simTrue=migration.sum(axis=0))
+    xsecUnfolder = xsec.XsecUnfolder.fromArrays(1.,2.,simArrays,dict(simArrays),numpy.arange(5.),numpy.arange(5.))
+    filename = str(tmp_path/"inputs.npz")
+    inputio.saveInputs(filename,xsecUnfolder)
+    with inputio.InputFile(filename) as inputFile:
+        numUnfolding, denomUnfolding = inputFile.getXsecUnfolder().getUnfoldings(UnfoldingWithSimulation)
+    numpy.testing.assert_array_equal(numUnfolding.simTrueHist,migration.sum(axis=0))
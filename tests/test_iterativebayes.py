@@ -0,0 +1,31 @@
+"""
+Iterative Bayes unfolding compared with reference D'Agostini iterations,
+and its covariance with a finite-difference Jacobian
+"""
+
+import numpy
+import pytest
+from helpers import finiteDifferenceJacobian
+from iterativebayes import UnfoldingIterativeBayes
+
+def test_bayesMatchesReferenceIterations(problem):
+    reconstructed, migration, binEdges = problem
+    unfolding = UnfoldingIterativeBayes(reconstructed,migration)
+    response = unfolding.getResponseMatrix()
+    efficiency = response.sum(axis=0)
+    x = migration.sum(axis=0)
+    for nIterations in range(1,5):
+        # D'Agostini: P(true|reco) from Bayes' theorem with the current x as the prior
+        posterior = response*x/response.dot(x)[:,numpy.newaxis]
+        x = posterior.T.dot(reconstructed)/efficiency
+        numpy.testing.assert_allclose(unfolding.unfold(nIterations).result,x,rtol=1e-10)
+
+@pytest.mark.parametrize("nIterations",[1,3,8])
+def test_bayesCovarianceMatchesFiniteDifferences(problem,nIterations):
+    reconstructed, migration, binEdges = problem
+    unfolding = UnfoldingIterativeBayes(reconstructed,migration)
+    function = lambda y: unfolding.withReconstructed(y).unfold(nIterations).result
+    jacobian = finiteDifferenceJacobian(function,reconstructed)
+    expected = (jacobian*reconstructed).dot(jacobian.T)
+    covariance = unfolding.unfold(nIterations).covariance
+    numpy.testing.assert_allclose(covariance,expected,rtol=1e-5,atol=1e-6*numpy.abs(expected).max())
@@ -0,0 +1,33 @@
+"""
+Unfolding.scan compared with unfolding with each parameter alone
+"""
+
+import numpy
+import pytest
+from matrixinverse import UnfoldingMatrixInverse
+from svdunfold import UnfoldingSVD
+from tikhonov import UnfoldingTikhonov
+from iterativebayes import UnfoldingIterativeBayes
+
+techniques = [(UnfoldingMatrixInverse,[None]),(UnfoldingSVD,[2,5,8]),
+                (UnfoldingTikhonov,[1e-4,1e-3,1e-2]),(UnfoldingIterativeBayes,[1,4,8])]
+
+@pytest.mark.parametrize("unfoldingClass,parameters",techniques)
+def test_scanMatchesSingleUnfolds(problem,unfoldingClass,parameters):
+    reconstructed, migration, binEdges = problem
+    unfolding = unfoldingClass(reconstructed,migration)
+    scanResult = unfolding.scan(parameters)
+    for iParameter, parameter in enumerate(parameters):
+        unfoldResult = unfolding.unfold(parameter)
+        numpy.testing.assert_allclose(scanResult.results[iParameter],unfoldResult.result,rtol=1e-9)
+        numpy.testing.assert_allclose(scanResult.covariances[iParameter],unfoldResult.covariance,rtol=1e-8,atol=1e-8)
+
+def test_scanOptimalParameter(problem):
+    reconstructed, migration, binEdges = problem
+    parameters = numpy.logspace(-6,0,25)
+    scanResult = UnfoldingTikhonov(reconstructed,migration).scan(parameters)
+    assert scanResult.getOptimalParameter("lcurve") in parameters
+    assert scanResult.getOptimalParameter("globalcorrelation") in parameters
+    globalCorrelations = scanResult.getGlobalCorrelations()
+    assert globalCorrelations.shape == (len(parameters),len(reconstructed))
+    assert ((globalCorrelations >= 0.) & (globalCorrelations <= 1.)).all()
@@ -0,0 +1,97 @@
+"""
+SparseResponse storage kinds compared with dense solves, and matrix inverse
+unfolding with each kind compared with a dense solve
+"""
+
+import numpy
+import pytest
+from matrixinverse import UnfoldingMatrixInverse
+from sparseresponse import SparseResponse
+
+pytest.importorskip("scipy")
+
+def makeMatrix(n=30,seed=0):
+    rng = numpy.random.default_rng(seed)
+    return 2.*numpy.eye(n)+0.3*numpy.diag(rng.random(n-1),1)+0.3*numpy.diag(rng.random(n-1),-1)
+
+@pytest.mark.parametrize("responseKind",["dense","banded","sparse"])
+def test_matrixInverseResponseKinds(problem,responseKind):
+    reconstructed, migration, binEdges = problem
+    result = UnfoldingMatrixInverse(reconstructed,migration,responseKind=responseKind).unfold()
+    response = UnfoldingMatrixInverse(reconstructed,migration).getResponseMatrix()
+    inverse = numpy.linalg.inv(response)
+    numpy.testing.assert_allclose(result.result,numpy.linalg.solve(response,reconstructed),rtol=1e-9)
+    numpy.testing.assert_allclose(result.covariance,(inverse*reconstructed).dot(inverse.T),rtol=1e-8,atol=1e-8)
+
+@pytest.mark.parametrize("responseKind",["dense","banded","sparse"])
+def test_sparseResponseSolves(responseKind):
+    matrix = makeMatrix()
+    response = SparseResponse(matrix,kind=responseKind)
+    b = numpy.random.default_rng(1).random((len(matrix),3))
+    inverse = numpy.linalg.inv(matrix)
+    numpy.testing.assert_allclose(response.solve(b),inverse.dot(b),rtol=1e-12)
+    numpy.testing.assert_allclose(response.solve(b,transpose=True),inverse.T.dot(b),rtol=1e-12)
+
+@pytest.mark.parametrize("responseKind",["dense","banded","sparse"])
+def test_sparseResponsePropagates(responseKind):
+    matrix = makeMatrix()
+    rng = numpy.random.default_rng(2)
+    variance = rng.random(len(matrix))
+    factors = rng.random((len(matrix),2))
+    response = SparseResponse(matrix,kind=responseKind)
+    inverse = numpy.linalg.inv(matrix)
+    expected = inverse.dot(numpy.diag(variance)+factors.dot(factors.T)).dot(inverse.T)
+    numpy.testing.assert_allclose(response.propagate(variance,factors),expected,rtol=1e-10,atol=1e-14)
+    numpy.testing.assert_allclose(response.propagate(variance),inverse.dot(numpy.diag(variance)).dot(inverse.T),
+                                    rtol=1e-10,atol=1e-14)
+    numpy.testing.assert_allclose(response.getConditionNumber(),numpy.linalg.cond(matrix,1),rtol=1e-6)
+
+def test_matrixInverseWithFullCovariance(problem):
+    reconstructed, migration, binEdges = problem
+    rng = numpy.random.default_rng(3)
+    shifts = rng.random((len(reconstructed),2))*numpy.sqrt(reconstructed)[:,numpy.newaxis]
+    covariance = numpy.diag(reconstructed)+shifts.dot(shifts.T)
+    unfolding = UnfoldingMatrixInverse(reconstructed,migration,reconstructedCovariance=covariance)
+    inverse = numpy.linalg.inv(unfolding.getResponseMatrix())
+    numpy.testing.assert_allclose(unfolding.unfold().covariance,inverse.dot(covariance).dot(inverse.T),rtol=1e-8,atol=1e-8)
+    factorUnfolding = UnfoldingMatrixInverse(reconstructed,migration,reconstructedCovarianceFactors=shifts)
+    numpy.testing.assert_allclose(factorUnfolding.unfold().covariance,inverse.dot(covariance).dot(inverse.T),rtol=1e-8,atol=1e-8)
+
+@pytest.mark.parametrize("responseKind",["dense","banded","sparse"])
+def test_matrixInverseBatchMatchesDenseSolve(problem,responseKind):
+    reconstructed, migration, binEdges = problem
+    unfolding = UnfoldingMatrixInverse(reconstructed,migration,responseKind=responseKind)
+    spectra = numpy.random.default_rng(4).poisson(reconstructed,size=(4,len(reconstructed))).astype(numpy.float64)
+    batchResult = unfolding.unfoldBatch(spectra)
+    inverse = numpy.linalg.inv(unfolding.getResponseMatrix())
+    for y, result, covariance in zip(spectra,batchResult.results,batchResult.covariances):
+        numpy.testing.assert_allclose(result,inverse.dot(y),rtol=1e-9)
+        numpy.testing.assert_allclose(covariance,(inverse*y).dot(inverse.T),rtol=1e-8,atol=1e-8)
+
+@pytest.mark.parametrize("responseKind",["dense","banded","sparse"])
+def test_sparseResponseFromSparseMatrix(responseKind):
+    import scipy.sparse
+    matrix = makeMatrix()
+    response = SparseResponse(scipy.sparse.csr_matrix(matrix),kind=responseKind)
+    numpy.testing.assert_array_equal(response.toDense(),matrix)
+    b = numpy.random.default_rng(3).random(len(matrix))
+    numpy.testing.assert_allclose(response.solve(b),numpy.linalg.solve(matrix,b),rtol=1e-12)
+
+@pytest.mark.parametrize("unfoldingClass,parameter",[("matrixinverse.UnfoldingMatrixInverse",None),
+                            ("svdunfold.UnfoldingSVD",5),("tikhonov.UnfoldingTikhonov",1e-3),
+                            ("iterativebayes.UnfoldingIterativeBayes",4)])
+def test_sparseMigrationStaysSparse(problem,unfoldingClass,parameter):
+    import importlib
+    import scipy.sparse
+    moduleName, className = unfoldingClass.split(".")
+    unfoldingClass = getattr(importlib.import_module(moduleName),className)
+    reconstructed, migration, binEdges = problem
+    expected = unfoldingClass(reconstructed,migration).unfold(parameter)
+    unfolding = unfoldingClass(reconstructed,scipy.sparse.csr_matrix(migration))
+    assert scipy.sparse.issparse(unfolding.migration)
+    result = unfolding.unfold(parameter)
+    numpy.testing.assert_allclose(result.result,expected.result,rtol=1e-9)
+    numpy.testing.assert_allclose(result.covariance,expected.covariance,rtol=1e-8,atol=1e-8)
+    varied = unfolding.withMigration(scipy.sparse.csr_matrix(migration*1.01))
+    assert scipy.sparse.issparse(varied.migration)
+    assert varied.getDecompositionKey() != unfolding.getDecompositionKey()
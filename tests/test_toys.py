@@ -0,0 +1,53 @@
+"""
+Toy Monte Carlo and Unfolding.unfoldArrays compared with single unfolds
+and analytic covariances
+"""
+
+import numpy
+import pytest
+import toys
+from matrixinverse import UnfoldingMatrixInverse
+from svdunfold import UnfoldingSVD
+from tikhonov import UnfoldingTikhonov
+from iterativebayes import UnfoldingIterativeBayes
+
+techniques = [(UnfoldingMatrixInverse,None),(UnfoldingSVD,8),(UnfoldingTikhonov,1e-2),(UnfoldingIterativeBayes,8)]
+
+def test_runningCovarianceMatchesNumpy():
+    samples = numpy.random.default_rng(8).standard_normal((1000,6)).dot(numpy.arange(36.).reshape(6,6))
+    accumulator = toys.RunningCovariance(6)
+    other = toys.RunningCovariance(6)
+    for batch in numpy.array_split(samples[:700],5):
+        accumulator.update(batch)
+    other.update(samples[700:])
+    accumulator.merge(other)
+    numpy.testing.assert_allclose(accumulator.getMean(),samples.mean(axis=0),rtol=1e-10)
+    numpy.testing.assert_allclose(accumulator.getCovariance(),numpy.cov(samples.T),rtol=1e-10)
+
+@pytest.mark.parametrize("unfoldingClass,parameter",techniques)
+def test_unfoldArraysMatchesSingleUnfolds(problem,unfoldingClass,parameter):
+    reconstructed, migration, binEdges = problem
+    unfolding = unfoldingClass(reconstructed,migration)
+    rng = numpy.random.default_rng(4)
+    migrations = migration*(1.+0.02*rng.standard_normal((3,)+migration.shape))
+    y = numpy.tile(reconstructed,(3,1))
+    results = unfolding.unfoldArrays(y,parameter,migrations)
+    for result, variedMigration in zip(results,migrations):
+        numpy.testing.assert_allclose(result,unfolding.withMigration(variedMigration).unfold(parameter).result,rtol=1e-8)
+
+def test_unfoldArraysLeavesCacheAlone(problem,freshCache):
+    reconstructed, migration, binEdges = problem
+    unfolding = UnfoldingSVD(reconstructed,migration)
+    unfolding.unfold(5)
+    nCached = len(freshCache)
+    migrations = numpy.array([migration*(1.+0.01*i) for i in range(10)])
+    unfolding.unfoldArrays(numpy.tile(reconstructed,(10,1)),5,migrations)
+    assert len(freshCache) == nCached
+
+def test_toyCovarianceMatchesPropagated(problem):
+    reconstructed, migration, binEdges = problem
+    unfolding = UnfoldingMatrixInverse(reconstructed,migration)
+    covariance = toys.ToyMC(unfolding).run(4000,seed=9).getCovariance()
+    expected = unfolding.unfold().covariance
+    # 4000 toys estimate each variance to about 2%
+    numpy.testing.assert_allclose(numpy.diag(covariance),numpy.diag(expected),rtol=0.1)
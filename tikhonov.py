@@ -0,0 +1,139 @@
+"""
+Tikhonov-regularized least squares implementation of the Unfolding class in numpy
+
+Follows ROOT TUnfoldDensity with curvature regularization of the bin-width
+normalized result, without the area constraint and without needing ROOT.
+"""
+
+import numpy
+import profiling
+from unfold_base import Unfolding
+
+class UnfoldingTikhonov(Unfolding):
+    """
+    Low-level unfolding class minimizing
+        (y - A x)^T V^-1 (y - A x) + tau^2 |L x|^2
+    where A is the response matrix, V the reconstructed covariance, and L
+    the curvature matrix. The regularization parameter is tau. The two terms
+    are diagonalized together once, so a scan over tau costs a matrix
+    product per tau, see _decompose.
+    """
+
+    dependsOnReconstructedVariance = True
+
+    @profiling.profiled()
+    def __init__(self,reconstructedHist,migrationMatrix,**kargs):
+        """
+        Unfolding Constructor
+        Inputs:
+            reconstructedHist: TH1 or 1D array reconstructed histogram to unfold
+            migrationMatrix: TH2 or 2D array migration matrix to use for unfolding true v reconstructed
+        Keyword arguments are passed to Unfolding
+        """
+        super(UnfoldingTikhonov, self).__init__(reconstructedHist,migrationMatrix,**kargs)
+        if self.migration.shape[0] < self.migration.shape[1]:
+            raise Exception("migrationMatrix must have at least as many reco bins as true bins for Tikhonov unfolding")
+        self.regularizationMatrix = self.getRegularizationMatrix()
+
+    def _getWeightVariance(self):
+        """
+        Returns the reconstructed variance weighting the residuals, 1 where it is 0
+        """
+        return numpy.where(self.reconstructedVariance > 0.,self.reconstructedVariance,1.)
+
+    def getNormalEquations(self):
+        """
+        Returns the pieces of the normal equations that don't depend on tau
+        Outputs:
+            tuple of (A^T V^-1 A, L^T L, A^T V^-1)
+        """
+        response = self.getResponseMatrix()
+        weightedResponseT = response.T/self._getWeightVariance()
+        return (weightedResponseT.dot(response),
+                self.regularizationMatrix.T.dot(self.regularizationMatrix),
+                weightedResponseT)
+
+    def getDecompositionInputs(self):
+        return super(UnfoldingTikhonov,self).getDecompositionInputs()+[self.reconstructedVariance,self.regularizationMatrix]
+
+    def decompose(self):
+        """
+        Returns the simultaneous diagonalization of A^T V^-1 A and L^T L,
+        which is independent of tau, computing it if it isn't cached
+        Outputs:
+            tuple of (Z,mu,nu,Z^T A^T V^-1), see _decompose
+        """
+        return self.getCachedDecomposition(self._decompose)
+
+    @profiling.profiled()
+    def _decompose(self):
+        # Generalized eigenvectors Z of F = A^T V^-1 A and B = F + scale L^T L,
+        # which diagonalize both, Z^T F Z = diag(mu) and Z^T L^T L Z = diag(nu), so
+        #     F + tau^2 L^T L = Z^-T diag(mu + tau^2 nu) Z^-1
+        # and each tau only rescales the columns of Z. B is invertible unless
+        # some x has A x = 0 and L x = 0, so empty true bins are fine. L^T L
+        # is scaled to F, so B is well conditioned.
+        fisherMatrix, regularization, weightedResponseT = self.getNormalEquations()
+        regularizationTrace = numpy.trace(regularization)
+        scale = numpy.trace(fisherMatrix)/regularizationTrace if regularizationTrace > 0. else 1.
+        try:
+            cholesky = numpy.linalg.cholesky(fisherMatrix+scale*regularization)
+        except numpy.linalg.LinAlgError:
+            raise numpy.linalg.LinAlgError("A^T V^-1 A + tau^2 L^T L is singular for every tau")
+        reduced = numpy.linalg.solve(cholesky,numpy.linalg.solve(cholesky,fisherMatrix).T)
+        eigenvectors = numpy.linalg.eigh(0.5*(reduced+reduced.T))[1]
+        Z = numpy.linalg.solve(cholesky.T,eigenvectors)
+        # mu and nu from V^-1/2 A Z and L Z rather than from the eigenvalues,
+        # so the small ones, e.g. of the directions L doesn't regularize,
+        # keep their relative accuracy when multiplied by a large tau^2
+        sigma = numpy.sqrt(self._getWeightVariance())
+        mu = ((self.getResponseMatrix()/sigma[:,numpy.newaxis]).dot(Z)**2).sum(axis=0)
+        nu = (self.regularizationMatrix.dot(Z)**2).sum(axis=0)
+        return (Z,mu,nu,Z.T.dot(weightedResponseT))
+
+    def getUnfoldingMatrix(self,parameter=None):
+        """
+        Returns the Tikhonov unfolding matrix for regularization parameter tau
+        Inputs:
+            parameter: float tau >= 0, default 0 (unregularized least squares)
+        Outputs:
+            numpy array of shape (nTrue,nReco)
+        """
+        return self.getUnfoldingMatrices([0. if parameter is None else parameter])[0]
+
+    @profiling.profiled()
+    def getUnfoldingMatrices(self,parameters):
+        """
+        Returns the Tikhonov unfolding matrices for a list of tau,
+            U = (A^T V^-1 A + tau^2 L^T L)^-1 A^T V^-1
+        from the one decomposition, with a matrix product for each tau
+        instead of a solve. Only the sum needs to be invertible, so empty
+        true bins are fine for tau > 0.
+        Inputs:
+            parameters: list of float tau >= 0
+        Outputs:
+            numpy array of shape (nParameters,nTrue,nReco)
+        """
+        taus = numpy.array(parameters,dtype=numpy.float64)
+        if (taus < 0.).any():
+            raise ValueError("tau must not be negative",parameters)
+        Z, mu, nu, projectedResponseT = self.decompose()
+        eigenvalues = mu+(taus**2)[:,numpy.newaxis]*nu
+        # Z^T B Z = 1, so the eigenvalues are relative to 1
+        if (eigenvalues <= numpy.finfo(numpy.float64).eps*len(mu)).any():
+            raise numpy.linalg.LinAlgError("A^T V^-1 A + tau^2 L^T L is singular; use tau > 0 if the response matrix has empty true bins",parameters)
+        return numpy.matmul(Z/eigenvalues[:,numpy.newaxis,:],projectedResponseT)
+
+if __name__ == "__main__":
+
+    from utilities import *
+    getROOT().gROOT.SetBatch(True)
+
+    trueDataHist, recoDataHist, trueMCHist, recoMCHist, migrationMatrix = CreateFakeData(2000,30000,10,10,0,0)
+
+    u = UnfoldingTikhonov(recoDataHist,migrationMatrix)
+    u.plotReconstructedHist("testTikhonovReco.png")
+    u.plotMigrationMatrix("testTikhonovMigrate.png")
+    r = u.unfold(1e-3)
+    r.plotResult("testTikhonovFinal.png")
+    r.plotCovarianceMatrix("testTikhonovFinalCov.png")
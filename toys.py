@@ -0,0 +1,205 @@
+"""
+Toy Monte Carlo for covariance estimation and systematics propagation
+
+Toys are thrown in batches as stacked numpy arrays, unfolded together with
+Unfolding.unfoldArrays, and accumulated with a streaming covariance
+estimator, so the full set of toys is never held in memory.
+"""
+
+import numpy
+import profiling
+from unfold_base import Unfolding
+
+class RunningCovariance(object):
+    """
+    Streaming estimator of the mean and covariance of vectors, updated a
+    batch at a time (Chan et al. pairwise update)
+    """
+
+    def __init__(self,nBins):
+        """
+        Inputs:
+            nBins: int length of the vectors
+        """
+        self.count = 0
+        self.mean = numpy.zeros(nBins)
+        self.sumSquares = numpy.zeros((nBins,nBins))
+
+    def update(self,samples):
+        """
+        Adds a batch of vectors
+        Inputs:
+            samples: numpy array (nSamples,nBins)
+        """
+        samples = numpy.asarray(samples,dtype=numpy.float64)
+        nSamples = len(samples)
+        if nSamples == 0:
+            return
+        batchMean = samples.mean(axis=0)
+        centered = samples-batchMean
+        self._combine(nSamples,batchMean,centered.T.dot(centered))
+
+    def merge(self,other):
+        """
+        Adds the vectors accumulated by another RunningCovariance
+        Inputs:
+            other: RunningCovariance
+        """
+        if other.count > 0:
+            self._combine(other.count,other.mean,other.sumSquares)
+
+    def _combine(self,count,mean,sumSquares):
+        total = self.count+count
+        delta = mean-self.mean
+        self.sumSquares += sumSquares+numpy.outer(delta,delta)*(self.count*count/float(total))
+        self.mean += delta*(count/float(total))
+        self.count = total
+
+    def getMean(self):
+        return self.mean.copy()
+
+    def getCovariance(self):
+        """
+        Returns the unbiased sample covariance
+        """
+        if self.count < 2:
+            raise ValueError("At least 2 samples are needed for a covariance",self.count)
+        return self.sumSquares/(self.count-1)
+
+class ToyMC(object):
+    """
+    Throws toys of the inputs to an unfolding and accumulates the
+    covariance of the unfolded, efficiency corrected results
+
+    The unfolding's reconstructed histogram is taken to be background
+    subtracted: toy data are Poisson fluctuations of it plus the
+    backgrounds, from which fluctuated backgrounds are subtracted.
+
+    Each background's errors and each migration matrix uncertainty are one
+    systematic source, fully correlated across bins, with one Gaussian
+    variation per toy. Efficiency errors are uncorrelated between bins.
+    """
+
+    def __init__(self,unfolding,parameter=None,fluctuateData=True,
+                        efficiency=None,efficiencyErrors=None,
+                        backgrounds=[],backgroundErrors=[],
+                        migrationUncertainties=[]):
+        """
+        Inputs:
+            unfolding: Unfolding to throw toys for
+            parameter: the regularization, n-iterations, etc. input parameter
+            fluctuateData: if True, Poisson fluctuate the data
+            efficiency: optional numpy array (nTrue,) efficiency to correct the result by
+            efficiencyErrors: optional numpy array (nTrue,) 1 sigma efficiency uncertainties
+            backgrounds: list of numpy arrays (nReco,) background counts
+            backgroundErrors: list of numpy arrays (nReco,) 1 sigma background uncertainties,
+                one for each background
+            migrationUncertainties: list of numpy arrays (nReco,nTrue) relative 1 sigma
+                migration matrix uncertainties, e.g. 0.1 for 10%
+        """
+        if not isinstance(unfolding,Unfolding):
+            raise TypeError("unfolding doesn't inherit from Unfolding",type(unfolding))
+        nReco, nTrue = unfolding.migration.shape
+        if len(backgroundErrors) != len(backgrounds):
+            raise ValueError("backgroundErrors must have one entry per background")
+        if efficiency is None:
+            if not (efficiencyErrors is None):
+                raise ValueError("efficiencyErrors given without efficiency")
+            efficiency = numpy.ones(nTrue)
+        if efficiencyErrors is None:
+            efficiencyErrors = numpy.zeros(nTrue)
+
+        self.unfolding = unfolding
+        self.parameter = parameter
+        self.fluctuateData = fluctuateData
+        self.efficiency = self._checkShape(efficiency,(nTrue,),"efficiency")
+        self.efficiencyErrors = self._checkShape(efficiencyErrors,(nTrue,),"efficiencyErrors")
+        self.backgrounds = self._checkShape(numpy.reshape(backgrounds,(-1,nReco)),(len(backgrounds),nReco),"backgrounds")
+        self.backgroundErrors = self._checkShape(numpy.reshape(backgroundErrors,(-1,nReco)),(len(backgrounds),nReco),"backgroundErrors")
+        self.migrationUncertainties = self._checkShape(numpy.reshape(migrationUncertainties,(-1,nReco,nTrue)),
+                                                        (len(migrationUncertainties),nReco,nTrue),"migrationUncertainties")
+
+    @staticmethod
+    def _checkShape(a,shape,name):
+        a = numpy.array(a,dtype=numpy.float64)
+        if a.shape != shape:
+            raise ValueError("{} must have shape {}".format(name,shape),a.shape)
+        return a
+
+    def getNominal(self):
+        """
+        Returns the unfolded, efficiency corrected result without fluctuations
+        """
+        x = self.unfolding.unfoldArrays(self.unfolding.reconstructed[numpy.newaxis,:],self.parameter)[0]
+        return self._correctEfficiency(x,self.efficiency)
+
+    @staticmethod
+    def _correctEfficiency(x,efficiency):
+        return x/numpy.where(efficiency != 0.,efficiency,1.)*(efficiency != 0.)
+
+    def throwBatch(self,nToys,rng):
+        """
+        Throws and unfolds one batch of toys
+        Inputs:
+            nToys: int number of toys
+            rng: numpy.random.Generator
+        Outputs:
+            numpy array (nToys,nTrue) of unfolded, efficiency corrected toys
+        """
+        unfolding = self.unfolding
+        nBackgrounds = len(self.backgrounds)
+        totalBackground = self.backgrounds.sum(axis=0)
+        observed = unfolding.reconstructed+totalBackground
+        if self.fluctuateData:
+            y = rng.poisson(numpy.clip(observed,0.,None),size=(nToys,len(observed))).astype(numpy.float64)
+        else:
+            y = numpy.tile(observed,(nToys,1))
+        y -= totalBackground
+        if nBackgrounds > 0:
+            y -= rng.standard_normal((nToys,nBackgrounds)).dot(self.backgroundErrors)
+
+        migrations = None
+        if len(self.migrationUncertainties) > 0:
+            variations = rng.standard_normal((nToys,len(self.migrationUncertainties)))
+            relative = numpy.tensordot(variations,self.migrationUncertainties,axes=1)
+            migrations = numpy.clip(unfolding.getMigrationArray()*(1.+relative),0.,None)
+
+        x = unfolding.unfoldArrays(y,self.parameter,migrations)
+        efficiency = self.efficiency+rng.standard_normal((nToys,len(self.efficiency)))*self.efficiencyErrors
+        return self._correctEfficiency(x,efficiency)
+
+    @profiling.profiled()
+    def run(self,nToys,batchSize=256,seed=None,accumulator=None,executor=None,store=None,firstTag=0):
+        """
+        Throws nToys toys in batches and accumulates their covariance
+        Inputs:
+            nToys: int number of toys
+            batchSize: int maximum number of toys held in memory at once
+            seed: seed for numpy.random.default_rng
+            accumulator: optional RunningCovariance to add to
+            executor: optional executors.SerialExecutor, ThreadExecutor, or
+                ProcessExecutor to split the toys across, see executors.throwToys
+            store: optional resultstore.ResultStore, without covariances, to append
+                every toy to, tagged with its toy number
+            firstTag: int toy number of the first toy
+        Outputs:
+            RunningCovariance of the unfolded, efficiency corrected toys
+        """
+        if accumulator is None:
+            accumulator = RunningCovariance(len(self.efficiency))
+        if not (executor is None):
+            import executors
+            accumulator.merge(executors.throwToys(self,nToys,executor,seed=seed,batchSize=batchSize,
+                                                    store=store,firstTag=firstTag))
+            return accumulator
+        rng = numpy.random.default_rng(seed)
+        nThrown = 0
+        while nThrown < nToys:
+            nBatch = min(batchSize,nToys-nThrown)
+            toys = self.throwBatch(nBatch,rng)
+            accumulator.update(toys)
+            if not (store is None):
+                store.append(toys,parameters=[self.parameter]*nBatch,
+                                tags=numpy.arange(firstTag+nThrown,firstTag+nThrown+nBatch))
+            nThrown += nBatch
+        return accumulator
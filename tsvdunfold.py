@@ -4,52 +4,91 @@ TSVDUnfold implementation of the Unfolding class
 
 import ROOT
 from unfold_base import Unfolding, UnfoldResult
-from utilities import cloneTNamedUUIDName
+from utilities import sameBinEdges
+from rootadapter import histBinEdges, histToArray, histErrorsToArray, makeHist, makeHist2D, detach
+import numpy
+import profiling
+
+def _simArrays(hist,binEdges,name,axisName):
+    """
+    Returns the contents and errors of a simulation TH1 or 1D array,
+    checking its binning against binEdges
+    """
+    if isinstance(hist,ROOT.TH1):
+        if isinstance(hist,ROOT.TH2) or isinstance(hist,ROOT.TH3):
+            raise NotImplementedError(name+" has more than 1 dimension, N-D unfolding isn't implemented for TSVDUnfold")
+        if not sameBinEdges(histBinEdges(hist),binEdges):
+            raise ValueError("{} binning doesn't match migrationMatrix {} binning".format(name,axisName))
+        return histToArray(hist), histErrorsToArray(hist)
+    try:
+        contents = numpy.array(hist,dtype=numpy.float64)
+    except (TypeError,ValueError):
+        raise TypeError(name+" must be a TH1 or an array",type(hist))
+    if contents.shape != (len(binEdges)-1,):
+        raise ValueError("{} must have {} bins like the migrationMatrix {}".format(name,len(binEdges)-1,axisName),contents.shape)
+    return contents, numpy.sqrt(numpy.abs(contents))
 
 class UnfoldingTSVDUnfold(Unfolding):
     """
     Low-level unfolding class using ROOTi TSVDUnfold 
     """
 
-    def __init__(self,reconstructedHist,migrationMatrix,simRecoHist,simTrueHist):
+    # Inputs needed besides the reconstructed histogram and migration matrix
+    extraInputs = ("simRecoHist","simTrueHist")
+
+    @profiling.profiled()
+    def __init__(self,reconstructedHist,migrationMatrix,simRecoHist,simTrueHist,**kargs):
         """
         Unfolding Constructor
         Inputs:
-            reconstructedHist: TH1 reconstructed histogram to unfold
-            migrationMatrix: TH2 migration matrix to use for unfolding true v reconstructed
-            simRecoHist: TH1 reconstructed simulation histogram corrosponding to simTrueHist and migrationMatrix
-            simTrueHist: TH1 true simulation histogram corresponding to simTrueHist and migrationMatrix
+            reconstructedHist: TH1 or 1D array reconstructed histogram to unfold
+            migrationMatrix: TH2 or 2D array migration matrix to use for unfolding true v reconstructed
+            simRecoHist: TH1 or 1D array reconstructed simulation histogram corrosponding to simTrueHist and migrationMatrix
+            simTrueHist: TH1 or 1D array true simulation histogram corresponding to simTrueHist and migrationMatrix;
+                arrays have errors sqrt(|contents|), like reconstructedHist
+        Keyword arguments are passed to Unfolding
         """
-        super(UnfoldingTSVDUnfold, self).__init__(reconstructedHist,migrationMatrix)
-
-        if not isinstance(simRecoHist,ROOT.TH1):
-            raise TypeError("simRecoHist doesn't inherit from TH1",type(simRecoHist))
-        if isinstance(simRecoHist,ROOT.TH2):
-            raise NotImplementedError("simRecoHist inherits from TH2, 2D unfolding not yet implemented")
-        if not isinstance(simTrueHist,ROOT.TH1):
-            raise TypeError("simTrueHist doesn't inherit from TH1",type(simTrueHist))
-        if isinstance(simTrueHist,ROOT.TH2):
-            raise NotImplementedError("simTrueHist inherits from TH2, 2D unfolding not yet implemented")
-
-
-        if not isinstance(reconstructedHist,ROOT.TH1D):
-            raise TypeError("reconstructedHist must be TH1D not",type(reconstructedHist))
-        if not isinstance(migrationMatrix,ROOT.TH2D):
-            raise TypeError("migrationMatrix must be TH2D not",type(migrationMatrix))
-        if not isinstance(simRecoHist,ROOT.TH1D):
-            raise TypeError("simRecoHist must be TH1D not",type(simRecoHist))
-        if not isinstance(simTrueHist,ROOT.TH1D):
-            raise TypeError("simTrueHist must be TH1D not",type(simTrueHist))
+        super(UnfoldingTSVDUnfold, self).__init__(reconstructedHist,migrationMatrix,**kargs)
 
+        simReco, simRecoErrors = _simArrays(simRecoHist,self.recoBinEdges,"simRecoHist","x-axis (reco)")
+        simTrue, simTrueErrors = _simArrays(simTrueHist,self.trueBinEdges,"simTrueHist","y-axis (true)")
         self.simRecoHist = simRecoHist
         self.simTrueHist = simTrueHist
+        # TSVDUnfold needs TH1D/TH2D inputs, so they're made from the core
+        # arrays, which also leaves out the underflow/overflow bins
+        self.simRecoHistNoFlow = makeHist(simReco,self.recoBinEdges,errors=simRecoErrors)
+        self.simTrueHistNoFlow = makeHist(simTrue,self.trueBinEdges,errors=simTrueErrors)
+        self.makeTSVDUnfold()
 
+    @profiling.profiled()
+    def makeTSVDUnfold(self):
+        """
+        Makes the TSVDUnfold object from the current reconstructed histogram
+        and migration matrix
+        """
+        reconstructedHist = makeHist(self.reconstructed,self.recoBinEdges,
+                                        errors=numpy.sqrt(self.reconstructedVariance))
+        migrationMatrix = makeHist2D(self.getMigrationArray(),self.recoBinEdges,self.trueBinEdges)
+        # TSVDUnfold keeps pointers to its inputs, so they must stay alive with it
+        self.tsvdunfoldInputs = (reconstructedHist,migrationMatrix)
         self.tsvdunfold = ROOT.TSVDUnfold(reconstructedHist,
-                                            simRecoHist,
-                                            simTrueHist,
+                                            self.simRecoHistNoFlow,
+                                            self.simTrueHistNoFlow,
                                             migrationMatrix
                                         )
-        
+
+    def withReconstructed(self,reconstructed,reconstructedVariance=None,decompositionCache=None):
+        # TSVDUnfold takes the data in its constructor, so make a new one
+        result = super(UnfoldingTSVDUnfold,self).withReconstructed(reconstructed,reconstructedVariance,decompositionCache)
+        result.makeTSVDUnfold()
+        return result
+
+    def withMigration(self,migration,decompositionCache=None):
+        result = super(UnfoldingTSVDUnfold,self).withMigration(migration,decompositionCache)
+        result.makeTSVDUnfold()
+        return result
+
+    @profiling.profiled()
     def unfold(self,parameter=None):
         """
         Method to unfold with regularization, n-iterations, etc. input parameter
@@ -59,9 +98,9 @@ class UnfoldingTSVDUnfold(Unfolding):
             UnfoldResult
         """
 
-        super(UnfoldingTSVDUnfold,self).unfold(parameter)
-        resultHist = self.tsvdunfold.Unfold(parameter)
-        covarianceMatrix = self.tsvdunfold.GetXtau()
+        # The caller owns the histograms TSVDUnfold returns; they're only converted to arrays
+        resultHist = detach(self.tsvdunfold.Unfold(parameter))
+        covarianceMatrix = detach(self.tsvdunfold.GetXtau())
         result = UnfoldResult(self, resultHist, covarianceMatrix, parameter)
         return result
 
@@ -2,29 +2,102 @@
 Implemenation of low-level unfolding class using ROOT TUnfold
 """
 
-import uuid
+import threading
 import ROOT
 from unfold_base import Unfolding, UnfoldResult
-from utilities import cloneTNamedUUIDName
+import numpy
+import profiling
+from rootadapter import makeHist, makeHist2D, detach
+from utilities import uniqueName, getObjectManager
+
+class _TUnfoldPerThread(object):
+    """
+    A TUnfoldDensity for each thread, all set up from the same migration
+    matrix. The input is set on the TUnfoldDensity itself, so unfoldings
+    sharing one through the decomposition cache can only unfold concurrently
+    on different instances.
+    """
+
+    def __init__(self,migrationMatrixNoFlow):
+        self.migrationMatrixNoFlow = migrationMatrixNoFlow
+        self.local = threading.local()
+
+    def get(self):
+        """
+        Returns the calling thread's TUnfoldDensity, making it on first use
+        """
+        tunfold = getattr(self.local,"tunfold",None)
+        if tunfold is None:
+            tunfold = ROOT.TUnfoldDensity(self.migrationMatrixNoFlow,ROOT.TUnfold.kHistMapOutputVert)
+            self.local.tunfold = tunfold
+        return tunfold
 
 class UnfoldingTUnfold(Unfolding):
     """
     Unfolding using ROOT TUnfold class
     """
 
-    def __init__(self,reconstructedHist,migrationMatrix):
-        super(UnfoldingTUnfold, self).__init__(reconstructedHist,migrationMatrix)
-        ### Be careful of underflow/overflow bins, may want to set to zero for all?
-        self.tunfold = ROOT.TUnfoldDensity(cloneTNamedUUIDName(migrationMatrix),ROOT.TUnfold.kHistMapOutputVert)
-        errCode = self.tunfold.SetInput(cloneTNamedUUIDName(reconstructedHist))
+    @profiling.profiled()
+    def __init__(self,reconstructedHist,migrationMatrix,**kargs):
+        """
+        Unfolding Constructor
+        Inputs:
+            reconstructedHist: TH1 or 1D array reconstructed histogram to unfold
+            migrationMatrix: TH2 or 2D array migration matrix to use for unfolding true v reconstructed
+        Keyword arguments are passed to Unfolding
+        """
+        super(UnfoldingTUnfold, self).__init__(reconstructedHist,migrationMatrix,**kargs)
+        # Built from the core arrays, so the underflow/overflow bins are zero
+        # and TUnfold doesn't treat them as extra inefficiency or background
+        self.reconstructedHistNoFlow = makeHist(self.reconstructed,self.recoBinEdges,
+                                                errors=numpy.sqrt(self.reconstructedVariance))
+        self.setInput(self.getTUnfold())
+
+    def decompose(self):
+        return self.getCachedDecomposition(self._makeTUnfold)
+
+    @profiling.profiled()
+    def _makeTUnfold(self):
+        # The TUnfoldDensity setup only depends on the migration matrix, so
+        # it's shared through the decomposition cache by unfoldings with the
+        # same one, with one instance per thread
+        migrationMatrixNoFlow = makeHist2D(self.getMigrationArray(),self.recoBinEdges,self.trueBinEdges)
+        return (_TUnfoldPerThread(migrationMatrixNoFlow),)
+
+    def getTUnfold(self):
+        """
+        Returns the calling thread's TUnfoldDensity for this migration matrix
+        """
+        return self.decompose()[0].get()
+
+    def withReconstructed(self,reconstructed,reconstructedVariance=None,decompositionCache=None):
+        result = super(UnfoldingTUnfold,self).withReconstructed(reconstructed,reconstructedVariance,decompositionCache)
+        result.reconstructedHistNoFlow = makeHist(result.reconstructed,result.recoBinEdges,
+                                                errors=numpy.sqrt(result.reconstructedVariance))
+        result.decomposition = self.decomposition
+        return result
+
+    def setInput(self,tunfold):
+        """
+        Sets this unfolding's reconstructed histogram as the input of
+        tunfold, a TUnfoldDensity from getTUnfold
+        """
+        errCode = tunfold.SetInput(self.reconstructedHistNoFlow)
         if errCode >= 10000:
             print("Warning: TUnfold doesn't think input data can make unfolding work")
 
+    @profiling.profiled()
     def unfold(self,parameter):
-        super(UnfoldingTUnfold,self).unfold(parameter)
-        self.tunfold.DoUnfold(parameter)
-        resultHist = self.tunfold.GetOutput(uuid.uuid1().hex)
-        covarianceMatrix = self.tunfold.GetEmatrixTotal(uuid.uuid1().hex)
+        # Another unfolding on this thread may have set its input on the
+        # shared TUnfoldDensity since, so it's set again; other threads have
+        # their own, e.g. for the numerator and denominator of xsec.unfoldChannels
+        tunfold = self.getTUnfold()
+        self.setInput(tunfold)
+        tunfold.DoUnfold(parameter)
+        # The caller owns the histograms TUnfold returns; they're only converted to arrays
+        objectManager = getObjectManager()
+        resultHist = objectManager.track(detach(tunfold.GetOutput(uniqueName("tunfoldOutput"))))
+        covarianceMatrix = objectManager.track(detach(tunfold.GetEmatrixTotal(uniqueName("tunfoldEmatrix"))))
         result = UnfoldResult(self,resultHist,covarianceMatrix,parameter)
         return result
 
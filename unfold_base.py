@@ -1,136 +1,1075 @@
 """
 Base classes for low-level unfolding
+
+The unfolding core works on numpy arrays plus bin edges. ROOT histograms are
+accepted as inputs and produced for plots through the rootadapter module,
+which is only imported when ROOT objects are used.
 """
 
-import ROOT
 import copy
-from utilities import cloneTNamedUUIDName, CanvasUUID, setupCOLZFrame
+import numpy
+import cache
+import binning
+import profiling
+from utilities import isTH1, isTH2, sameBinEdges, curvatureMatrix, scratchCanvas, setupCOLZFrame
+
+def _rootadapter():
+    import rootadapter
+    return rootadapter
+
+def _toArray(obj,ndim,name):
+    """
+    Converts a non-ROOT input to a float64 numpy array with ndim dimensions,
+    or any number if ndim is None
+    """
+    try:
+        result = numpy.array(obj,dtype=numpy.float64)
+    except (TypeError,ValueError):
+        raise TypeError(name+" must be a ROOT histogram or an array",type(obj))
+    if not (ndim is None) and result.ndim != ndim:
+        raise ValueError("{} must be {}D, but is {}D".format(name,ndim,result.ndim))
+    return result
+
+def _toBinEdges(binEdges,nBins,name):
+    """
+    Converts bin edges to a numpy array, defaulting to the bin indices
+    """
+    if binEdges is None:
+        return numpy.arange(nBins+1,dtype=numpy.float64)
+    binEdges = _toArray(binEdges,1,name)
+    if binEdges.shape != (nBins+1,):
+        raise ValueError("{} must have {} entries, not {}".format(name,nBins+1,len(binEdges)))
+    return binEdges
+
+def _isSparse(matrix):
+    """
+    Returns True for a scipy.sparse matrix
+    """
+    return hasattr(matrix,"tocsr")
+
+def _histBinning(hist):
+    """
+    Returns the binning.Binning of the axes of a TH1, TH2, or TH3
+    """
+    rootadapter = _rootadapter()
+    return binning.Binning([rootadapter.histBinEdges(hist,axis) for axis in "xyz"[:hist.GetDimension()]])
+
+def _flattenHistND(hist,histBinning,name):
+    """
+    Returns the contents and variances of a TH2 or TH3 flattened to the
+    compact indices of histBinning, which must have the histogram's shape
+    """
+    if histBinning is None or histBinning.shape != _histBinning(hist).shape:
+        raise ValueError("{} is a TH{}, but its binning doesn't match the unfolding's binning.Binning".format(name,hist.GetDimension()))
+    rootadapter = _rootadapter()
+    return (histBinning.flatten(rootadapter.histToArray(hist)),
+            histBinning.flatten(rootadapter.histErrorsToArray(hist)**2))
 
 class Unfolding(object):
     """
     Low-level unfolding technique base class for a single distribution
 
-    Subclass this for each unfolding technique
+    Subclass this for each unfolding technique. Linear techniques only need
+    to implement getUnfoldingMatrix, other techniques override unfold.
+
+    A scipy.sparse migration matrix is kept as a CSR matrix, and so are the
+    copies from withMigration. Matrix inverse unfolding factorizes it sparse;
+    the techniques that need the dense response densify it in their own
+    decomposition or unfold: SVD, Tikhonov, and iterative Bayes through
+    getResponseMatrix or getMigrationArray, and TSVDUnfold and TUnfold to
+    fill their ROOT histograms.
     """
 
-    def __init__(self,reconstructedHist,migrationMatrix,xAxisTitle="Kinetic Energy [MeV]",yAxisTitle="Counts / bin",titlePrefix=""):
+    # Names of constructor inputs needed besides the reconstructed histogram
+    # and migration matrix, e.g. simulation histograms, see XsecUnfolder
+    extraInputs = ()
+    # True if the unfolding matrix is weighted by the reconstructed variance
+    # (SVD, Tikhonov), so unfoldBatch factorizes each spectrum on its own, and
+    # unfoldArrays, which uses this unfolding's matrix for every spectrum,
+    # differs from unfolding each alone
+    dependsOnReconstructedVariance = False
+
+    @profiling.profiled()
+    def __init__(self,reconstructedHist,migrationMatrix,xAxisTitle="Kinetic Energy [MeV]",yAxisTitle="Counts / bin",titlePrefix="",
+                        recoBinEdges=None,trueBinEdges=None,decompositionCache=None,
+                        reconstructedCovariance=None,reconstructedCovarianceFactors=None):
         """
         Unfolding Constructor
         Inputs:
-            reconstructedHist: TH1 reconstructed histogram to unfold
-            migrationMatrix: TH2 migration matrix to use for unfolding true v reconstructed
+            reconstructedHist: TH1, TH2, TH3, or array reconstructed histogram to unfold; N-D
+                                inputs are flattened with the reco binning.Binning
+            migrationMatrix: TH2, 2D array, or scipy.sparse matrix migration matrix to use for
+                                unfolding true v reconstructed; x (first index) is reconstructed,
+                                y (second index) is true, both compact binning.Binning indices
+                                for N-D binnings. An array with the shape of the reco binning
+                                followed by the true binning is flattened.
             xAxisTitle: Title for x-axis of histograms, will have reco/true/unfolded added to it
             yAxisTitle: Title for y-axis of histograms, counts, events / bin, events / MeV etc.
+            recoBinEdges: reconstructed bin edges, only used for array inputs, or a
+                                binning.Binning for N-D inputs; default bin indices
+            trueBinEdges: true bin edges, only used for array inputs, or a
+                                binning.Binning for N-D results; default bin indices
+            decompositionCache: cache.DecompositionCache for the response factorizations,
+                default cache.getDefaultCache()
+            reconstructedCovariance: optional covariance of reconstructedHist, replacing its
+                errors: 1D array of variances, or 2D array full covariance matrix, e.g. after
+                background subtraction. Techniques weighting by the reconstructed errors
+                (SVD, Tikhonov) use its diagonal.
+            reconstructedCovarianceFactors: optional 2D array (nReco,nFactors) of fully
+                correlated 1 sigma shifts of reconstructedHist, each adding its outer
+                product to the covariance without forming the full matrix
         """
-        if not isinstance(reconstructedHist,ROOT.TH1):
-            raise TypeError("reconstructedHist doesn't inherit from TH1",type(reconstructedHist))
-        if isinstance(reconstructedHist,ROOT.TH2):
-            raise NotImplementedError("reconstructedHist inherits from TH2, 2D unfolding not yet implemented")
-        if not isinstance(migrationMatrix,ROOT.TH2):
+        recoBinning = recoBinEdges if isinstance(recoBinEdges,binning.Binning) else None
+        trueBinning = trueBinEdges if isinstance(trueBinEdges,binning.Binning) else None
+        if isTH1(reconstructedHist):
+            rootadapter = _rootadapter()
+            reconstructed = rootadapter.histToArray(reconstructedHist)
+            reconstructedVariance = rootadapter.histErrorsToArray(reconstructedHist)**2
+            if reconstructedHist.GetDimension() > 1:
+                histBinning = _histBinning(reconstructedHist)
+                if recoBinning is None:
+                    recoBinning = histBinning
+                elif recoBinning.shape != histBinning.shape:
+                    raise ValueError("reconstructedHist binning doesn't match recoBinEdges")
+            elif recoBinning is None:
+                recoBinEdges = rootadapter.histBinEdges(reconstructedHist)
+        else:
+            reconstructed = _toArray(reconstructedHist,None,"reconstructedHist")
+            reconstructedVariance = numpy.abs(reconstructed)
+        if not (recoBinning is None):
+            if reconstructed.shape == recoBinning.shape:
+                reconstructed = recoBinning.flatten(reconstructed)
+                reconstructedVariance = recoBinning.flatten(reconstructedVariance)
+            recoBinEdges = recoBinning.getFlatBinEdges()
+        if reconstructed.ndim != 1:
+            raise ValueError("reconstructedHist must be 1D, or have the shape of a binning.Binning given as recoBinEdges")
+        if isTH2(migrationMatrix):
+            rootadapter = _rootadapter()
+            migration = rootadapter.histToArray(migrationMatrix)
+            if recoBinning is None:
+                migrationRecoBinEdges = rootadapter.histBinEdges(migrationMatrix,"x")
+                if recoBinEdges is None:
+                    recoBinEdges = migrationRecoBinEdges
+                elif not sameBinEdges(migrationRecoBinEdges,recoBinEdges):
+                    raise ValueError("migrationMatrix x-axis (reco) binning doesn't match reconstructedHist binning")
+            if trueBinning is None:
+                trueBinEdges = rootadapter.histBinEdges(migrationMatrix,"y")
+        elif isTH1(migrationMatrix):
             raise TypeError("migrationMatrix doesn't inherit from TH2",type(migrationMatrix))
+        elif _isSparse(migrationMatrix):
+            # scipy.sparse matrix of compact bin indices, e.g. from binning.MultiResponseBuilder
+            migration = migrationMatrix.tocsr().astype(numpy.float64)
+        else:
+            migration = _toArray(migrationMatrix,None,"migrationMatrix")
+        if not _isSparse(migration):
+            migration = binning.flattenMigration(migration,recoBinning,trueBinning)
+        if migration.ndim != 2:
+            raise ValueError("migrationMatrix must be 2D, or have the shape of the reco binning followed by the true binning")
+        if not (trueBinning is None):
+            if migration.shape[1] != trueBinning.nBins:
+                raise ValueError("migrationMatrix has {} true bins but trueBinEdges has {}".format(migration.shape[1],trueBinning.nBins))
+            trueBinEdges = trueBinning.getFlatBinEdges()
+        elif not isTH2(migrationMatrix):
+            trueBinEdges = _toBinEdges(trueBinEdges,migration.shape[1],"trueBinEdges")
+        if migration.shape[0] != len(reconstructed):
+            raise ValueError("migrationMatrix has {} reco bins but reconstructedHist has {}".format(migration.shape[0],len(reconstructed)))
+        recoBinEdges = _toBinEdges(recoBinEdges,len(reconstructed),"recoBinEdges")
+        nReco = len(reconstructed)
+        fullCovariance = None
+        if not (reconstructedCovariance is None):
+            reconstructedCovariance = numpy.array(reconstructedCovariance,dtype=numpy.float64)
+            if not (recoBinning is None) and reconstructedCovariance.shape in (recoBinning.shape,recoBinning.shape*2):
+                reconstructedCovariance = recoBinning.flatten(reconstructedCovariance)
+                if reconstructedCovariance.ndim > 1:
+                    reconstructedCovariance = recoBinning.flatten(reconstructedCovariance,1)
+            if reconstructedCovariance.shape == (nReco,):
+                reconstructedVariance = reconstructedCovariance
+            elif reconstructedCovariance.shape == (nReco,nReco):
+                if not numpy.allclose(reconstructedCovariance,reconstructedCovariance.T):
+                    raise ValueError("reconstructedCovariance must be symmetric")
+                fullCovariance = reconstructedCovariance
+                reconstructedVariance = numpy.diag(fullCovariance).copy()
+            else:
+                raise ValueError("reconstructedCovariance must have shape {} or {}".format((nReco,),(nReco,nReco)),
+                                    reconstructedCovariance.shape)
+        if not (reconstructedCovarianceFactors is None):
+            if not (recoBinning is None) and numpy.shape(reconstructedCovarianceFactors)[:recoBinning.nAxes] == recoBinning.shape:
+                reconstructedCovarianceFactors = recoBinning.flatten(reconstructedCovarianceFactors)
+            reconstructedCovarianceFactors = _toArray(reconstructedCovarianceFactors,2,"reconstructedCovarianceFactors")
+            if reconstructedCovarianceFactors.shape[0] != nReco:
+                raise ValueError("reconstructedCovarianceFactors must have {} rows".format(nReco),reconstructedCovarianceFactors.shape)
+            if fullCovariance is None:
+                reconstructedVariance = reconstructedVariance+(reconstructedCovarianceFactors**2).sum(axis=1)
+            else:
+                fullCovariance = fullCovariance+reconstructedCovarianceFactors.dot(reconstructedCovarianceFactors.T)
+                reconstructedVariance = numpy.diag(fullCovariance).copy()
+                reconstructedCovarianceFactors = None
 
-        self.reconstructedHist = reconstructedHist
-        self.migrationMatrix = migrationMatrix
+        self.reconstructedHist = reconstructedHist if isTH1(reconstructedHist) else None
+        self.migrationMatrix = migrationMatrix if isTH2(migrationMatrix) else None
+        self.reconstructed = reconstructed
+        self.reconstructedVariance = reconstructedVariance
+        # Full covariance, or None if it is diagonal plus the low-rank factors
+        self.reconstructedCovariance = fullCovariance
+        self.reconstructedCovarianceFactors = reconstructedCovarianceFactors
+        # numpy array, or scipy.sparse CSR matrix if migrationMatrix was sparse
+        self.migration = migration
+        self.recoBinEdges = recoBinEdges
+        self.trueBinEdges = trueBinEdges
+        # binning.Binning of multidimensional inputs, None for 1D bin edges
+        self.recoBinning = recoBinning
+        self.trueBinning = trueBinning
         self.xAxisTitle = xAxisTitle
         self.yAxisTitle = yAxisTitle
         self.titlePrefix = titlePrefix
-        
+        # Subclasses may store response factorizations here; reset when the inputs change
+        self.decomposition = None
+        self.decompositionCache = decompositionCache
+
+    @profiling.profiled()
     def unfold(self,parameter=None):
         """
         Method to unfold with regularization, n-iterations, etc. input parameter
+
+        The default implementation applies getUnfoldingMatrix to the
+        reconstructed histogram and propagates its variance.
         Inputs:
             parameter: the regularization, n-iterations, etc. input parameter
         Outputs:
             UnfoldResult
         """
-        pass
+        unfoldingMatrix = self.getUnfoldingMatrix(parameter)
+        x = unfoldingMatrix.dot(self.reconstructed)
+        xCov = self.propagateCovariance(unfoldingMatrix)
+        return UnfoldResult(self,x,xCov,parameter)
+
+    def getReconstructedCovariance(self):
+        """
+        Returns the full covariance matrix of the reconstructed histogram
+        Outputs:
+            numpy array of shape (nReco,nReco)
+        """
+        if not (self.reconstructedCovariance is None):
+            return self.reconstructedCovariance.copy()
+        result = numpy.diag(self.reconstructedVariance)
+        if not (self.reconstructedCovarianceFactors is None):
+            factors = self.reconstructedCovarianceFactors
+            result += factors.dot(factors.T)-numpy.diag((factors**2).sum(axis=1))
+        return result
+
+    @profiling.profiled()
+    def propagateCovariance(self,jacobians):
+        """
+        Propagates the reconstructed covariance V through linear maps J,
+        returning J V J^T. A diagonal plus low-rank V is never formed.
+        Inputs:
+            jacobians: numpy array (...,nTrue,nReco), e.g. unfolding matrices
+        Outputs:
+            numpy array (...,nTrue,nTrue)
+        """
+        jacobiansT = numpy.swapaxes(jacobians,-1,-2)
+        if not (self.reconstructedCovariance is None):
+            return numpy.matmul(numpy.matmul(jacobians,self.reconstructedCovariance),jacobiansT)
+        factors = self.reconstructedCovarianceFactors
+        if factors is None:
+            return numpy.matmul(jacobians*self.reconstructedVariance,jacobiansT)
+        uncorrelatedVariance = self.reconstructedVariance-(factors**2).sum(axis=1)
+        result = numpy.matmul(jacobians*uncorrelatedVariance,jacobiansT)
+        correlated = numpy.matmul(jacobians,factors)
+        return result+numpy.matmul(correlated,numpy.swapaxes(correlated,-1,-2))
+
+    def getUnfoldingMatrix(self,parameter=None):
+        """
+        Method for linear techniques to return the matrix U, where
+        unfolded = U . reconstructed
+        Inputs:
+            parameter: the regularization, n-iterations, etc. input parameter
+        Outputs:
+            numpy array of shape (nTrue,nReco)
+        """
+        raise NotImplementedError("{} doesn't provide an unfolding matrix".format(type(self).__name__))
+
+    def getUnfoldingMatrices(self,parameters):
+        """
+        Returns the unfolding matrices for a list of parameters stacked
+        in one array. Override to reuse work between parameters.
+        Inputs:
+            parameters: list of regularization, n-iterations, etc. input parameters
+        Outputs:
+            numpy array of shape (nParameters,nTrue,nReco)
+        """
+        return numpy.array([self.getUnfoldingMatrix(parameter) for parameter in parameters])
+
+    def getDecompositionInputs(self):
+        """
+        Returns the list of arrays the decomposition depends on, hashed for
+        its cache key. Override if it depends on more than the migration
+        matrix and binning, e.g. the reconstructed variance.
+        """
+        return [self.migration,self.recoBinEdges,self.trueBinEdges]
+
+    def getDecompositionKey(self):
+        """
+        Returns the decomposition cache key, a hash of the technique and
+        getDecompositionInputs; unfoldings with the same key share a decomposition
+        """
+        return cache.contentKey(type(self).__name__,*self.getDecompositionInputs())
+
+    def decompose(self):
+        """
+        Computes, or takes from the cache, the factorization of the response
+        that doesn't depend on the data or parameter, for techniques that have one
+        Outputs:
+            the decomposition tuple, or None
+        """
+        return None
+
+    def getCachedDecomposition(self,compute):
+        """
+        Returns self.decomposition, taking it from the decomposition cache
+        or computing it if it isn't stored yet
+        Inputs:
+            compute: function returning the decomposition as a tuple
+        Outputs:
+            tuple with read-only numpy arrays
+        """
+        if self.decomposition is None:
+            decompositionCache = self.decompositionCache
+            if decompositionCache is None:
+                decompositionCache = cache.getDefaultCache()
+            self.decomposition = decompositionCache.getOrCompute(self.getDecompositionKey(),compute)
+        return self.decomposition
+
+    def getRegularizationMatrix(self):
+        """
+        Returns the matrix L used for the regularization term |L x|^2 of
+        the L-curve, by default the curvature of the bin-width normalized result,
+        along each axis of an N-D true binning
+        """
+        if not (self.trueBinning is None):
+            return self.trueBinning.getCurvatureMatrix()
+        return curvatureMatrix(self.trueBinEdges)
+
+    @profiling.profiled()
+    def scan(self,parameters,executor=None):
+        """
+        Unfolds with each of a list of parameters, e.g. to choose the
+        regularization parameter
+
+        Linear techniques get all of the unfolding matrices together from
+        getUnfoldingMatrices, others are unfolded one parameter at a time.
+        Inputs:
+            parameters: list of regularization, n-iterations, etc. input parameters
+            executor: optional executors.SerialExecutor, ThreadExecutor, or
+                ProcessExecutor to split the parameters across
+        Outputs:
+            ScanResult
+        """
+        parameters = list(parameters)
+        if not (executor is None):
+            import executors
+            return executors.scan(self,parameters,executor)
+        try:
+            unfoldingMatrices = self.getUnfoldingMatrices(parameters)
+        except NotImplementedError:
+            unfoldResults = [self.unfold(parameter) for parameter in parameters]
+            results = numpy.array([unfoldResult.result for unfoldResult in unfoldResults])
+            covariances = numpy.array([unfoldResult.covariance for unfoldResult in unfoldResults])
+        else:
+            results = unfoldingMatrices.dot(self.reconstructed)
+            covariances = self.propagateCovariance(unfoldingMatrices)
+        return ScanResult(self,parameters,results,covariances)
+
+    def withMigration(self,migration,decompositionCache=None):
+        """
+        Returns a shallow copy of this unfolding using a different migration
+        matrix with the same binning, e.g. a systematically varied one
+        Inputs:
+            migration: numpy array or scipy.sparse matrix of shape (nReco,nTrue)
+            decompositionCache: optional cache.DecompositionCache for the copy's
+                decomposition, e.g. one with maxEntries=0 for single-use
+                variations, default this unfolding's
+        Outputs:
+            Unfolding of the same class
+        """
+        migration = self._flattenMigration(migration)
+        if migration.shape != self.migration.shape:
+            raise ValueError("migration must have shape {}".format(self.migration.shape),migration.shape)
+        result = copy.copy(self)
+        result.migration = migration
+        result.migrationMatrix = None
+        result.decomposition = None
+        if not (decompositionCache is None):
+            result.decompositionCache = decompositionCache
+        return result
+
+    def _flattenReconstructed(self,a,axis=0):
+        """
+        Returns a with N-D reco bin axes starting at axis flattened to the
+        compact reco bin index, or a unchanged if it is already flat
+        """
+        recoBinning = self.recoBinning
+        if recoBinning is None or a.shape[axis:axis+recoBinning.nAxes] != recoBinning.shape:
+            return a
+        if recoBinning.nAxes == 1 and recoBinning.mask is None:
+            return a
+        return recoBinning.flatten(a,axis)
+
+    def _flattenMigration(self,migration):
+        """
+        Returns a migration matrix array as a 2D array of compact bin
+        indices, or a scipy.sparse matrix of them as a CSR matrix
+        """
+        if _isSparse(migration):
+            return migration.tocsr().astype(numpy.float64)
+        migration = binning.flattenMigration(_toArray(migration,None,"migration"),self.recoBinning,self.trueBinning)
+        if migration.ndim != 2:
+            raise ValueError("migration must be 2D, or have the shape of the reco binning followed by the true binning",migration.shape)
+        return migration
+
+    def withReconstructed(self,reconstructed,reconstructedVariance=None,decompositionCache=None):
+        """
+        Returns a shallow copy of this unfolding for a different
+        reconstructed spectrum with the same binning
+        Inputs:
+            reconstructed: numpy array (nReco,)
+            reconstructedVariance: optional numpy array (nReco,), default |reconstructed|
+            decompositionCache: optional cache.DecompositionCache for the copy's
+                decomposition, see withMigration
+        Outputs:
+            Unfolding of the same class
+        """
+        reconstructed = self._flattenReconstructed(_toArray(reconstructed,None,"reconstructed"))
+        if reconstructed.shape != self.reconstructed.shape:
+            raise ValueError("reconstructed must have shape {}".format(self.reconstructed.shape),reconstructed.shape)
+        if reconstructedVariance is None:
+            reconstructedVariance = numpy.abs(reconstructed)
+        reconstructedVariance = self._flattenReconstructed(_toArray(reconstructedVariance,None,"reconstructedVariance"))
+        if reconstructedVariance.shape != reconstructed.shape:
+            raise ValueError("reconstructedVariance must have shape {}".format(reconstructed.shape),reconstructedVariance.shape)
+        result = copy.copy(self)
+        result.reconstructed = reconstructed
+        result.reconstructedVariance = reconstructedVariance
+        result.reconstructedCovariance = None
+        result.reconstructedCovarianceFactors = None
+        result.reconstructedHist = None
+        result.decomposition = None
+        if not (decompositionCache is None):
+            result.decompositionCache = decompositionCache
+        return result
 
+    def getSpectraArrays(self,reconstructedHists,reconstructedVariances=None):
+        """
+        Converts a batch of reconstructed spectra to stacked arrays
+        Inputs:
+            reconstructedHists: list of TH1, TH2 or TH3 (with an N-D reco binning.Binning), or
+                1D arrays, or 2D array (nSpectra,nReco)
+            reconstructedVariances: optional 2D array (nSpectra,nReco) of variances,
+                default the squared histogram errors, or |contents| for arrays
+        Outputs:
+            reconstructed: numpy array (nSpectra,nReco)
+            reconstructedVariances: numpy array (nSpectra,nReco)
+        """
+        if isinstance(reconstructedHists,(list,tuple)) and any(isTH1(hist) for hist in reconstructedHists):
+            rootadapter = _rootadapter()
+            contents = []
+            variances = []
+            for hist in reconstructedHists:
+                if isTH1(hist) and hist.GetDimension() > 1:
+                    histContents, histVariances = _flattenHistND(hist,self.recoBinning,"reconstructedHists entry")
+                    contents.append(histContents)
+                    variances.append(histVariances)
+                elif isTH1(hist):
+                    if not sameBinEdges(rootadapter.histBinEdges(hist),self.recoBinEdges):
+                        raise ValueError("reconstructedHists binning doesn't match the reco binning")
+                    contents.append(rootadapter.histToArray(hist))
+                    variances.append(rootadapter.histErrorsToArray(hist)**2)
+                else:
+                    contents.append(self._flattenReconstructed(_toArray(hist,None,"reconstructedHists entry")))
+                    variances.append(numpy.abs(contents[-1]))
+            reconstructed = numpy.array(contents)
+            variances = numpy.array(variances)
+        else:
+            reconstructed = self._flattenReconstructed(_toArray(reconstructedHists,None,"reconstructedHists"),1)
+            variances = numpy.abs(reconstructed)
+        if reconstructed.ndim != 2 or reconstructed.shape[1:] != self.reconstructed.shape:
+            raise ValueError("reconstructedHists must have {} reco bins".format(len(self.reconstructed)),reconstructed.shape)
+        if not (reconstructedVariances is None):
+            variances = self._flattenReconstructed(_toArray(reconstructedVariances,None,"reconstructedVariances"),1)
+            if variances.shape != reconstructed.shape:
+                raise ValueError("reconstructedVariances must have shape {}".format(reconstructed.shape),variances.shape)
+        return reconstructed, variances
+
+    @profiling.profiled()
+    def unfoldBatch(self,reconstructedHists,parameter=None,reconstructedVariances=None):
+        """
+        Unfolds many reconstructed spectra that share this unfolding's
+        migration matrix, e.g. run periods or sideband selections, giving
+        the same results and covariances as unfolding each alone
+
+        Linear techniques apply one unfolding matrix to every spectrum in a
+        single matrix product, and propagate each spectrum's own variance.
+        Techniques whose unfolding matrix is weighted by the reconstructed
+        variance (SVD, Tikhonov) factorize each spectrum with its own
+        variance, then apply the stacked matrices together. Other techniques
+        unfold the spectra one at a time.
+        Inputs:
+            reconstructedHists: list of TH1 or 1D arrays, or 2D array (nSpectra,nReco)
+            parameter: the regularization, n-iterations, etc. input parameter
+            reconstructedVariances: optional 2D array (nSpectra,nReco), see getSpectraArrays
+        Outputs:
+            BatchResult
+        """
+        reconstructed, variances = self.getSpectraArrays(reconstructedHists,reconstructedVariances)
+        nReco, nTrue = self.migration.shape
+        try:
+            if self.dependsOnReconstructedVariance:
+                # A cache that keeps nothing, so the single-use factorizations
+                # don't evict the real ones from the shared cache
+                throwawayCache = cache.DecompositionCache(maxEntries=0)
+                unfoldingMatrices = numpy.array([self.withReconstructed(y,variance,throwawayCache).getUnfoldingMatrix(parameter)
+                                                    for y, variance in zip(reconstructed,variances)]).reshape(-1,nTrue,nReco)
+            else:
+                unfoldingMatrices = self.getUnfoldingMatrix(parameter)[numpy.newaxis,:,:]
+        except NotImplementedError:
+            unfoldResults = [self.withReconstructed(y,variance).unfold(parameter)
+                                for y, variance in zip(reconstructed,variances)]
+            results = numpy.array([unfoldResult.result for unfoldResult in unfoldResults]).reshape(-1,nTrue)
+            covariances = numpy.array([unfoldResult.covariance for unfoldResult in unfoldResults]).reshape(-1,nTrue,nTrue)
+        else:
+            results = numpy.matmul(unfoldingMatrices,reconstructed[:,:,numpy.newaxis])[:,:,0]
+            covariances = numpy.matmul(unfoldingMatrices*variances[:,numpy.newaxis,:],numpy.swapaxes(unfoldingMatrices,1,2))
+        return BatchResult(self,parameter,reconstructed,variances,results,covariances)
+
+    @profiling.profiled()
+    def unfoldArrays(self,reconstructed,parameter=None,migrations=None):
+        """
+        Unfolds a stack of reconstructed spectra, without covariances,
+        e.g. for toys. Every spectrum is unfolded with the same unfolding
+        matrix, built from this unfolding's reconstructed variance. The
+        decompositions of the migrations are used once, so they aren't cached.
+        Inputs:
+            reconstructed: numpy array (nSpectra,nReco)
+            parameter: the regularization, n-iterations, etc. input parameter
+            migrations: optional numpy array (nSpectra,nReco,nTrue) of a
+                migration matrix for each spectrum, default this unfolding's
+        Outputs:
+            numpy array (nSpectra,nTrue)
+        """
+        reconstructed = numpy.asarray(reconstructed,dtype=numpy.float64)
+        if migrations is None:
+            return reconstructed.dot(self.getUnfoldingMatrix(parameter).T)
+        # A cache that keeps nothing, so the varied decompositions don't
+        # evict the real ones from the shared cache during long toy runs
+        throwawayCache = cache.DecompositionCache(maxEntries=0)
+        return numpy.array([self.withMigration(migration,throwawayCache).getUnfoldingMatrix(parameter).dot(y)
+                                for y, migration in zip(reconstructed,migrations)])
+
+    def getIncrementalUnfolding(self,parameter=None):
+        """
+        Returns an IncrementalUnfolding, which keeps this unfolding's matrix
+        for parameter and updates the result as the reconstructed spectrum
+        changes, e.g. as events arrive during data-taking. Only for linear
+        techniques, those with getUnfoldingMatrix.
+        Inputs:
+            parameter: the regularization input parameter, fixed from now on
+        Outputs:
+            IncrementalUnfolding
+        """
+        return IncrementalUnfolding(self,parameter)
+
+    def getResponseMatrix(self,sparse=False):
+        """
+        Returns the migration matrix normalized so each true bin sums to 1
+        Inputs:
+            sparse: if True, a sparse migration matrix gives a scipy.sparse CSR
+                matrix; otherwise, and for dense migration matrices, a numpy array
+        Outputs:
+            numpy array or scipy.sparse CSR matrix of shape (nReco,nTrue)
+        """
+        trueSums = self.getTrueProjection()
+        scale = 1./numpy.where(trueSums != 0.,trueSums,1.)
+        if _isSparse(self.migration):
+            response = self.migration.multiply(scale[numpy.newaxis,:]).tocsr()
+            return response if sparse else response.toarray()
+        return self.migration*scale
+
+    def getTrueProjection(self):
+        """
+        Returns the migration matrix summed over the reco bins
+        Outputs:
+            numpy array of shape (nTrue,)
+        """
+        return numpy.asarray(self.migration.sum(axis=0)).ravel()
+
+    def getReconstructedArray(self):
+        return self.reconstructed.copy()
+
+    def getMigrationArray(self):
+        """
+        Returns a copy of the migration matrix as a dense numpy array
+        """
+        if _isSparse(self.migration):
+            return self.migration.toarray()
+        return self.migration.copy()
+
+    @profiling.profiled()
     def getReconstructedHist(self):
-        return cloneTNamedUUIDName(self.reconstructedHist)
+        rootadapter = _rootadapter()
+        if self.reconstructedHist is None:
+            return rootadapter.makeHist(self.reconstructed,self.recoBinEdges,errors=numpy.sqrt(self.reconstructedVariance))
+        return rootadapter.cloneTNamedUUIDName(self.reconstructedHist)
 
+    @profiling.profiled()
     def getMigrationMatrix(self):
-        return cloneTNamedUUIDName(self.migrationMatrix)
+        rootadapter = _rootadapter()
+        if self.migrationMatrix is None:
+            return rootadapter.makeHist2D(self.getMigrationArray(),self.recoBinEdges,self.trueBinEdges)
+        return rootadapter.cloneTNamedUUIDName(self.migrationMatrix)
 
+    @profiling.profiled()
     def plotReconstructedHist(self,outfilename):
-        c = CanvasUUID()
-        hist = self.getReconstructedHist()
-        hist.Draw("E")
-        hist.GetXaxis().SetTitle("Reconstructed {}".format(self.xAxisTitle))
-        hist.GetYaxis().SetTitle("Reconstructed {}".format(self.yAxisTitle))
-        hist.SetTitle(self.titlePrefix+"Reconstructed Histogram")
-        c.SaveAs(outfilename)
+        with scratchCanvas() as c:
+            hist = self.getReconstructedHist()
+            hist.Draw("E")
+            hist.GetXaxis().SetTitle("Reconstructed {}".format(self.xAxisTitle))
+            hist.GetYaxis().SetTitle("Reconstructed {}".format(self.yAxisTitle))
+            hist.SetTitle(self.titlePrefix+"Reconstructed Histogram")
+            c.SaveAs(outfilename)
 
+    @profiling.profiled()
     def plotMigrationMatrix(self,outfilename):
-        c = CanvasUUID()
-        setupCOLZFrame(c)
-        hist = self.getMigrationMatrix()
-        hist.Draw("colz")
-        hist.GetXaxis().SetTitle("Reconstructed {}".format(self.xAxisTitle))
-        hist.GetYaxis().SetTitle("True {}".format(self.xAxisTitle))
-        hist.SetTitle(self.titlePrefix+"Migration Matrix")
-        c.SaveAs(outfilename)
-        setupCOLZFrame(c,reset=True)
+        with scratchCanvas() as c:
+            setupCOLZFrame(c)
+            hist = self.getMigrationMatrix()
+            hist.Draw("colz")
+            hist.GetXaxis().SetTitle("Reconstructed {}".format(self.xAxisTitle))
+            hist.GetYaxis().SetTitle("True {}".format(self.xAxisTitle))
+            hist.SetTitle(self.titlePrefix+"Migration Matrix")
+            c.SaveAs(outfilename)
 
 class UnfoldResult(object):
     """
     Holds result of Unfolding class
 
+    The result, covariance, and bin edges are stored as numpy arrays, and
+    ROOT histograms are only made, detached from any ROOT directory, when
+    requested for plots or export. Pickling keeps only the arrays, parameter,
+    and titles, not the unfolding, so results are cheap to send between
+    processes.
     """
 
+    __slots__ = ("unfolding","result","covariance","binEdges","parameter",
+                    "xAxisTitle","yAxisTitle","titlePrefix","trueBinning")
+
     def __init__(self,unfolding, resultHist, covarianceMatrix, parameter):
         """
         Inputs:
             unfolding: Unfolding class object used to create this result
-            resultHist: TH1 result histogram
-            covarianceMatrix: TH2 showing convariance of result
+            resultHist: TH1 or 1D array result histogram, or TH2 or TH3 with the
+                unfolding's N-D true binning.Binning
+            covarianceMatrix: TH2 or 2D array showing convariance of result
             parameter: the regularization, n-iterations, etc. input parameter
         """
 
         if not isinstance(unfolding,Unfolding):
             raise TypeError("unfolding doesn't inherit from Unfolding",type(unfolding))
-        if not isinstance(covarianceMatrix,ROOT.TH2):
-            raise TypeError("covarianceMatrix doesn't inherit from TH2",type(covarianceMatrix))
 
-        if not isinstance(resultHist,ROOT.TH1):
-            raise TypeError("resultHist doesn't inherit from TH1",type(resultHist))
-        if isinstance(resultHist,ROOT.TH2):
-            raise NotImplementedError("resultHist inherits from TH2, 2D unfolding not yet implemented")
+        if isTH1(resultHist) and resultHist.GetDimension() > 1:
+            result = _flattenHistND(resultHist,getattr(unfolding,"trueBinning",None),"resultHist")[0]
+        elif isTH1(resultHist):
+            result = _rootadapter().histToArray(resultHist)
+        else:
+            result = _toArray(resultHist,1,"resultHist")
 
-        if not isinstance(covarianceMatrix,ROOT.TH2):
+        if isTH2(covarianceMatrix):
+            covariance = _rootadapter().histToArray(covarianceMatrix)
+        elif isTH1(covarianceMatrix):
             raise TypeError("covarianceMatrix doesn't inherit from TH2",type(covarianceMatrix))
+        else:
+            covariance = _toArray(covarianceMatrix,2,"covarianceMatrix")
+
+        nTrue = len(unfolding.trueBinEdges)-1
+        if result.shape != (nTrue,):
+            raise ValueError("resultHist has {} bins but the unfolding has {} true bins".format(len(result),nTrue))
+        if covariance.shape != (nTrue,nTrue):
+            raise ValueError("covarianceMatrix has shape {} but the unfolding has {} true bins".format(covariance.shape,nTrue))
 
         self.unfolding = unfolding
-        self.resultHist = resultHist
-        self.covarianceMatrix = covarianceMatrix
+        self.result = result
+        self.covariance = covariance
+        self.binEdges = unfolding.trueBinEdges
         self.parameter = parameter
+        self.xAxisTitle = unfolding.xAxisTitle
+        self.yAxisTitle = unfolding.yAxisTitle
+        self.titlePrefix = unfolding.titlePrefix
+        # binning.Binning of an N-D result, None for 1D bin edges
+        self.trueBinning = getattr(unfolding,"trueBinning",None)
+
+    def __getstate__(self):
+        # The unfolding may hold ROOT objects and large inputs, so it isn't pickled
+        return dict((name,getattr(self,name)) for name in self.__slots__ if name != "unfolding")
+
+    def __setstate__(self,state):
+        self.unfolding = None
+        self.trueBinning = None
+        for name, value in state.items():
+            setattr(self,name,value)
+
+    def __copy__(self):
+        result = UnfoldResult.__new__(type(self))
+        for name in self.__slots__:
+            setattr(result,name,getattr(self,name))
+        return result
+
+    def _getUnfolding(self):
+        if self.unfolding is None:
+            raise ValueError("The unfolding isn't kept when an UnfoldResult is pickled")
+        return self.unfolding
 
     def getReconstructedHist(self):
-        return self.unfolding.getReconstructedHist()
+        return self._getUnfolding().getReconstructedHist()
     def getMigrationMatrix(self):
-        return self.unfolding.getMigrationMatrix()
+        return self._getUnfolding().getMigrationMatrix()
+    @profiling.profiled()
     def getResult(self):
-        return cloneTNamedUUIDName(self.resultHist)
+        return _rootadapter().makeHist(self.result,self.binEdges,errors=self.getErrorArray())
+    @profiling.profiled()
     def getCovarianceMatrix(self):
-        return cloneTNamedUUIDName(self.covarianceMatrix)
+        return _rootadapter().makeHist2D(self.covariance,self.binEdges,self.binEdges)
+    def getResultArray(self):
+        return self.result.copy()
+    def getErrorArray(self):
+        return numpy.sqrt(numpy.abs(numpy.diag(self.covariance)))
+    def getCovarianceArray(self):
+        return self.covariance.copy()
+    def getResultArrayND(self):
+        """
+        Returns the result with the shape of the true binning.Binning, 0 in
+        masked bins, or the 1D result without one
+        """
+        if self.trueBinning is None:
+            return self.getResultArray()
+        return self.trueBinning.unflatten(self.result)
+    def getErrorArrayND(self):
+        if self.trueBinning is None:
+            return self.getErrorArray()
+        return self.trueBinning.unflatten(self.getErrorArray())
+    def getCovarianceArrayND(self):
+        """
+        Returns the covariance with shape trueBinning.shape+trueBinning.shape,
+        or the 2D covariance without a true binning.Binning
+        """
+        if self.trueBinning is None:
+            return self.getCovarianceArray()
+        return self.trueBinning.unflattenCovariance(self.covariance)
+    def getBinEdges(self):
+        return self.binEdges.copy()
     def getParameter(self):
-        return copy.deepcopy(parameter)
+        return copy.deepcopy(self.parameter)
 
+    @profiling.profiled()
     def plotResult(self,outfilename):
-        c = CanvasUUID()
-        hist = self.getResult()
-        hist.Draw("E")
-        hist.GetXaxis().SetTitle("True {}".format(self.unfolding.xAxisTitle))
-        hist.GetYaxis().SetTitle("Unfolded {}".format(self.unfolding.yAxisTitle))
-        hist.SetTitle(self.unfolding.titlePrefix+"Unfolded Histogram")
-        c.SaveAs(outfilename)
-        
+        with scratchCanvas() as c:
+            hist = self.getResult()
+            hist.Draw("E")
+            hist.GetXaxis().SetTitle("True {}".format(self.xAxisTitle))
+            hist.GetYaxis().SetTitle("Unfolded {}".format(self.yAxisTitle))
+            hist.SetTitle(self.titlePrefix+"Unfolded Histogram")
+            c.SaveAs(outfilename)
+
+    @profiling.profiled()
     def plotCovarianceMatrix(self,outfilename):
-        c = CanvasUUID()
-        setupCOLZFrame(c)
-        hist = self.getCovarianceMatrix()
-        hist.Draw("colz")
-        hist.GetXaxis().SetTitle("True {}".format(self.unfolding.xAxisTitle))
-        hist.GetYaxis().SetTitle("True {}".format(self.unfolding.xAxisTitle))
-        hist.SetTitle(self.unfolding.titlePrefix+"Unfolded Covariance Matrix")
-        c.SaveAs(outfilename)
-        setupCOLZFrame(c,reset=True)
+        with scratchCanvas() as c:
+            setupCOLZFrame(c)
+            hist = self.getCovarianceMatrix()
+            hist.Draw("colz")
+            hist.GetXaxis().SetTitle("True {}".format(self.xAxisTitle))
+            hist.GetYaxis().SetTitle("True {}".format(self.xAxisTitle))
+            hist.SetTitle(self.titlePrefix+"Unfolded Covariance Matrix")
+            c.SaveAs(outfilename)
+
+class BatchResult(object):
+    """
+    Holds the results of Unfolding.unfoldBatch for a batch of reconstructed
+    spectra unfolded with the same migration matrix and parameter
+
+    Results and covariances are stored as stacked numpy arrays, and an
+    UnfoldResult is only made for a spectrum when requested.
+    """
+
+    def __init__(self,unfolding,parameter,reconstructed,reconstructedVariances,results,covariances):
+        """
+        Inputs:
+            unfolding: Unfolding class object used to create this result
+            parameter: the regularization, n-iterations, etc. input parameter
+            reconstructed: numpy array (nSpectra,nReco) of reconstructed spectra
+            reconstructedVariances: numpy array (nSpectra,nReco) of their variances
+            results: numpy array (nSpectra,nTrue) of unfolded results
+            covariances: numpy array (nSpectra,nTrue,nTrue) of covariances
+        """
+        if not isinstance(unfolding,Unfolding):
+            raise TypeError("unfolding doesn't inherit from Unfolding",type(unfolding))
+        nSpectra = len(reconstructed)
+        nTrue = len(unfolding.trueBinEdges)-1
+        if results.shape != (nSpectra,nTrue):
+            raise ValueError("results must have shape {}".format((nSpectra,nTrue)),results.shape)
+        if covariances.shape != (nSpectra,nTrue,nTrue):
+            raise ValueError("covariances must have shape {}".format((nSpectra,nTrue,nTrue)),covariances.shape)
+
+        self.unfolding = unfolding
+        self.parameter = parameter
+        self.reconstructed = reconstructed
+        self.reconstructedVariances = reconstructedVariances
+        self.results = results
+        self.covariances = covariances
+
+    def __len__(self):
+        return len(self.results)
+
+    def getResult(self,iSpectrum):
+        """
+        Returns the UnfoldResult for the iSpectrum'th spectrum
+        """
+        unfolding = self.unfolding.withReconstructed(self.reconstructed[iSpectrum],self.reconstructedVariances[iSpectrum])
+        return UnfoldResult(unfolding,self.results[iSpectrum],self.covariances[iSpectrum],self.parameter)
+
+    def getResultArrays(self):
+        return self.results.copy()
+
+    def getErrorArrays(self):
+        return numpy.sqrt(numpy.abs(numpy.diagonal(self.covariances,axis1=1,axis2=2)))
+
+    def getCovarianceArrays(self):
+        return self.covariances.copy()
+
+class IncrementalUnfolding(object):
+    """
+    Unfolds a changing reconstructed spectrum with a fixed unfolding
+    matrix U, made once from the unfolding it starts from
+
+    Each update costs a product of U with the change in the spectrum. The
+    covariance, U V U^T, is only computed when requested, then updated
+    for the bins whose variance changed. Nothing is refactorized, so for the
+    techniques weighting by the reconstructed errors (SVD, Tikhonov) the
+    weights stay those of the starting spectrum. Correlations between
+    reconstructed bins in the starting unfolding's covariance are kept fixed;
+    updates add uncorrelated variance.
+    """
+
+    def __init__(self,unfolding,parameter=None):
+        """
+        Inputs:
+            unfolding: Unfolding of a linear technique, with the starting spectrum
+            parameter: the regularization input parameter
+        """
+        if not isinstance(unfolding,Unfolding):
+            raise TypeError("unfolding doesn't inherit from Unfolding",type(unfolding))
+        self.unfolding = unfolding
+        self.parameter = parameter
+        self.unfoldingMatrix = unfolding.getUnfoldingMatrix(parameter)
+        self.reconstructed = unfolding.reconstructed.copy()
+        # Split the starting covariance into its diagonal, which updates
+        # change, and the fixed correlations between bins
+        factors = unfolding.reconstructedCovarianceFactors
+        if not (unfolding.reconstructedCovariance is None):
+            self.reconstructedVariance = unfolding.reconstructedVariance.copy()
+            correlations = unfolding.reconstructedCovariance-numpy.diag(self.reconstructedVariance)
+            self.correlatedCovariance = self.unfoldingMatrix.dot(correlations).dot(self.unfoldingMatrix.T)
+        elif not (factors is None):
+            self.reconstructedVariance = unfolding.reconstructedVariance-(factors**2).sum(axis=1)
+            correlated = self.unfoldingMatrix.dot(factors)
+            self.correlatedCovariance = correlated.dot(correlated.T)
+        else:
+            self.reconstructedVariance = unfolding.reconstructedVariance.copy()
+            self.correlatedCovariance = None
+        self.result = self.unfoldingMatrix.dot(self.reconstructed)
+        self.covariance = None
+        self.nUpdates = 0
+
+    def _toArrays(self,reconstructedHist,reconstructedVariance):
+        if isTH1(reconstructedHist):
+            rootadapter = _rootadapter()
+            reconstructed = rootadapter.histToArray(reconstructedHist)
+            if reconstructedVariance is None:
+                reconstructedVariance = rootadapter.histErrorsToArray(reconstructedHist)**2
+        else:
+            reconstructed = self.unfolding._flattenReconstructed(_toArray(reconstructedHist,None,"reconstructedHist"))
+        if reconstructed.shape != self.reconstructed.shape:
+            raise ValueError("reconstructedHist must have {} bins".format(len(self.reconstructed)),reconstructed.shape)
+        if not (reconstructedVariance is None):
+            reconstructedVariance = self.unfolding._flattenReconstructed(_toArray(reconstructedVariance,None,"reconstructedVariance"))
+            if reconstructedVariance.shape != reconstructed.shape:
+                raise ValueError("reconstructedVariance must have shape {}".format(reconstructed.shape),reconstructedVariance.shape)
+        return reconstructed, reconstructedVariance
+
+    @profiling.profiled()
+    def update(self,reconstructedHist,reconstructedVariance=None):
+        """
+        Replaces the reconstructed spectrum, e.g. with the latest counts
+        Inputs:
+            reconstructedHist: TH1 or 1D array reconstructed spectrum
+            reconstructedVariance: optional numpy array (nReco,) of its
+                uncorrelated variance, default the squared histogram errors,
+                or |contents| for arrays
+        """
+        reconstructed, reconstructedVariance = self._toArrays(reconstructedHist,reconstructedVariance)
+        if reconstructedVariance is None:
+            reconstructedVariance = numpy.abs(reconstructed)
+        self.addCounts(reconstructed-self.reconstructed,reconstructedVariance-self.reconstructedVariance)
+
+    @profiling.profiled()
+    def addCounts(self,deltaHist,deltaVariance=None):
+        """
+        Adds a change to the reconstructed spectrum, e.g. the newly arrived events
+        Inputs:
+            deltaHist: TH1 or 1D array change of the reconstructed spectrum
+            deltaVariance: optional numpy array (nReco,) change of its
+                uncorrelated variance, default the squared histogram errors,
+                or the change itself for arrays (Poisson counts)
+        """
+        delta, deltaVariance = self._toArrays(deltaHist,deltaVariance)
+        if deltaVariance is None:
+            deltaVariance = delta
+        changed = numpy.flatnonzero(delta)
+        if len(changed) > 0:
+            self.result += self.unfoldingMatrix[:,changed].dot(delta[changed])
+            self.reconstructed += delta
+        changed = numpy.flatnonzero(deltaVariance)
+        if len(changed) > 0:
+            self.reconstructedVariance = self.reconstructedVariance+deltaVariance
+            if not (self.covariance is None):
+                # Rank-len(changed) update, only the columns of U that changed
+                columns = self.unfoldingMatrix[:,changed]
+                self.covariance += (columns*deltaVariance[changed]).dot(columns.T)
+        self.nUpdates += 1
+
+    def getResultArray(self):
+        return self.result.copy()
+
+    def getErrorArray(self):
+        return numpy.sqrt(numpy.abs(numpy.diag(self.getCovarianceArray())))
+
+    def getCovarianceArray(self):
+        if self.covariance is None:
+            self.covariance = (self.unfoldingMatrix*self.reconstructedVariance).dot(self.unfoldingMatrix.T)
+            if not (self.correlatedCovariance is None):
+                self.covariance += self.correlatedCovariance
+        return self.covariance.copy()
+
+    def getResult(self):
+        """
+        Returns an UnfoldResult of the current spectrum
+        """
+        unfolding = self.unfolding.withReconstructed(self.reconstructed.copy(),self.reconstructedVariance.copy())
+        return UnfoldResult(unfolding,self.getResultArray(),self.getCovarianceArray(),self.parameter)
+
+class ScanResult(object):
+    """
+    Holds the results of Unfolding.scan for a list of parameters, with the
+    L-curve and global correlation data used to choose the parameter
+
+    Results and covariances are stored as stacked numpy arrays, and an
+    UnfoldResult is only made for a parameter when requested.
+    """
+
+    def __init__(self,unfolding,parameters,results,covariances):
+        """
+        Inputs:
+            unfolding: Unfolding class object used to create this result
+            parameters: list of the nParameters parameters
+            results: numpy array (nParameters,nTrue) of unfolded results
+            covariances: numpy array (nParameters,nTrue,nTrue) of covariances
+        """
+        if not isinstance(unfolding,Unfolding):
+            raise TypeError("unfolding doesn't inherit from Unfolding",type(unfolding))
+        nTrue = len(unfolding.trueBinEdges)-1
+        if results.shape != (len(parameters),nTrue):
+            raise ValueError("results must have shape {}".format((len(parameters),nTrue)),results.shape)
+        if covariances.shape != (len(parameters),nTrue,nTrue):
+            raise ValueError("covariances must have shape {}".format((len(parameters),nTrue,nTrue)),covariances.shape)
+
+        self.unfolding = unfolding
+        self.parameters = parameters
+        self.results = results
+        self.covariances = covariances
+
+    def __len__(self):
+        return len(self.parameters)
+
+    def getResult(self,iParameter):
+        """
+        Returns the UnfoldResult for the iParameter'th parameter
+        """
+        return UnfoldResult(self.unfolding,self.results[iParameter],self.covariances[iParameter],self.parameters[iParameter])
+
+    def getResiduals(self):
+        """
+        Returns chi^2 = (y - A x)^T V^-1 (y - A x) of the folded result
+        and the reconstructed histogram for each parameter
+        """
+        folded = self.unfolding.getResponseMatrix(sparse=True).dot(self.results.T).T
+        variance = self.unfolding.reconstructedVariance
+        variance = numpy.where(variance > 0.,variance,1.)
+        return (((folded-self.unfolding.reconstructed)**2)/variance).sum(axis=1)
+
+    def getRegularizations(self):
+        """
+        Returns |L x|^2 for each parameter, L from Unfolding.getRegularizationMatrix
+        """
+        regularized = self.results.dot(self.unfolding.getRegularizationMatrix().T)
+        return (regularized**2).sum(axis=1)
+
+    def getLCurve(self):
+        """
+        Returns the L-curve and its curvature, for parameters in scan order
+        Outputs:
+            logResiduals: numpy array of log10(chi^2)
+            logRegularizations: numpy array of log10(|L x|^2)
+            curvatures: numpy array of the curvature of the L-curve at each point,
+                positive at the corner
+        """
+        tiny = numpy.finfo(numpy.float64).tiny
+        logResiduals = numpy.log10(numpy.maximum(self.getResiduals(),tiny))
+        logRegularizations = numpy.log10(numpy.maximum(self.getRegularizations(),tiny))
+        if len(self) < 3:
+            return logResiduals, logRegularizations, numpy.zeros(len(self))
+        dx = numpy.gradient(logResiduals)
+        dy = numpy.gradient(logRegularizations)
+        ddx = numpy.gradient(dx)
+        ddy = numpy.gradient(dy)
+        denominator = (dx**2+dy**2)**1.5
+        curvatures = (dx*ddy-dy*ddx)/numpy.where(denominator > 0.,denominator,1.)
+        # Sign convention: positive at the corner, whichever way the parameters are ordered
+        if logResiduals[-1] < logResiduals[0]:
+            curvatures = -curvatures
+        return logResiduals, logRegularizations, curvatures
+
+    def getGlobalCorrelations(self):
+        """
+        Returns the global correlation coefficient of each true bin,
+        rho_i = sqrt(1 - 1/(V_ii (V^-1)_ii)), for each parameter
+        Outputs:
+            numpy array (nParameters,nTrue)
+        """
+        inverses = numpy.linalg.pinv(self.covariances,hermitian=True)
+        diagonals = numpy.diagonal(self.covariances,axis1=1,axis2=2)*numpy.diagonal(inverses,axis1=1,axis2=2)
+        ratio = 1.-1./numpy.where(diagonals > 0.,diagonals,1.)
+        return numpy.sqrt(numpy.clip(ratio,0.,1.))
+
+    def getOptimalParameter(self,method="lcurve"):
+        """
+        Returns the parameter chosen by method
+        Inputs:
+            method: "lcurve" for the point of maximum L-curve curvature, or
+                "globalcorrelation" for the minimum average global correlation
+        Outputs:
+            the chosen parameter
+        """
+        if method == "lcurve":
+            iParameter = numpy.argmax(self.getLCurve()[2])
+        elif method == "globalcorrelation":
+            iParameter = numpy.argmin(self.getGlobalCorrelations().mean(axis=1))
+        else:
+            raise ValueError("method must be 'lcurve' or 'globalcorrelation'",method)
+        return self.parameters[iParameter]
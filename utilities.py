@@ -2,21 +2,279 @@
 Utility Functions
 """
 
-import ROOT
-from ROOT import gStyle as gStyle
-import uuid
+import os
+import sys
+import array
 import numbers
+import weakref
+import itertools
+import threading
+import contextlib
+import collections
 import numpy
 
+_ROOT = None
+
+def getROOT():
+    """
+    Imports and returns the ROOT module, setting the plot style the first time
+
+    ROOT is only needed for ROOT histogram input/output and plotting, so it
+    isn't imported until one of those is used.
+    """
+    global _ROOT
+    if _ROOT is None:
+        import ROOT
+        _ROOT = ROOT
+        setStyle()
+    return _ROOT
+
+def isTH1(obj):
+    """
+    Returns True if obj is a ROOT TH1 (including TH2), without importing ROOT
+    """
+    ROOT = sys.modules.get("ROOT")
+    return not (ROOT is None) and isinstance(obj,ROOT.TH1)
+
+def isTH2(obj):
+    """
+    Returns True if obj is a ROOT TH2, without importing ROOT
+    """
+    ROOT = sys.modules.get("ROOT")
+    return not (ROOT is None) and isinstance(obj,ROOT.TH2)
+
+_nameCounter = itertools.count()
+
+def uniqueName(prefix="obj"):
+    """
+    Returns a name unique within this process for a ROOT object: the prefix,
+    process id, and a counter, much cheaper than a uuid
+    """
+    return "{}_{}_{}".format(prefix,os.getpid(),next(_nameCounter))
+
+# AddDirectory is global ROOT state, so changes to it are serialized
+_directoryLock = threading.RLock()
+
+@contextlib.contextmanager
+def detachedFromDirectory():
+    """
+    Context manager in which new histograms aren't registered in ROOT's
+    current directory (TH1::AddDirectory(false)), restoring the previous
+    setting afterwards
+    """
+    TH1 = getROOT().TH1
+    with _directoryLock:
+        status = TH1.AddDirectoryStatus()
+        TH1.AddDirectory(False)
+        try:
+            yield
+        finally:
+            TH1.AddDirectory(status)
+
+class ROOTObjectManager(object):
+    """
+    Lifecycle of the ROOT histograms and canvases made by this package
+
+    Objects are made outside ROOT's directories and owned by Python, so
+    they are deleted as soon as they are no longer referenced instead of
+    accumulating in gDirectory during long toy and scan runs. Scratch
+    canvases and histograms, used only while drawing a plot, are pooled and
+    reused. Live objects are counted by class, so leaks can be monitored
+    with getStats.
+    """
+
+    def __init__(self,maxPooled=8):
+        """
+        Inputs:
+            maxPooled: int maximum number of free canvases, and of free
+                histograms of each binning, kept for reuse
+        """
+        self.maxPooled = maxPooled
+        self.created = collections.Counter()
+        self.deleted = collections.Counter()
+        self.reused = collections.Counter()
+        self._lock = threading.RLock()
+        self._refs = set()
+        self._canvasPool = []
+        self._histPools = {}
+        self._histKeys = {}
+
+    def track(self,obj):
+        """
+        Gives ownership of a ROOT object to Python and counts it until it is deleted
+        Outputs:
+            obj
+        """
+        if obj is None:
+            return obj
+        getROOT().SetOwnership(obj,True)
+        className = obj.ClassName()
+        with self._lock:
+            self.created[className] += 1
+        try:
+            ref = weakref.ref(obj,lambda ref: self._onDelete(ref,className))
+        except TypeError:
+            return obj
+        with self._lock:
+            self._refs.add(ref)
+        return obj
+
+    def _onDelete(self,ref,className):
+        with self._lock:
+            if ref in self._refs:
+                self._refs.discard(ref)
+                self.deleted[className] += 1
+
+    def acquireCanvas(self):
+        """
+        Returns a cleared canvas from the pool, or a new one
+        """
+        with self._lock:
+            if len(self._canvasPool) > 0:
+                self.reused["TCanvas"] += 1
+                return self._canvasPool.pop()
+        return CanvasUUID()
+
+    def releaseCanvas(self,canvas):
+        """
+        Clears a canvas from acquireCanvas and returns it to the pool
+        """
+        canvas.Clear()
+        setupCOLZFrame(canvas,reset=True)
+        with self._lock:
+            if len(self._canvasPool) < self.maxPooled:
+                self._canvasPool.append(canvas)
+
+    @contextlib.contextmanager
+    def scratchCanvas(self):
+        """
+        Context manager giving a pooled canvas for one plot, e.g.
+
+            with objectManager.scratchCanvas() as c:
+                hist.Draw()
+                c.SaveAs("plot.pdf")
+        """
+        canvas = self.acquireCanvas()
+        try:
+            yield canvas
+        finally:
+            self.releaseCanvas(canvas)
+
+    def acquireHist(self,xBinEdges,yBinEdges=None):
+        """
+        Returns an empty TH1D, or TH2D if yBinEdges is given, with these bin
+        edges from the pool, or a new one
+        """
+        key = (tuple(float(x) for x in xBinEdges),None if yBinEdges is None else tuple(float(y) for y in yBinEdges))
+        hist = None
+        with self._lock:
+            pool = self._histPools.get(key)
+            if pool:
+                hist = pool.pop()
+                self.reused[hist.ClassName()] += 1
+        if hist is None:
+            if yBinEdges is None:
+                hist = HistUUID(list(key[0]),TH1D=True)
+            else:
+                hist = Hist2DUUID(list(key[0]),list(key[1]),TH2D=True)
+        else:
+            hist.Reset()
+            hist.SetTitle("")
+            hist.GetXaxis().SetTitle("")
+            hist.GetYaxis().SetTitle("")
+        with self._lock:
+            self._histKeys[id(hist)] = key
+        return hist
+
+    def releaseHist(self,hist):
+        """
+        Returns a histogram from acquireHist to the pool
+        """
+        with self._lock:
+            key = self._histKeys.pop(id(hist),None)
+            if key is None:
+                return
+            pool = self._histPools.setdefault(key,[])
+            if len(pool) < self.maxPooled:
+                pool.append(hist)
+
+    @contextlib.contextmanager
+    def scratchHist(self,xBinEdges,yBinEdges=None):
+        """
+        Context manager giving a pooled histogram for one plot, see acquireHist
+        """
+        hist = self.acquireHist(xBinEdges,yBinEdges)
+        try:
+            yield hist
+        finally:
+            self.releaseHist(hist)
+
+    def clearPools(self):
+        """
+        Deletes the pooled canvases and histograms
+        """
+        with self._lock:
+            canvases = self._canvasPool
+            self._canvasPool = []
+            self._histPools = {}
+        for canvas in canvases:
+            canvas.Close()
+
+    def getLiveCounts(self):
+        """
+        Returns a dict of ROOT class name to the number of objects made and
+        not yet deleted, including pooled ones
+        """
+        with self._lock:
+            return dict((className,self.created[className]-self.deleted[className])
+                            for className in self.created if self.created[className] > self.deleted[className])
+
+    def getStats(self):
+        """
+        Returns a dict of "live" (see getLiveCounts), "created", "reused",
+        and "pooled" counts, and "directoryObjects", the number of objects
+        in ROOT's current directory
+        """
+        with self._lock:
+            nPooled = len(self._canvasPool)+sum(len(pool) for pool in self._histPools.values())
+            result = {"live": self.getLiveCounts(),"created": dict(self.created),
+                        "reused": dict(self.reused),"pooled": nPooled}
+        ROOT = sys.modules.get("ROOT")
+        result["directoryObjects"] = None if ROOT is None else ROOT.gDirectory.GetList().GetSize()
+        return result
+
+_objectManager = ROOTObjectManager()
+
+def getObjectManager():
+    """
+    Returns the ROOTObjectManager tracking the objects made by this package
+    """
+    return _objectManager
+
+def scratchCanvas():
+    return _objectManager.scratchCanvas()
+
+def scratchHist(xBinEdges,yBinEdges=None):
+    return _objectManager.scratchHist(xBinEdges,yBinEdges)
+
 def cloneTNamedUUIDName(hist):
-    return hist.Clone(uuid.uuid1().hex)
+    """
+    Returns a clone of hist with a unique name, not in any ROOT directory
+    and owned by Python
+    """
+    with detachedFromDirectory():
+        result = hist.Clone(uniqueName("h"))
+    if isinstance(result,getROOT().TH1):
+        result.SetDirectory(0)
+    return _objectManager.track(result)
 
 def CanvasUUID():
-   return ROOT.TCanvas(uuid.uuid1().hex)
+   return _objectManager.track(getROOT().TCanvas(uniqueName("c")))
 
 def HistUUID(*args,**kargs):
   """
-  Returns TH1F/TH1D/TEfficiency with UUID for name and "" for title.
+  Returns TH1F/TH1D/TEfficiency with a unique name and "" for title,
+  not in any ROOT directory and owned by Python.
   Positional arguments:
     either:
         nBins: number of histogram bins
@@ -30,27 +288,30 @@ def HistUUID(*args,**kargs):
   Outputs:
     ROOT 1D histogram or TEfficiency
   """
+  ROOT = getROOT()
   func = ROOT.TH1F
   if "TH1D" in kargs and kargs["TH1D"]:
     func = ROOT.TH1D
   if "TEfficiency" in kargs and kargs["TEfficiency"]:
     func = ROOT.TEfficiency
-  name = uuid.uuid1().hex
+  name = uniqueName("h")
   hist = None
-  if len(args) == 1 and type(args[0]) == list:
-    hist = func(name,"",len(args[0])-1,array.array('f',args[0]))
-  elif len(args) == 3:
-    for i in range(3):
-      if not isinstance(args[i],numbers.Number):
-        raise Exception(i,"th argument is not a number")
-    hist = func(name,"",args[0],args[1],args[2])
-  else:
-    raise Exception("Hist: Innapropriate arguments, requires either nBins, low, high or a list of bin edges:",args)
-  return hist
+  with detachedFromDirectory():
+    if len(args) == 1 and type(args[0]) == list:
+      hist = func(name,"",len(args[0])-1,array.array('d',args[0]))
+    elif len(args) == 3:
+      for i in range(3):
+        if not isinstance(args[i],numbers.Number):
+          raise Exception(i,"th argument is not a number")
+      hist = func(name,"",args[0],args[1],args[2])
+    else:
+      raise Exception("Hist: Innapropriate arguments, requires either nBins, low, high or a list of bin edges:",args)
+  return _objectManager.track(hist)
 
 def Hist2DUUID(*args,**kargs):
   """
-  Returns TH2F/TH2D/2D-TEfficiency with UUID for name and "" for title.
+  Returns TH2F/TH2D/2D-TEfficiency with a unique name and "" for title,
+  not in any ROOT directory and owned by Python.
   Positional arguments:
     either:
         nBinsX: number of histogram bins
@@ -68,34 +329,95 @@ def Hist2DUUID(*args,**kargs):
   Outputs:
     ROOT 2D histogram or 2D TEfficiency
   """
+  ROOT = getROOT()
   func = ROOT.TH2F
   if "TH2D" in kargs and kargs["TH2D"]:
     func = ROOT.TH2D
   if "TEfficiency" in kargs and kargs["TEfficiency"]:
     func = ROOT.TEfficiency
-  name = uuid.uuid1().hex
+  name = uniqueName("h")
   hist = None
-  if len(args) == 2 and type(args[0]) == list and type(args[1]) == list:
-    hist = func(name,"",len(args[0])-1,array.array('f',args[0]),len(args[1])-1,array.array('f',args[1]))
-  elif len(args) == 6:
-    for i in range(6):
-      if not isinstance(args[i],numbers.Number):
-        raise Exception(i,"th argument is not a number")
-    hist = func(name,"",args[0],args[1],args[2],args[3],args[4],args[5])
-  elif len(args) == 4:
-    if type(args[0]) == list:
-      for i in range(1,4):
+  with detachedFromDirectory():
+    if len(args) == 2 and type(args[0]) == list and type(args[1]) == list:
+      hist = func(name,"",len(args[0])-1,array.array('d',args[0]),len(args[1])-1,array.array('d',args[1]))
+    elif len(args) == 6:
+      for i in range(6):
         if not isinstance(args[i],numbers.Number):
           raise Exception(i,"th argument is not a number")
-      hist = func(name,"",len(args[0])-1,array.array('d',args[0]),args[1],args[2],args[3])
-    elif type(args[3]) == list:
-      for i in range(3):
-        if not isinstance(args[i],numbers.Number):
-          raise Exception(i,"th argument is not a number")
-      hist = func(name,"",args[0],args[1],args[2],len(args[3])-1,array.array('d',args[3]))
-  else:
-    raise Exception("Hist: Innapropriate arguments, requires either nBins, low, high or a list of bin edges:",args)
-  return hist
+      hist = func(name,"",args[0],args[1],args[2],args[3],args[4],args[5])
+    elif len(args) == 4:
+      if type(args[0]) == list:
+        for i in range(1,4):
+          if not isinstance(args[i],numbers.Number):
+            raise Exception(i,"th argument is not a number")
+        hist = func(name,"",len(args[0])-1,array.array('d',args[0]),args[1],args[2],args[3])
+      elif type(args[3]) == list:
+        for i in range(3):
+          if not isinstance(args[i],numbers.Number):
+            raise Exception(i,"th argument is not a number")
+        hist = func(name,"",args[0],args[1],args[2],len(args[3])-1,array.array('d',args[3]))
+    else:
+      raise Exception("Hist: Innapropriate arguments, requires either nBins, low, high or a list of bin edges:",args)
+  return _objectManager.track(hist)
+
+def sameBinEdges(binEdges1,binEdges2):
+    """
+    Returns True if the two arrays of bin edges describe the same binning
+    """
+    binEdges1 = numpy.asarray(binEdges1)
+    binEdges2 = numpy.asarray(binEdges2)
+    return binEdges1.shape == binEdges2.shape and numpy.allclose(binEdges1,binEdges2)
+
+def curvatureMatrix(binEdges):
+    """
+    Returns the (nBins-2) x nBins second-derivative matrix acting on the
+    bin contents divided by the bin widths, like TUnfoldDensity's
+    kRegModeCurvature with kDensityModeBinWidth
+    """
+    binWidths = numpy.diff(binEdges)
+    nBins = len(binWidths)
+    result = numpy.zeros((max(nBins-2,0),nBins))
+    iRows = numpy.arange(nBins-2)
+    result[iRows,iRows] = 1.
+    result[iRows,iRows+1] = -2.
+    result[iRows,iRows+2] = 1.
+    return result/binWidths
+
+def CreateFakeDataArrays(nData,nMC,nBinsReco,nBinsTrue,smearingData=0.1,smearingMC=0.1,rng=None):
+    """
+    Creates a fake dataset for testing as numpy arrays, binning goes from 0 to 1.
+    Data and MC are generated identically.
+
+    Inputs:
+      nData, nMC: number of events
+      nBinsReco, nBinsTrue: number of bins
+      smearingData, smearingMC: relative smearing factor on reco
+      rng: optional numpy.random.Generator, default uses the global numpy.random state
+
+    Outputs:
+        dataBuilder: histbuilder.ResponseBuilder filled with the data
+        mcBuilder: histbuilder.ResponseBuilder filled with the MC
+    """
+    from histbuilder import ResponseBuilder
+    if rng is None:
+        rand = numpy.random.rand
+        randn = numpy.random.randn
+    else:
+        rand = rng.random
+        randn = rng.standard_normal
+
+    recoBinEdges = numpy.linspace(0,1,nBinsReco+1)
+    trueBinEdges = numpy.linspace(0,1,nBinsTrue+1)
+    builders = []
+    for nEvents, smearing in [(nData,smearingData),(nMC,smearingMC)]:
+        true = rand(nEvents) # N samples uniform [0,1)
+        reco = true+randn(nEvents)*smearing # random normal dist
+        # get rid of out of bounds events
+        mask = numpy.logical_and(reco > 0.,reco < 1.)
+        builder = ResponseBuilder(recoBinEdges,trueBinEdges)
+        builder.fill(true[mask],reco[mask])
+        builders.append(builder)
+    return builders[0], builders[1]
 
 def CreateFakeData(nData,nMC,nBinsReco,nBinsTrue,smearingData=0.1,smearingMC=0.1):
     """
@@ -112,37 +434,23 @@ def CreateFakeData(nData,nMC,nBinsReco,nBinsTrue,smearingData=0.1,smearingMC=0.1
         recoDataHist: smeared distribution of data
         trueMCHist: true distribution of MC
         recoMCHist: true distribution of MC
-        migrationMatrix: migration matrix of MC, reco v true
-    """
-    trueData = numpy.random.rand(nData) # N samples uniform [0,1)
-    recoData = trueData+numpy.random.randn(nData)*smearingData # random normal dist
-    # get rid of out of bounds events
-    mask = numpy.logical_and(recoData > 0.,recoData < 1.)
-    trueData = trueData[mask]
-    recoData = recoData[mask]
-
-    trueMC = numpy.random.rand(nMC) # N samples uniform [0,1)
-    recoMC = trueMC+numpy.random.randn(nMC)*smearingMC # random normal dist
-    mask = numpy.logical_and(recoMC > 0.,recoMC < 1.)
-    trueMC = trueMC[mask]
-    recoMC = recoMC[mask]
-
-    trueDataHist = HistUUID(nBinsTrue,0,1,TH1D=True)
-    recoDataHist = HistUUID(nBinsReco,0,1,TH1D=True)
-    for t, r in zip(trueData,recoData):
-        trueDataHist.Fill(t)
-        recoDataHist.Fill(r)
-
-    trueMCHist = HistUUID(nBinsTrue,0,1,TH1D=True)
-    recoMCHist = HistUUID(nBinsReco,0,1,TH1D=True)
-    migrationMatrix = Hist2DUUID(nBinsTrue,0,1,nBinsReco,0,1,TH2D=True)
-    for t, r in zip(trueMC,recoMC):
-        trueMCHist.Fill(t)
-        recoMCHist.Fill(r)
-        migrationMatrix.Fill(t,r)
+        migrationMatrix: migration matrix of MC, true (y) v reco (x)
+    """
+    from rootadapter import makeHist, makeHist2D
+
+    dataBuilder, mcBuilder = CreateFakeDataArrays(nData,nMC,nBinsReco,nBinsTrue,smearingData,smearingMC)
+    recoBinEdges = mcBuilder.recoBinEdges
+    trueBinEdges = mcBuilder.trueBinEdges
+    trueDataHist = makeHist(dataBuilder.getTrueHist(),trueBinEdges)
+    recoDataHist = makeHist(dataBuilder.getRecoHist(),recoBinEdges)
+    trueMCHist = makeHist(mcBuilder.getTrueHist(),trueBinEdges)
+    recoMCHist = makeHist(mcBuilder.getRecoHist(),recoBinEdges)
+    migrationMatrix = makeHist2D(mcBuilder.getMigrationMatrix(),recoBinEdges,trueBinEdges)
     return trueDataHist, recoDataHist, trueMCHist, recoMCHist, migrationMatrix
 
 def setStyle():
+  ROOT = getROOT()
+  gStyle = ROOT.gStyle
   gStyle.SetCanvasColor(0)
   gStyle.SetCanvasBorderSize(10)
   gStyle.SetCanvasBorderMode(0)
@@ -205,10 +513,9 @@ def setStyle():
  
   gStyle.SetOptStat(0)
   gStyle.SetOptStat("nemr")
-  
-setStyle()
 
 def setupCOLZFrame(pad,reset=False):
+   gStyle = getROOT().gStyle
    if reset:
      pad.SetRightMargin(gStyle.GetPadRightMargin())
    else:
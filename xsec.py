@@ -1,29 +1,163 @@
 """
 Classes to handle unfolding a thick-target cross-section measurement
+
+The ROOT inputs are converted to numpy arrays once, then background
+subtraction, unfolding, efficiency correction, and the ratio are done on
+arrays, propagating the covariance of each uncertainty source by its
+Jacobian, or with toys. The numerator and denominator, and several
+channels with unfoldChannels, can be unfolded concurrently on an executor.
 """
 
+import numpy
+import profiling
 import utilities
 import unfold_base
+import binning
+
+# fromArrays entry holding each extra technique input, see Unfolding.extraInputs
+_extraInputKeys = {"simRecoHist": "simReconstructed","simTrueHist": "simTrue"}
+
+def _safeInverse(a):
+    """
+    Returns 1/a, with 0 where a is 0
+    """
+    return (a != 0.)/numpy.where(a != 0.,a,1.)
+
+def _histAxesEdges(rootadapter,hist):
+    """
+    Returns the list of bin edges of each axis of a TH1, TH2, or TH3
+    """
+    return [rootadapter.histBinEdges(hist,axis) for axis in "xyz"[:hist.GetDimension()]]
+
+def _sameAxesEdges(axesEdges1,axesEdges2):
+    """
+    Returns True if two lists of bin edges, one per axis, describe the same binning
+    """
+    return len(axesEdges1) == len(axesEdges2) and all(utilities.sameBinEdges(edges1,edges2)
+                                                        for edges1, edges2 in zip(axesEdges1,axesEdges2))
+
+def _sameMigrationAxis(migrationEdges,binEdges,axisBinning):
+    """
+    Returns True if a migration matrix axis matches the 1D bin edges, or
+    has one bin per compact index of an N-D binning.Binning
+    """
+    if axisBinning is None:
+        return utilities.sameBinEdges(migrationEdges,binEdges)
+    return len(migrationEdges) == axisBinning.nBins+1
+
+def _histArrays(rootadapter,recoHist,migrationMatrix,efficiencyHist,backgroundHists,migrationUncHists,
+                    simRecoHist=None,simTrueHist=None,recoBinning=None,trueBinning=None):
+    """
+    Converts the ROOT inputs of the numerator or denominator to a dict of
+    numpy arrays, flattening N-D histograms with the binning.Binnings
+    """
+    def recoArray(a):
+        return a if recoBinning is None else recoBinning.flatten(a)
+    def trueArray(a):
+        return a if trueBinning is None else trueBinning.flatten(a)
+    nReco, nTrue = rootadapter.histToArray(migrationMatrix).shape
+    result = {
+        "reconstructed": recoArray(rootadapter.histToArray(recoHist)),
+        "reconstructedVariance": recoArray(rootadapter.histErrorsToArray(recoHist)**2),
+        "migration": rootadapter.histToArray(migrationMatrix),
+        "backgrounds": numpy.array([recoArray(rootadapter.histToArray(h)) for h in backgroundHists]).reshape(-1,nReco),
+        "backgroundErrors": numpy.array([recoArray(rootadapter.histErrorsToArray(h)) for h in backgroundHists]).reshape(-1,nReco),
+        "migrationUncertainties": numpy.array([rootadapter.histToArray(h) for h in migrationUncHists]).reshape(-1,nReco,nTrue),
+    }
+    if efficiencyHist is None:
+        result["efficiency"] = numpy.ones(nTrue)
+        result["efficiencyErrors"] = numpy.zeros(nTrue)
+    else:
+        result["efficiency"] = trueArray(rootadapter.histToArray(efficiencyHist))
+        result["efficiencyErrors"] = trueArray(rootadapter.histErrorsToArray(efficiencyHist))
+    if not (simRecoHist is None):
+        result["simReconstructed"] = recoArray(rootadapter.histToArray(simRecoHist))
+    if not (simTrueHist is None):
+        result["simTrue"] = trueArray(rootadapter.histToArray(simTrueHist))
+    return result
+
+def _flattenInput(key,value,recoBinning,trueBinning):
+    """
+    Returns an XsecUnfolder.fromArrays input with N-D bin axes flattened to
+    compact bin indices, or value unchanged if it is already flat
+    """
+    if key == "migration":
+        return binning.flattenMigration(value,recoBinning,trueBinning)
+    if key == "migrationUncertainties":
+        if value.ndim < 3 or len(value) == 0:
+            return value
+        return numpy.array([binning.flattenMigration(item,recoBinning,trueBinning) for item in value])
+    if key in ("efficiency","efficiencyErrors","simTrue"):
+        itemBinning, axis = trueBinning, 0
+    elif key in ("backgrounds","backgroundErrors"):
+        itemBinning, axis = recoBinning, 1
+    else:
+        itemBinning, axis = recoBinning, 0
+    if itemBinning is None or value.shape[axis:axis+itemBinning.nAxes] != itemBinning.shape:
+        return value
+    return itemBinning.flatten(value,axis)
+
+def _completeArrays(arrays,nReco,nTrue,name,recoBinning=None,trueBinning=None):
+    """
+    Returns a copy of a dict of numerator or denominator input arrays, as
+    made by _histArrays, with the optional entries filled with their defaults
+    and N-D inputs flattened with the binning.Binnings
+    """
+    shapes = {"reconstructed": (nReco,),"reconstructedVariance": (nReco,),"migration": (nReco,nTrue),
+                "efficiency": (nTrue,),"efficiencyErrors": (nTrue,),"backgrounds": (-1,nReco),
+                "backgroundErrors": (-1,nReco),"migrationUncertainties": (-1,nReco,nTrue),
+                "simReconstructed": (nReco,),"simTrue": (nTrue,)}
+    for key in ["reconstructed","migration"]:
+        if not (key in arrays):
+            raise ValueError("{} needs \"{}\"".format(name,key))
+    for key in arrays:
+        if not (key in shapes):
+            raise ValueError("Unknown {} entry \"{}\"".format(name,key))
+    result = {}
+    for key, value in arrays.items():
+        value = _flattenInput(key,numpy.asarray(value,dtype=numpy.float64),recoBinning,trueBinning)
+        shape = shapes[key]
+        if shape[0] == -1:
+            # A list of any length, possibly empty, of entries of shape shape[1:]
+            if value.size % numpy.prod(shape[1:]) != 0 or (value.ndim == len(shape) and value.shape[1:] != shape[1:]):
+                raise ValueError("{} \"{}\" must be a list of arrays of shape {}".format(name,key,shape[1:]),value.shape)
+            value = value.reshape(shape)
+        elif value.shape != shape:
+            raise ValueError("{} \"{}\" must have shape {}".format(name,key,shape),value.shape)
+        result[key] = value
+    result.setdefault("reconstructedVariance",numpy.abs(result["reconstructed"]))
+    result.setdefault("efficiency",numpy.ones(nTrue))
+    result.setdefault("efficiencyErrors",numpy.zeros(nTrue))
+    result.setdefault("backgrounds",numpy.zeros((0,nReco)))
+    result.setdefault("backgroundErrors",numpy.zeros(result["backgrounds"].shape))
+    result.setdefault("migrationUncertainties",numpy.zeros((0,nReco,nTrue)))
+    if result["backgroundErrors"].shape != result["backgrounds"].shape:
+        raise ValueError("{} \"backgroundErrors\" must have the shape of \"backgrounds\"".format(name))
+    return result
 
 class XsecUnfolder(object):
     """
     User-facing class for unfolding cross-sections
     """
     
+    @profiling.profiled()
     def __init__(self,dz,density,
                         numRecoHist,denomRecoHist,
                         numMigrationMatrix,denomMigrationMatrix,
                         numEfficiencyHist=None,denomEfficiencyHist=None,
                         numBackgroundHistList=[],denomBackgroundHistList=[],
-                        numMigrationMatrixUncList=[],denomMigrationMatrixUncList=[]):
+                        numMigrationMatrixUncList=[],denomMigrationMatrixUncList=[],
+                        numSimRecoHist=None,denomSimRecoHist=None,
+                        numSimTrueHist=None,denomSimTrueHist=None,
+                        executor=None,recoBinning=None,trueBinning=None):
         """
         Inputs:
             dz: float thickness of thin slab (distance between 
                 wires in average particle direction)
             density: float argon number density per volume
-            numRecoHist: TH1 reconstructed numerator histogram to unfold
-            denomRecoHist: TH1 reconstructed denominator histogram to unfold
-            numMigrationMatrix: TH2 migration to use for unfolding denominator; true v reconstructed
+            numRecoHist: TH1, TH2, or TH3 reconstructed numerator histogram to unfold
+            denomRecoHist: TH1, TH2, or TH3 reconstructed denominator histogram to unfold
+            numMigrationMatrix: TH2 migration to use for unfolding numerator; true v reconstructed
             denomMigrationMatrix: TH2 migration to use for unfolding denominator; true v reconstructed
             numEfficiencyHist: optional TH1 efficiency of numerator in bins of true
             denomEfficiencyHist: optional TH1 efficiency of denominator in bins of true
@@ -37,6 +171,21 @@ class XsecUnfolder(object):
             denomMigrationMatrixUncList: list of TH2 migration matrix systematic uncertainties for denominator;
                                     each bin should be the relative 1 sigma systematic uncertainty
                                     e.g. 0.1 for 10% uncertainty
+            numSimRecoHist: optional TH1 simulated numerator in bins of reco, for techniques needing it (TSVDUnfold)
+            denomSimRecoHist: optional TH1 simulated denominator in bins of reco, for techniques needing it (TSVDUnfold)
+            numSimTrueHist: optional TH1 simulated numerator in bins of true, for techniques needing it (TSVDUnfold)
+            denomSimTrueHist: optional TH1 simulated denominator in bins of true, for techniques needing it (TSVDUnfold)
+            executor: optional default executor for unfold, e.g. executors.ThreadExecutor
+            recoBinning: optional binning.Binning of N-D reco histograms, e.g. with a
+                mask, default the axes of numRecoHist if it is a TH2 or TH3
+            trueBinning: optional binning.Binning of N-D true histograms, default the
+                axes of the first efficiency or simulated true histogram if it is a TH2 or TH3
+
+        The reco histograms (reco, background, and simulated reco) may be TH1,
+        TH2, or TH3, and the true ones (efficiency and simulated true) too.
+        N-D ones are flattened to the compact bin indices of recoBinning and
+        trueBinning, and the migration matrices are TH2s of those indices. The
+        results are mapped back by XsecUnfoldResult.getResultArrayND etc.
         """
 
         try:
@@ -47,47 +196,47 @@ class XsecUnfolder(object):
             density = float(density)
         except ValueError:
             raise ValueError("Could not convert density to float: ",density)
-        if not isinstance(numRecoHist,ROOT.TH1):
-            raise TypeError("numRecoHist doesn't inherit from TH1",type(numRecoHist))
-        if isinstance(numRecoHist,ROOT.TH2):
-            raise NotImplementedError("numRecoHist inherits from TH2, 2D unfolding not yet implemented")
-        if not isinstance(denomRecoHist,ROOT.TH1):
-            raise TypeError("denomRecoHist doesn't inherit from TH1",type(denomRecoHist))
-        if isinstance(denomRecoHist,ROOT.TH2):
-            raise NotImplementedError("denomRecoHist inherits from TH2, 2D unfolding not yet implemented")
-        if not isinstance(numMigrationMatrix,ROOT.TH2):
-            raise TypeError("numMigrationMatrix doesn't inherit from TH2",type(numMigrationMatrix))
-        if not isinstance(denomMigrationMatrix,ROOT.TH2):
-            raise TypeError("denomMigrationMatrix doesn't inherit from TH2",type(denomMigrationMatrix))
-
-        if not (numEfficiencyHist is None):
-            if not isinstance(numEfficiencyHist,ROOT.TH1):
-                raise TypeError("numEfficiencyHist doesn't inherit from TH1",type(numEfficiencyHist))
-            if isinstance(numEfficiencyHist,ROOT.TH2):
-                raise NotImplementedError("numEfficiencyHist inherits from TH2, 2D unfolding not yet implemented")
-        if not (denomEfficiencyHist is None):
-            if not isinstance(denomEfficiencyHist,ROOT.TH1):
-                raise TypeError("denomEfficiencyHist doesn't inherit from TH1",type(denomEfficiencyHist))
-            if isinstance(denomEfficiencyHist,ROOT.TH2):
-                raise NotImplementedError("denomEfficiencyHist inherits from TH2, 2D unfolding not yet implemented")
-
-        for numBackgroundHist in numBackgroundHistList:
-            if not isinstance(numBackgroundHist,ROOT.TH1):
-                raise TypeError("numBackgroundHist doesn't inherit from TH1",type(numBackgroundHist))
-            if isinstance(numBackgroundHist,ROOT.TH2):
-                raise NotImplementedError("numBackgroundHist inherits from TH2, 2D unfolding not yet implemented")
-        for denomBackgroundHist in denomBackgroundHistList:
-            if not isinstance(denomBackgroundHist,ROOT.TH1):
-                raise TypeError("denomBackgroundHist doesn't inherit from TH1",type(denomBackgroundHist))
-            if isinstance(denomBackgroundHist,ROOT.TH2):
-                raise NotImplementedError("denomBackgroundHist inherits from TH2, 2D unfolding not yet implemented")
-
-        for numMigrationMatrixUnc in numMigrationMatrixUncList:
-            if not isinstance(numMigrationMatrixUnc,ROOT.TH2):
-                raise TypeError("numMigrationMatrixUnc doesn't inherit from TH2",type(numMigrationMatrixUnc))
-        for denomMigrationMatrixUnc in denomMigrationMatrixUncList:
-            if not isinstance(denomMigrationMatrixUnc,ROOT.TH2):
-                raise TypeError("denomMigrationMatrixUnc doesn't inherit from TH2",type(denomMigrationMatrixUnc))
+        recoHists = [("numRecoHist",numRecoHist),("denomRecoHist",denomRecoHist)]
+        recoHists += [("numBackgroundHist",h) for h in numBackgroundHistList]
+        recoHists += [("denomBackgroundHist",h) for h in denomBackgroundHistList]
+        recoHists += [(name,h) for name, h in [("numSimRecoHist",numSimRecoHist),("denomSimRecoHist",denomSimRecoHist)]
+                        if not (h is None)]
+        trueHists = [(name,h) for name, h in [("numEfficiencyHist",numEfficiencyHist),("denomEfficiencyHist",denomEfficiencyHist),
+                                                ("numSimTrueHist",numSimTrueHist),("denomSimTrueHist",denomSimTrueHist)]
+                        if not (h is None)]
+        migrationMatrices = [("numMigrationMatrix",numMigrationMatrix),("denomMigrationMatrix",denomMigrationMatrix)]
+        migrationMatrices += [("numMigrationMatrixUnc",h) for h in numMigrationMatrixUncList]
+        migrationMatrices += [("denomMigrationMatrixUnc",h) for h in denomMigrationMatrixUncList]
+        for name, hist in recoHists+trueHists:
+            if not utilities.isTH1(hist):
+                raise TypeError(name+" doesn't inherit from TH1",type(hist))
+        for name, hist in migrationMatrices:
+            if not utilities.isTH2(hist):
+                raise TypeError(name+" doesn't inherit from TH2",type(hist))
+
+        import rootadapter
+        # N-D reco and true histograms are flattened to compact bin indices
+        # with a binning.Binning, like Unfolding does; the migration matrices
+        # are TH2s of those indices
+        if recoBinning is None and numRecoHist.GetDimension() > 1:
+            recoBinning = binning.Binning(_histAxesEdges(rootadapter,numRecoHist))
+        if trueBinning is None and len(trueHists) > 0 and trueHists[0][1].GetDimension() > 1:
+            trueBinning = binning.Binning(_histAxesEdges(rootadapter,trueHists[0][1]))
+        recoBinEdges = rootadapter.histBinEdges(numMigrationMatrix,"x") if recoBinning is None else recoBinning.getFlatBinEdges()
+        trueBinEdges = rootadapter.histBinEdges(numMigrationMatrix,"y") if trueBinning is None else trueBinning.getFlatBinEdges()
+        recoAxesEdges = [recoBinEdges] if recoBinning is None else recoBinning.binEdges
+        trueAxesEdges = [trueBinEdges] if trueBinning is None else trueBinning.binEdges
+        for name, hist in recoHists:
+            if not _sameAxesEdges(_histAxesEdges(rootadapter,hist),recoAxesEdges):
+                raise ValueError(name+" binning doesn't match the migration matrix reco binning")
+        for name, hist in trueHists:
+            if not _sameAxesEdges(_histAxesEdges(rootadapter,hist),trueAxesEdges):
+                raise ValueError(name+" binning doesn't match the migration matrix true binning")
+        for name, hist in migrationMatrices:
+            # Only the number of bins is checked on the compact index axes
+            if not (_sameMigrationAxis(rootadapter.histBinEdges(hist,"x"),recoBinEdges,recoBinning)
+                    and _sameMigrationAxis(rootadapter.histBinEdges(hist,"y"),trueBinEdges,trueBinning)):
+                raise ValueError(name+" binning doesn't match the reco and true binnings")
 
         self.dz = dz
         self.density = density
@@ -101,8 +250,109 @@ class XsecUnfolder(object):
         self.denomBackgroundHistList = denomBackgroundHistList
         self.numMigrationMatrixUncList = numMigrationMatrixUncList
         self.denomMigrationMatrixUncList = denomMigrationMatrixUncList
+        self.numExtraInputs = {"simRecoHist": numSimRecoHist,"simTrueHist": numSimTrueHist}
+        self.denomExtraInputs = {"simRecoHist": denomSimRecoHist,"simTrueHist": denomSimTrueHist}
+        self.recoBinEdges = recoBinEdges
+        self.trueBinEdges = trueBinEdges
+        self.recoBinning = recoBinning
+        self.trueBinning = trueBinning
+        self.numArrays = _histArrays(rootadapter,numRecoHist,numMigrationMatrix,numEfficiencyHist,
+                                        numBackgroundHistList,numMigrationMatrixUncList,
+                                        numSimRecoHist,numSimTrueHist,recoBinning,trueBinning)
+        self.denomArrays = _histArrays(rootadapter,denomRecoHist,denomMigrationMatrix,denomEfficiencyHist,
+                                        denomBackgroundHistList,denomMigrationMatrixUncList,
+                                        denomSimRecoHist,denomSimTrueHist,recoBinning,trueBinning)
+        self.executor = executor
+        # Numerator and denominator unfoldings for each technique, reused between calls to unfold
+        self.unfoldings = {}
+
+    @classmethod
+    def fromArrays(cls,dz,density,numArrays,denomArrays,recoBinEdges,trueBinEdges,executor=None):
+        """
+        Makes an XsecUnfolder from numpy arrays instead of ROOT histograms
+        Inputs:
+            dz: float thickness of thin slab
+            density: float argon number density per volume
+            numArrays: dict of the numerator inputs:
+                "reconstructed": (nReco,) reconstructed counts
+                "migration": (nReco,nTrue) migration matrix
+                "reconstructedVariance": optional (nReco,), default |reconstructed|
+                "efficiency", "efficiencyErrors": optional (nTrue,), default 1 and 0
+                "backgrounds", "backgroundErrors": optional (nBackgrounds,nReco)
+                "migrationUncertainties": optional (nUncertainties,nReco,nTrue) relative
+                    1 sigma uncertainties of the migration matrix
+                "simReconstructed": optional (nReco,) simulated reco, for techniques needing it (TSVDUnfold)
+                "simTrue": optional (nTrue,) simulated true, for techniques needing it (TSVDUnfold)
+            denomArrays: dict of the denominator inputs, as numArrays
+            recoBinEdges: reconstructed bin edges, or a binning.Binning, with which
+                N-D arrays, e.g. (nBackgrounds,)+recoBinning.shape, are flattened
+            trueBinEdges: true bin edges, or a binning.Binning
+            executor: optional default executor for unfold
+        Outputs:
+            XsecUnfolder
+        """
+        result = cls.__new__(cls)
+        result.dz = float(dz)
+        result.density = float(density)
+        result.recoBinning = recoBinEdges if isinstance(recoBinEdges,binning.Binning) else None
+        result.trueBinning = trueBinEdges if isinstance(trueBinEdges,binning.Binning) else None
+        if not (result.recoBinning is None):
+            recoBinEdges = result.recoBinning.getFlatBinEdges()
+        if not (result.trueBinning is None):
+            trueBinEdges = result.trueBinning.getFlatBinEdges()
+        result.recoBinEdges = numpy.array(recoBinEdges,dtype=numpy.float64)
+        result.trueBinEdges = numpy.array(trueBinEdges,dtype=numpy.float64)
+        nReco = len(result.recoBinEdges)-1
+        nTrue = len(result.trueBinEdges)-1
+        result.numArrays = _completeArrays(numArrays,nReco,nTrue,"numArrays",result.recoBinning,result.trueBinning)
+        result.denomArrays = _completeArrays(denomArrays,nReco,nTrue,"denomArrays",result.recoBinning,result.trueBinning)
+        for name in ["numRecoHist","denomRecoHist","numMigrationMatrix","denomMigrationMatrix",
+                        "numEfficiencyHist","denomEfficiencyHist"]:
+            setattr(result,name,None)
+        for name in ["numBackgroundHistList","denomBackgroundHistList",
+                        "numMigrationMatrixUncList","denomMigrationMatrixUncList"]:
+            setattr(result,name,[])
+        result.numExtraInputs = dict((name,result.numArrays.get(key)) for name, key in _extraInputKeys.items())
+        result.denomExtraInputs = dict((name,result.denomArrays.get(key)) for name, key in _extraInputKeys.items())
+        result.executor = executor
+        result.unfoldings = {}
+        return result
 
-    def unfold(self,unfoldingClass,numParameter,denomParameter):
+    def getUnfoldings(self,unfoldingClass):
+        """
+        Returns the numerator and denominator unfoldings for a technique,
+        making them on the first call. Their response factorizations are
+        also shared with other unfoldings through the decomposition cache.
+        Inputs:
+            unfoldingClass: the unfolding technique class to use for unfolding
+        Outputs:
+            tuple of (numerator Unfolding, denominator Unfolding)
+        """
+        if not (unfoldingClass in self.unfoldings):
+            self.unfoldings[unfoldingClass] = (self._makeUnfolding(unfoldingClass,self.numArrays,self.numExtraInputs,"num"),
+                                                self._makeUnfolding(unfoldingClass,self.denomArrays,self.denomExtraInputs,"denom"))
+        return self.unfoldings[unfoldingClass]
+
+    def _makeUnfolding(self,unfoldingClass,arrays,extraInputs,prefix):
+        """
+        Makes the unfolding of the background subtracted reconstructed
+        histogram, with its statistical variance, passing the extra inputs
+        the technique needs
+        """
+        kargs = {}
+        for name in unfoldingClass.extraInputs:
+            if extraInputs.get(name) is None:
+                raise ValueError("{} needs {}{}{} to be given to XsecUnfolder, or \"{}\" in the {}Arrays of XsecUnfolder.fromArrays".format(
+                                    unfoldingClass.__name__,prefix,name[0].upper(),name[1:],_extraInputKeys.get(name,name),prefix))
+            kargs[name] = extraInputs[name]
+        subtracted = arrays["reconstructed"]-arrays["backgrounds"].sum(axis=0)
+        recoBinEdges = self.recoBinEdges if self.recoBinning is None else self.recoBinning
+        trueBinEdges = self.trueBinEdges if self.trueBinning is None else self.trueBinning
+        return unfoldingClass(subtracted,arrays["migration"],recoBinEdges=recoBinEdges,trueBinEdges=trueBinEdges,
+                                reconstructedCovariance=arrays["reconstructedVariance"],**kargs)
+
+    @profiling.profiled()
+    def unfold(self,unfoldingClass,numParameter,denomParameter,useToys=False,nToys=1000,seed=None,executor=None):
         """
         Method to perform unfolding and produce a result
         Inputs:
@@ -111,49 +361,254 @@ class XsecUnfolder(object):
                                     for unfolding the numerator histogram
             denomParameter: the regularization, n-iterations, etc. input parameter
                                     for unfolding the denominator histogram
+            useToys: if True, get the numerator and denominator covariances from
+                                    toys.ToyMC instead of propagating each source by its Jacobian
+            nToys: int number of toys for each of the numerator and denominator
+            seed: seed for the toys
+            executor: optional executors.SerialExecutor, ThreadExecutor, or ProcessExecutor,
+                                    default self.executor. Without toys, the numerator and
+                                    denominator are unfolded concurrently on it; with toys,
+                                    the toys are thrown on it.
         Outputs:
             XsecUnfoldResult
         """
+        if executor is None:
+            executor = self.executor
+        return unfoldChannels([self],unfoldingClass,[numParameter],[denomParameter],
+                                useToys=useToys,nToys=nToys,seed=seed,executor=executor)[0]
 
-        numUnfolding = unfoldingClass(self.numRecoHist,self.numMigrationMatrix)
-        denomUnfolding = unfoldingClass(self.denomRecoHist,self.denomMigrationMatrix)
-        
-        numUnfoldResult = numUnfolding.unfold(numParameter)
-        denomUnfoldResult = denomUnfolding.unfold(denomParameter)
+def _spawnSeeds(seed,n):
+    """
+    Returns n independent SeedSequences from seed, which may be a SeedSequence
+    """
+    if not isinstance(seed,numpy.random.SeedSequence):
+        seed = numpy.random.SeedSequence(seed)
+    return seed.spawn(n)
 
-        result = XsecUnfoldResult(self,numUnfoldResult,denomUnfoldResult)
-        return result
+@profiling.profiled()
+def unfoldSide(unfolding,arrays,parameter,useToys=False,nToys=1000,seed=None,executor=None):
+    """
+    Unfolds and efficiency corrects the numerator or denominator
+    Inputs:
+        unfolding: Unfolding of the background subtracted reconstructed histogram
+        arrays: dict of input arrays from XsecUnfolder.numArrays or denomArrays
+        parameter, useToys, nToys, seed, executor: see XsecUnfolder.unfold
+    Outputs:
+        unfoldResult: UnfoldResult, with the statistical covariance
+        corrected: numpy array (nTrue,) efficiency corrected result
+        covariances: dict of uncertainty source to its covariance of corrected
+    """
+    unfoldResult = unfolding.unfold(parameter)
+    x = unfoldResult.result
+    efficiency = arrays["efficiency"]
+    scale = _safeInverse(efficiency)
+    corrected = x*scale
+    if useToys:
+        import toys
+        toyMC = toys.ToyMC(unfolding,parameter,efficiency=efficiency,efficiencyErrors=arrays["efficiencyErrors"],
+                            backgrounds=list(arrays["backgrounds"]),backgroundErrors=list(arrays["backgroundErrors"]),
+                            migrationUncertainties=list(arrays["migrationUncertainties"]))
+        accumulator = toyMC.run(nToys,seed=seed,executor=executor)
+        return unfoldResult, corrected, {"total": accumulator.getCovariance()}
+
+    # Each background's errors and each migration uncertainty is one fully
+    # correlated source; its Jacobian column is the shift of the result
+    unfoldedCovariances = {"statistical": unfoldResult.covariance}
+    backgroundCovariance = numpy.zeros(unfoldResult.covariance.shape)
+    for backgroundErrors in arrays["backgroundErrors"]:
+        shifted = unfolding.withReconstructed(unfolding.reconstructed-backgroundErrors,unfolding.reconstructedVariance)
+        shift = shifted.unfold(parameter).result-x
+        backgroundCovariance += numpy.outer(shift,shift)
+    unfoldedCovariances["background"] = backgroundCovariance
+    migrationCovariance = numpy.zeros(unfoldResult.covariance.shape)
+    for migrationUncertainty in arrays["migrationUncertainties"]:
+        shifted = unfolding.withMigration(numpy.clip(unfolding.getMigrationArray()*(1.+migrationUncertainty),0.,None))
+        shift = shifted.unfold(parameter).result-x
+        migrationCovariance += numpy.outer(shift,shift)
+    unfoldedCovariances["migration"] = migrationCovariance
+
+    covariances = dict((source,covariance*numpy.outer(scale,scale)) for source, covariance in unfoldedCovariances.items())
+    covariances["efficiency"] = numpy.diag((corrected*scale*arrays["efficiencyErrors"])**2)
+    return unfoldResult, corrected, covariances
+
+def _unfoldSideTask(sides,task):
+    iSide, parameter = task
+    unfolding, arrays = sides[iSide]
+    return unfoldSide(unfolding,arrays,parameter)
+
+@profiling.profiled()
+def unfoldChannels(xsecUnfolders,unfoldingClass,numParameters,denomParameters,useToys=False,nToys=1000,seed=None,executor=None):
+    """
+    Unfolds several cross-section channels, e.g. different targets or
+    final states. Without toys, the numerator and denominator of every
+    channel are independent tasks run concurrently on executor; with toys,
+    they are unfolded in turn and the toys of each are thrown on executor.
+    Unfoldings with identical responses share one factorization, computed
+    once before the tasks are sent to the workers.
+    Inputs:
+        xsecUnfolders: list of XsecUnfolder
+        unfoldingClass: the unfolding technique class to use for unfolding
+        numParameters: list of the numerator parameter of each channel
+        denomParameters: list of the denominator parameter of each channel
+        useToys, nToys: see XsecUnfolder.unfold
+        seed: seed for the toys; with one channel, used as in XsecUnfolder.unfold
+        executor: optional executors.SerialExecutor, ThreadExecutor, or ProcessExecutor
+    Outputs:
+        list of XsecUnfoldResult, one per channel
+    """
+    xsecUnfolders = list(xsecUnfolders)
+    if not (len(numParameters) == len(xsecUnfolders) and len(denomParameters) == len(xsecUnfolders)):
+        raise ValueError("Need one numerator and one denominator parameter per channel")
+    sides = []
+    parameters = []
+    for xsecUnfolder, numParameter, denomParameter in zip(xsecUnfolders,numParameters,denomParameters):
+        numUnfolding, denomUnfolding = xsecUnfolder.getUnfoldings(unfoldingClass)
+        sides += [(numUnfolding,xsecUnfolder.numArrays),(denomUnfolding,xsecUnfolder.denomArrays)]
+        parameters += [numParameter,denomParameter]
+
+    if useToys:
+        if len(xsecUnfolders) == 1:
+            seeds = _spawnSeeds(seed,2)
+        else:
+            seeds = [side for channelSeed in _spawnSeeds(seed,len(xsecUnfolders)) for side in channelSeed.spawn(2)]
+        sideResults = [unfoldSide(unfolding,arrays,parameter,True,nToys,sideSeed,executor)
+                        for (unfolding, arrays), parameter, sideSeed in zip(sides,parameters,seeds)]
+    elif executor is None:
+        sideResults = [unfoldSide(unfolding,arrays,parameter) for (unfolding, arrays), parameter in zip(sides,parameters)]
+    else:
+        # Factorize shared responses here, so they are computed once and
+        # sent to the workers, instead of once in each of them
+        keys = [unfolding.getDecompositionKey() for unfolding, arrays in sides]
+        for (unfolding, arrays), key in zip(sides,keys):
+            if keys.count(key) > 1:
+                unfolding.decompose()
+        sideResults = executor.run(_unfoldSideTask,list(enumerate(parameters)),sides)
+        for (unfolding, arrays), (unfoldResult, corrected, covariances) in zip(sides,sideResults):
+            # Results from worker processes come back without their unfolding
+            unfoldResult.unfolding = unfolding
+
+    results = []
+    for iChannel, xsecUnfolder in enumerate(xsecUnfolders):
+        numUnfoldResult, numCorrected, numCovariances = sideResults[2*iChannel]
+        denomUnfoldResult, denomCorrected, denomCovariances = sideResults[2*iChannel+1]
+        results.append(XsecUnfoldResult(xsecUnfolder,numUnfoldResult,denomUnfoldResult,
+                                            numCorrected,numCovariances,denomCorrected,denomCovariances))
+    return results
 
 class XsecUnfoldResult(object):
     """
     Holds result of XsecUnfolder class for a specific technique and set of parameters
+
+    The cross section is numerator / denominator / (density*dz) in each
+    true bin, with the covariance of each uncertainty source propagated
+    through the ratio by its Jacobian. The numerator and denominator are
+    independent samples.
     """
 
-    def __init__(self,xsecUnfolder,numUnfoldResult,denomUnfoldResult):
+    @profiling.profiled()
+    def __init__(self,xsecUnfolder,numUnfoldResult,denomUnfoldResult,
+                        numCorrected=None,numCovariances=None,denomCorrected=None,denomCovariances=None):
         """
         Inputs:
             xsecUnfolder: the XsecUnfolder object used to unfold
             numUnfoldResult: the numerator UnfoldResult object
             denomUnfoldResult: the denominator UnfoldResult object
+            numCorrected: optional numpy array efficiency corrected numerator,
+                default the numerator UnfoldResult
+            numCovariances: optional dict of uncertainty source to covariance of numCorrected,
+                default the numerator UnfoldResult covariance as "statistical"
+            denomCorrected: optional numpy array efficiency corrected denominator
+            denomCovariances: optional dict of uncertainty source to covariance of denomCorrected
         """
 
         if not isinstance(xsecUnfolder,XsecUnfolder):
             raise TypeError("xsecUnfolder isn't a XsecUnfolder",type(xsecUnfolder))
-        if not isinstance(numUnfoldResult,UnfoldResult):
+        if not isinstance(numUnfoldResult,unfold_base.UnfoldResult):
             raise TypeError("numUnfoldResult isn't a UnfoldResult",type(numUnfoldResult))
-        if not isinstance(denomUnfoldResult,UnfoldResult):
+        if not isinstance(denomUnfoldResult,unfold_base.UnfoldResult):
             raise TypeError("denomUnfoldResult isn't a UnfoldResult",type(denomUnfoldResult))
+        if numCorrected is None:
+            numCorrected = numUnfoldResult.result
+            numCovariances = {"statistical": numUnfoldResult.covariance}
+        if denomCorrected is None:
+            denomCorrected = denomUnfoldResult.result
+            denomCovariances = {"statistical": denomUnfoldResult.covariance}
 
         self.xsecUnfolder = xsecUnfolder
         self.numUnfoldResult = numUnfoldResult
         self.denomUnfoldResult = denomUnfoldResult
+        self.numCorrected = numCorrected
+        self.numCovariances = numCovariances
+        self.denomCorrected = denomCorrected
+        self.denomCovariances = denomCovariances
+        self.binEdges = numUnfoldResult.binEdges
+
+        scaleFactor = 1./(xsecUnfolder.density*xsecUnfolder.dz)
+        inverseDenom = _safeInverse(denomCorrected)
+        self.result = numCorrected*inverseDenom*scaleFactor
+        numJacobian = inverseDenom*scaleFactor
+        denomJacobian = -self.result*inverseDenom
+        zeros = numpy.zeros((len(self.result),len(self.result)))
+        self.covariances = {}
+        for source in list(numCovariances)+[source for source in denomCovariances if not (source in numCovariances)]:
+            self.covariances[source] = (numCovariances.get(source,zeros)*numpy.outer(numJacobian,numJacobian)
+                                        + denomCovariances.get(source,zeros)*numpy.outer(denomJacobian,denomJacobian))
+        self.covariance = sum(self.covariances.values(),zeros)
 
+    @profiling.profiled()
     def getResult(self):
-        result = self.numUnfoldResult.getResult()
-        result.Divide(self.denomUnfoldResult.getResult())
-        scaleFactor = 1./(self.xsecUnfolder.density*self.xsecUnfolder.dz)
-        result.Scale(scaleFactor)
-        return result
-        
-    def plotResult(self):
-        pass
+        import rootadapter
+        return rootadapter.makeHist(self.result,self.binEdges,errors=self.getErrorArray())
+    @profiling.profiled()
+    def getCovarianceMatrix(self):
+        import rootadapter
+        return rootadapter.makeHist2D(self.covariance,self.binEdges,self.binEdges)
+    def getResultArray(self):
+        return self.result.copy()
+    def getErrorArray(self):
+        return numpy.sqrt(numpy.abs(numpy.diag(self.covariance)))
+    def getCovarianceArray(self):
+        return self.covariance.copy()
+    def getResultArrayND(self):
+        """
+        Returns the result with the shape of the XsecUnfolder's true
+        binning.Binning, 0 in masked bins, or the 1D result without one
+        """
+        trueBinning = self.xsecUnfolder.trueBinning
+        if trueBinning is None:
+            return self.getResultArray()
+        return trueBinning.unflatten(self.result)
+    def getErrorArrayND(self):
+        trueBinning = self.xsecUnfolder.trueBinning
+        if trueBinning is None:
+            return self.getErrorArray()
+        return trueBinning.unflatten(self.getErrorArray())
+    def getCovarianceArrayND(self):
+        trueBinning = self.xsecUnfolder.trueBinning
+        if trueBinning is None:
+            return self.getCovarianceArray()
+        return trueBinning.unflattenCovariance(self.covariance)
+    def getCovarianceArraysBySource(self):
+        """
+        Returns a dict of uncertainty source ("statistical", "background",
+        "migration", "efficiency", or "total" for toys) to its covariance
+        """
+        return dict((source,covariance.copy()) for source, covariance in self.covariances.items())
+    def getRelativeErrorArraysBySource(self):
+        """
+        Returns a dict of uncertainty source to the relative 1 sigma error in each bin
+        """
+        scale = _safeInverse(numpy.abs(self.result))
+        return dict((source,numpy.sqrt(numpy.abs(numpy.diag(covariance)))*scale)
+                        for source, covariance in self.covariances.items())
+
+    @profiling.profiled()
+    def plotResult(self,outfilename):
+        unfolding = self.numUnfoldResult
+        with utilities.scratchCanvas() as c:
+            hist = self.getResult()
+            hist.Draw("E")
+            hist.GetXaxis().SetTitle("True {}".format(unfolding.xAxisTitle))
+            hist.GetYaxis().SetTitle("Cross Section")
+            hist.SetTitle(unfolding.titlePrefix+"Unfolded Cross Section")
+            c.SaveAs(outfilename)